@@ -0,0 +1,199 @@
+# ann.py
+#
+# Backend di ricerca dei vicini per FaceIndex. Lavorano tutti su embedding
+# normalizzati (similarità = prodotto scalare) e restituiscono, per ogni riga
+# candidata dell'indice, la similarità migliore rispetto ai volti della query.
+# - ExactSearch: confronta la query con tutte le righe (risultati esatti)
+# - IVFSearch: inverted file. Le righe sono raggruppate attorno a nlist
+#   centroidi (k-means sferico) e una ricerca guarda solo le righe dei nprobe
+#   centroidi più vicini alla query: nprobe regola il compromesso tra recall e
+#   latenza. Finché l'indice è piccolo la ricerca resta esatta.
+
+import json
+import logging
+import math
+import time
+
+import numpy as np
+
+# Righe elaborate per blocco nelle assegnazioni ai centroidi (limita la memoria)
+ASSIGN_BLOCK_ROWS = 65536
+
+
+def _empty_result():
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+
+def _best_per_row(rows, similarities):
+    """Per ogni riga ripetuta tiene solo la similarità più alta."""
+    order = np.argsort(-similarities, kind='stable')
+    rows, similarities = rows[order], similarities[order]
+    _, first = np.unique(rows, return_index=True)
+    return rows[first], similarities[first]
+
+
+class ExactSearch:
+    """Confronto esaustivo: un prodotto matrice-matrice su tutto l'indice."""
+
+    name = 'exact'
+
+    def add(self, matrix, first_row):
+        pass
+
+    def remove(self, keep):
+        pass
+
+    def search(self, query, matrix):
+        if not len(matrix):
+            return _empty_result()
+        similarities = (query @ matrix.T).max(axis=0)
+        return np.arange(len(matrix)), similarities
+
+    def state(self):
+        return {}
+
+    def load_state(self, data, matrix):
+        pass
+
+
+class IVFSearch:
+    """
+    Inverted file su centroidi appresi con k-means sferico.
+    nlist: numero di centroidi (None = 4 * sqrt(righe) al momento dell'addestramento)
+    nprobe: centroidi visitati per ogni volto della query
+    min_train: righe necessarie prima di addestrare; sotto questa soglia la ricerca è esatta
+    Le righe aggiunte dopo l'addestramento vengono assegnate al centroide più vicino;
+    con nlist automatico l'indice viene riaddestrato quando le righe si quadruplicano.
+    """
+
+    name = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=32, min_train=10000, iterations=10,
+                 points_per_centroid=64, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.iterations = iterations
+        self.points_per_centroid = points_per_centroid
+        self.seed = seed
+
+        self.centroids = None
+        self.trained_on = 0
+        self._assign = np.empty(0, dtype=np.int32) # riga -> centroide
+        self._order = None                         # righe ordinate per centroide
+        self._offsets = None                       # inizio di ogni lista in _order
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    @staticmethod
+    def _nearest(vectors, centroids):
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), ASSIGN_BLOCK_ROWS):
+            block = vectors[start:start + ASSIGN_BLOCK_ROWS]
+            labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return labels
+
+    def train(self, matrix):
+        """Apprende i centroidi da un campione delle righe e riassegna tutto l'indice."""
+        started = time.perf_counter()
+        rng = np.random.default_rng(self.seed)
+        rows = len(matrix)
+        nlist = self.nlist or int(4 * math.sqrt(rows))
+        nlist = max(1, min(nlist, rows))
+
+        sample_size = min(rows, nlist * self.points_per_centroid)
+        sample = matrix[np.sort(rng.choice(rows, sample_size, replace=False))]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            labels = self._nearest(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            # I centroidi rimasti senza punti ripartono da un punto a caso
+            empty = np.flatnonzero(counts == 0)
+            if len(empty):
+                sums[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        self.centroids = centroids
+        self.trained_on = rows
+        self._assign = self._nearest(matrix, centroids)
+        self._order = None
+        logging.info(f"Indice IVF addestrato: {nlist} liste su {rows} volti in {time.perf_counter() - started:.1f}s")
+
+    def add(self, matrix, first_row):
+        rows = len(matrix)
+        if not self.trained:
+            if rows >= self.min_train:
+                self.train(matrix)
+            return
+        if self.nlist is None and rows >= 4 * self.trained_on:
+            self.train(matrix)
+            return
+        self._assign = np.concatenate([self._assign[:first_row], self._nearest(matrix[first_row:], self.centroids)])
+        self._order = None
+
+    def remove(self, keep):
+        if self.trained:
+            self._assign = self._assign[keep]
+            self._order = None
+
+    def _lists(self):
+        if self._order is None:
+            self._order = np.argsort(self._assign, kind='stable')
+            self._offsets = np.searchsorted(self._assign[self._order], np.arange(len(self.centroids) + 1))
+        return self._order, self._offsets
+
+    def search(self, query, matrix):
+        if not self.trained:
+            return ExactSearch().search(query, matrix)
+        if not len(matrix):
+            return _empty_result()
+
+        order, offsets = self._lists()
+        nprobe = min(self.nprobe, len(self.centroids))
+        centroid_scores = query @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+
+        found_rows = []
+        found_similarities = []
+        for face, lists in zip(query, probes):
+            candidates = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in lists])
+            if len(candidates):
+                found_rows.append(candidates)
+                found_similarities.append(matrix[candidates] @ face)
+        if not found_rows:
+            return _empty_result()
+        return _best_per_row(np.concatenate(found_rows), np.concatenate(found_similarities))
+
+    def state(self):
+        if not self.trained:
+            return {}
+        return {
+            'ivf_centroids': self.centroids,
+            'ivf_assign': self._assign,
+            'ivf_meta': np.array(json.dumps({'trained_on': self.trained_on})),
+        }
+
+    def load_state(self, data, matrix):
+        """Ripristina centroidi e assegnazioni salvati (o li ricalcola se mancano)."""
+        if 'ivf_centroids' in data and len(data['ivf_assign']) == len(matrix):
+            self.centroids = data['ivf_centroids']
+            self._assign = data['ivf_assign']
+            self.trained_on = json.loads(str(data['ivf_meta']))['trained_on']
+            self._order = None
+        else:
+            self.add(matrix, 0)
+
+
+def create_search_backend(name, **params):
+    """Crea il backend configurato ('exact' o 'ivf')."""
+    if name == 'exact':
+        return ExactSearch()
+    if name == 'ivf':
+        return IVFSearch(**params)
+    raise ValueError(f"Backend di ricerca sconosciuto: {name}")
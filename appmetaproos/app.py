@@ -1,20 +1,28 @@
-import mimetypes
-from PIL import Image
-import os
 import boto3
 # import sqlite3 # Non più necessario se usi PostgreSQL
-from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, session
-from werkzeug.utils import secure_filename
+from flask import Flask, Response, request, render_template, redirect, url_for, flash, jsonify, session
+import io
+import secrets
 import uuid
 # Importa TUTTE le funzioni del database, incluse le nuove per i volti
-from database import init_db, add_face_record, get_photos_by_face_ids, get_all_photos, \
-                     delete_all_face_records, get_all_unique_face_ids_with_counts, get_photos_by_single_face_id
+from database import init_db, get_photo_renditions_by_face_ids, get_photos_page, \
+                     get_all_unique_face_ids_with_counts, get_photos_by_single_face_id, list_events
 from config import Config
+from events import EventError, active_events, archive_event, collection_id, create_event, resolve_event
+from jobs import submit_indexing_job, get_job
+from purge import get_purge_status, resume_interrupted_purge, start_purge
+from cache import create_cache
+from search_cache import create_search_cache, perceptual_hash
+from signing import UrlSigner, object_key_from_url
+from normalizer import normalize_for_rekognition
+import metrics
 
 # Inizializzazione dell'applicazione Flask. Questa riga è FONDAMENTALE e deve essere qui.
 app = Flask(__name__)
 # Imposta la chiave segreta per le sessioni da Config (letta dalla variabile d'ambiente FLASK_SECRET_KEY)
 app.secret_key = Config.SECRET_KEY
+# Durata e numero delle richieste per endpoint, esposti su /metrics
+metrics.instrument_flask(app)
 
 # Inizializza il database (creerà la tabella 'faces' se non esiste)
 init_db()
@@ -24,15 +32,26 @@ init_db()
 s3_client = boto3.client('s3', region_name=Config.AWS_REGION)
 rekognition_client = boto3.client('rekognition', region_name=Config.AWS_REGION)
 
-def allowed_file(filename):
-    """Controlla se l'estensione del file è consentita."""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
+# Firma degli URL della galleria, arrotondata a finestre temporali fisse
+url_signer = UrlSigner(s3_client, Config.S3_GALLERY_BUCKET, Config.AWS_REGION,
+                       bucket_seconds=Config.PRESIGN_BUCKET_SECONDS, ttl=Config.PRESIGN_TTL)
+
+# Una cancellazione di tutte le foto interrotta da un riavvio riprende dall'ultimo lotto completato
+resume_interrupted_purge(s3_client, rekognition_client)
+
+# Cache dei risultati di ricerca dei selfie (None se disattivata)
+search_cache = create_search_cache()
+
+# Gallerie dei clienti: token opaco -> foto trovate da /search (in memoria o su Redis, con scadenza)
+gallery_store = create_cache(Config.GALLERY_STORE_BACKEND, namespace='gallery',
+                             max_entries=Config.GALLERY_STORE_MAX_ENTRIES, ttl=Config.GALLERY_TTL,
+                             redis_url=Config.REDIS_URL)
 
 @app.route('/')
 def index():
-    """Pagina principale per i clienti per il login con riconoscimento facciale."""
-    return render_template('index.html')
+    """Pagina principale per i clienti per il login con riconoscimento facciale (?event=<chiave> per un evento)."""
+    return render_template('index.html', events=active_events(),
+                           event_key=request.args.get('event', Config.DEFAULT_EVENT))
 
 # ROUTE ADMIN PRINCIPALE (con gestione login/logout)
 @app.route('/admin', methods=['GET', 'POST'])
@@ -67,7 +86,12 @@ def admin():
         return render_template('admin.html', logged_in=False) # Mostra la pagina di login (form)
     else:
         print("Already logged in. Rendering full admin panel.")
-        return render_template('admin.html', logged_in=True) # Mostra il pannello admin completo
+        # Se arriva da un upload, il template segue l'avanzamento del job
+        # Una cancellazione di tutte le foto in corso (o fallita) viene mostrata con il suo avanzamento
+        purge = get_purge_status()
+        return render_template('admin.html', logged_in=True, job_id=request.args.get('job'), # Mostra il pannello admin completo
+                               purge=purge if purge and purge['status'] != 'done' else None,
+                               events=list_events(face_counts=True), default_event=Config.DEFAULT_EVENT)
 
 # ROUTE LOGOUT ADMIN
 @app.route('/admin/logout', methods=['POST'])
@@ -95,71 +119,35 @@ def upload_photos():
         flash('No selected file')
         return redirect(request.url)
     
+    # Le foto vanno nell'evento scelto nel form (quello predefinito se assente)
     try:
-        for photo in photos:
-            if photo and allowed_file(photo.filename):
-                filename = secure_filename(photo.filename)
-                unique_filename = str(uuid.uuid4()) + os.path.splitext(filename)[1]
-                
-                # Salva il file originale in un percorso temporaneo
-                original_temp_path = os.path.join(Config.TEMP_DIR, "original-" + unique_filename)
-                photo.save(original_temp_path)
-
-                # Percorso per l'immagine da inviare a Rekognition (potrebbe essere ridimensionata)
-                rekognition_image_path = original_temp_path
-                
-                # Logica di ridimensionamento per Rekognition se il file è troppo grande
-                if os.path.getsize(original_temp_path) > 15 * 1024 * 1024: # 15MB limite Rekognition
-                    resized_temp_path = os.path.join(Config.TEMP_DIR, "resized-" + unique_filename)
-                    with Image.open(original_temp_path) as img:
-                        img.thumbnail((1920, 1920)) # Ridimensiona mantenendo le proporzioni
-                        img.save(resized_temp_path, "JPEG", quality=90)
-                    rekognition_image_path = resized_temp_path
-
-                # Indovina il tipo di file dall'originale
-                content_type, _ = mimetypes.guess_type(unique_filename)
-                if content_type is None:
-                    content_type = 'application/octet-stream'
-
-                extra_args = {'ACL': 'public-read', 'ContentType': content_type}
-                
-                # Carica la FOTO ORIGINALE di alta qualità su S3
-                s3_client.upload_file(
-                    original_temp_path, 
-                    Config.S3_GALLERY_BUCKET, 
-                    unique_filename,
-                    ExtraArgs=extra_args
-                )
-                
-                s3_url = f"https://{Config.S3_GALLERY_BUCKET}.s3.{Config.AWS_REGION}.amazonaws.com/{unique_filename}"
-                
-                # Invia l'IMMAGINE OTTIMIZZATA a Rekognition per l'analisi
-                with open(rekognition_image_path, 'rb') as image_for_rekognition:
-                    response = rekognition_client.index_faces(
-                        CollectionId=Config.REKOGNITION_COLLECTION_ID,
-                        Image={'Bytes': image_for_rekognition.read()},
-                        ExternalImageId=unique_filename,
-                        DetectionAttributes=['ALL']
-                    )
-                
-                # Salva i record nel database
-                for face_record in response['FaceRecords']:
-                    face_id = face_record['Face']['FaceId']
-                    add_face_record(face_id, s3_url)
-                
-                # Pulisci TUTTI i file temporanei
-                os.remove(original_temp_path)
-                if rekognition_image_path != original_temp_path:
-                    os.remove(rekognition_image_path)
-        
-        flash('Photos uploaded and indexed successfully!', 'success')
-        return redirect(url_for('admin'))
-    
-    except Exception as e:
-        print(f"ADMIN UPLOAD ERROR: {e}")
-        flash(f'Error uploading photos: {str(e)}', 'danger')
+        event_key = resolve_event(request.form.get('event'))
+    except EventError as e:
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), e.status
+        flash(str(e), 'danger')
         return redirect(url_for('admin'))
 
+    # I file vengono solo bufferizzati: S3 e Rekognition girano in background
+    job = submit_indexing_job(photos, s3_client, rekognition_client, event_key)
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job.id, 'status_url': url_for('admin_job_status', job_id=job.id)}), 202
+
+    flash(f'Upload accepted: {len(job.files)} photos are being indexed in the background.', 'info')
+    return redirect(url_for('admin', job=job.id))
+
+@app.route('/admin/jobs/<job_id>')
+def admin_job_status(job_id):
+    """Restituisce in JSON l'avanzamento di un job di indicizzazione (solo admin)."""
+    if not session.get('logged_in_admin'):
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
 @app.route('/search', methods=['POST'])
 def search_faces():
     """Gestisce la ricerca di riconoscimento facciale per il login del cliente."""
@@ -170,53 +158,186 @@ def search_faces():
     
     if selfie.filename == '':
         return jsonify({'error': 'No selfie selected'}), 400
+
+    # La ricerca avviene nella collection di un solo evento (quello predefinito se non indicato)
+    try:
+        event_key = resolve_event(request.form.get('event'))
+    except EventError as e:
+        return jsonify({'error': str(e)}), e.status
     
     try:
-        filename = str(uuid.uuid4()) + '.jpg'
-        temp_path = os.path.join(Config.TEMP_DIR, filename)
-        selfie.save(temp_path)
-        
-        with open(temp_path, 'rb') as image:
-            response = rekognition_client.search_faces_by_image(
-                CollectionId=Config.REKOGNITION_COLLECTION_ID,
-                Image={'Bytes': image.read()},
-                MaxFaces=5,
-                FaceMatchThreshold=98
-            )
-        
-        os.remove(temp_path)
-        
-        face_ids = [match['Face']['FaceId'] for match in response['FaceMatches']]
-        
-        if not face_ids:
-            return jsonify({'photo_urls': []})
+        # Il selfie viene letto direttamente in memoria, senza passare dal disco
+        selfie_bytes = selfie.read()
+        matches = None
 
-        photo_urls = get_photos_by_face_ids(face_ids)
-        
-        # Genera URL pre-firmati per un accesso sicuro e temporaneo alle immagini S3
-        presigned_urls = []
-        for url in photo_urls:
+        # Un selfie ripetuto (o quasi identico) nella stessa sessione usa i risultati in cache
+        if search_cache is not None:
+            # I risultati in cache valgono solo per l'evento in cui sono stati cercati
+            search_session = f"{session.setdefault('search_session', uuid.uuid4().hex)}:{event_key}"
             try:
-                object_key = url.split('/')[-1] # Estrai la chiave dell'oggetto dall'URL
-                presigned_url = s3_client.generate_presigned_url('get_object',
-                                                                 Params={'Bucket': Config.S3_GALLERY_BUCKET,
-                                                                         'Key': object_key},
-                                                                 ExpiresIn=3600) # URL valido per 1 ora
-                presigned_urls.append(presigned_url)
+                selfie_hash = perceptual_hash(selfie_bytes)
             except Exception as e:
-                print(f"Error generating presigned URL for {url}: {e}")
+                print(f"Error hashing selfie: {e}")
+                selfie_hash = None
+            if selfie_hash is not None:
+                matches = search_cache.get(search_session, selfie_hash)
+
+        if matches is None:
+            # JPEG/PNG sotto i 5 MB così com'è, altrimenti ridotto con una sola decodifica
+            rekognition_bytes, normalize_stats = normalize_for_rekognition(io.BytesIO(selfie_bytes))
+            if normalize_stats['reencoded']:
+                print(f"NORMALIZED selfie: {len(selfie_bytes)} -> {normalize_stats['output_bytes']} bytes, "
+                      f"decode {normalize_stats['decode_ms']}ms, encode {normalize_stats['encode_ms']}ms, "
+                      f"{normalize_stats['attempts']} attempt(s)")
+            with metrics.track('rekognition', 'search_faces_by_image'):
+                response = rekognition_client.search_faces_by_image(
+                    CollectionId=collection_id(event_key),
+                    Image={'Bytes': rekognition_bytes},
+                    MaxFaces=5,
+                    FaceMatchThreshold=98
+                )
+            matches = [{'face_id': match['Face']['FaceId'], 'similarity': match['Similarity']}
+                       for match in response['FaceMatches']]
+            # I risultati vuoti non vengono salvati: il cliente riproverà con un selfie migliore
+            if matches and search_cache is not None and selfie_hash is not None:
+                search_cache.put(search_session, selfie_hash, matches)
+
+        face_ids = [match['face_id'] for match in matches]
+        
+        if not face_ids:
+            return jsonify({'photo_count': 0})
+
+        # (photo_url, thumb_url, web_url) in ordine stabile
+        photo_rows = get_photo_renditions_by_face_ids(face_ids, event_key)
+        if not photo_rows:
+            return jsonify({'photo_count': 0})
+
+        # Il risultato resta sul server: al browser va solo un token breve e opaco
+        gallery_token = secrets.token_urlsafe(16)
+        gallery_store.set(gallery_token, [list(row) for row in photo_rows])
 
-        return jsonify({'photo_urls': presigned_urls if presigned_urls else list(photo_urls)})
+        return jsonify({
+            'gallery_token': gallery_token,
+            'gallery_url': url_for('gallery', token=gallery_token),
+            'photo_count': len(photo_rows)
+        })
     
     except Exception as e:
+        metrics.count_error('app', 'search', e)
         print(f"SEARCH ERROR: {e}") 
         return jsonify({'error': str(e)}), 500
 
-@app.route('/gallery')
-def gallery():
-    """Visualizza la galleria di foto del cliente."""
-    photo_urls = request.args.getlist('photos')
-    return render_template('gallery.html', photos=photo_urls)
+@app.route('/admin/search_cache')
+def admin_search_cache_stats():
+    """Restituisce in JSON i contatori hit/miss della cache dei selfie (solo admin)."""
+    if not session.get('logged_in_admin'):
+        return jsonify({'error': 'Unauthorized access'}), 401
+    if search_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **search_cache.stats()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metriche in formato Prometheus. Con METRICS_TOKEN impostato serve 'Authorization: Bearer <token>'."""
+    if Config.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {Config.METRICS_TOKEN}":
+        return jsonify({'error': 'Unauthorized access'}), 401
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/gallery/<token>')
+def gallery(token):
+    """Visualizza una pagina della galleria di foto del cliente salvata da /search."""
+    photo_rows = gallery_store.get(token)
+    if photo_rows is None:
+        return render_template('gallery.html', photos=[], expired=True), 404
+
+    page_size = Config.GALLERY_PAGE_SIZE
+    pages = max(1, -(-len(photo_rows) // page_size))
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    page_rows = photo_rows[(page - 1) * page_size:page * page_size]
+
+    # Firma solo le foto di questa pagina (originali, miniature e versioni per lo schermo) in un solo passaggio.
+    # Gli URL restano identici entro la stessa finestra temporale, quindi browser e CDN li mettono in cache.
+    signed = {}
+    try:
+        signed = url_signer.sign_many(object_key_from_url(url) for row in page_rows for url in row if url)
+    except Exception as e:
+        print(f"Error generating presigned URLs: {e}")
+
+    def presigned(url):
+        return signed.get(object_key_from_url(url), url) if url else None
+
+    photos = []
+    for photo_url, thumb_url, web_url in page_rows:
+        original = presigned(photo_url)
+        web = presigned(web_url) or original
+        photos.append({'original': original, 'web': web, 'thumb': presigned(thumb_url) or web})
+
+    return render_template('gallery.html', photos=photos, widths=Config.DERIVATIVE_WIDTHS,
+                           token=token, page=page, pages=pages, first_index=(page - 1) * page_size)
+
+# ROUTE ADMIN: Eventi (album), ognuno con la propria collection Rekognition
+@app.route('/admin/events', methods=['GET', 'POST'])
+def admin_events():
+    """Elenca gli eventi (GET, in JSON) o ne crea uno nuovo (POST con 'event_key' e 'name')."""
+    if not session.get('logged_in_admin'):
+        if request.method == 'GET' or request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': 'Unauthorized access'}), 401
+        flash('Unauthorized access', 'danger')
+        return redirect(url_for('admin'))
+
+    if request.method == 'GET':
+        return jsonify({'events': [serialize_event(event) for event in list_events(face_counts=True)]})
+
+    try:
+        event = create_event(request.form.get('event_key'), request.form.get('name'), rekognition_client)
+    except EventError as e:
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), e.status
+        flash(str(e), 'danger')
+        return redirect(url_for('admin'))
+    except Exception as e:
+        print(f"ERROR creating event: {e}")
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), 500
+        flash(f'Error creating event: {str(e)}', 'danger')
+        return redirect(url_for('admin'))
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(serialize_event(event)), 201
+    flash(f"Event '{event['name']}' created.", 'success')
+    return redirect(url_for('admin'))
+
+@app.route('/admin/events/<event_key>/archive', methods=['POST'])
+def admin_archive_event(event_key):
+    """Archivia un evento: esce dall'indice di ricerca, le sue foto restano consultabili dall'admin."""
+    if not session.get('logged_in_admin'):
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': 'Unauthorized access'}), 401
+        flash('Unauthorized access', 'danger')
+        return redirect(url_for('admin'))
+
+    try:
+        event = archive_event(event_key, rekognition_client)
+    except EventError as e:
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), e.status
+        flash(str(e), 'danger')
+        return redirect(url_for('admin'))
+    except Exception as e:
+        print(f"ERROR archiving event {event_key}: {e}")
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), 500
+        flash(f'Error archiving event: {str(e)}', 'danger')
+        return redirect(url_for('admin'))
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(serialize_event(event))
+    flash(f"Event '{event['name']}' archived: it is no longer searchable.", 'info')
+    return redirect(url_for('admin'))
+
+def serialize_event(event):
+    """Evento del database in forma serializzabile in JSON."""
+    return {key: value.isoformat() if hasattr(value, 'isoformat') else value for key, value in event.items()}
 
 # ROUTE ADMIN: Visualizza tutte le foto caricate
 @app.route('/admin/all_photos')
@@ -228,13 +349,38 @@ def all_photos_admin():
         return redirect(url_for('admin'))
 
     try:
-        all_photo_urls = get_all_photos()
-        return render_template('all_photos.html', photos=all_photo_urls)
+        # Solo la prima pagina: le successive arrivano da /admin/api/photos durante lo scroll
+        event_key = request.args.get('event') or None
+        rows, next_cursor = get_photos_page(limit=Config.PHOTOS_PAGE_SIZE, event_key=event_key)
+        return render_template('all_photos.html', photos=unique_photos(rows), next_cursor=next_cursor,
+                               widths=Config.DERIVATIVE_WIDTHS, event_key=event_key)
     except Exception as e:
         print(f"ERROR displaying all photos: {e}")
         flash(f'Error loading photos: {str(e)}', 'danger')
         return redirect(url_for('admin'))
 
+@app.route('/admin/api/photos')
+def admin_photos_api():
+    """Restituisce in JSON una pagina di foto (paginazione keyset con ?cursor=<id>, ?event=<chiave> facoltativo, solo admin)."""
+    if not session.get('logged_in_admin'):
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    cursor = request.args.get('cursor', type=int)
+    limit = min(max(request.args.get('limit', Config.PHOTOS_PAGE_SIZE, type=int), 1), 200)
+    rows, next_cursor = get_photos_page(before_id=cursor, limit=limit, event_key=request.args.get('event') or None)
+    return jsonify({'photos': unique_photos(rows), 'next_cursor': next_cursor})
+
+def unique_photos(rows):
+    """
+    Foto delle righe (id, photo_url, thumb_url, web_url) senza duplicati
+    (una foto con più volti ha più righe), con le URL delle versioni ridotte.
+    """
+    photos = {}
+    for _, photo_url, thumb_url, web_url in rows:
+        if photo_url not in photos:
+            photos[photo_url] = {'url': photo_url, 'thumb': thumb_url, 'web': web_url}
+    return list(photos.values())
+
 # ROUTE ADMIN: Gestione dei volti riconosciuti
 @app.route('/admin/faces')
 def admin_faces():
@@ -269,34 +415,35 @@ def admin_face_photos(face_id):
 # ROUTE ADMIN: Cancella tutte le foto
 @app.route('/admin/delete_all_photos', methods=['POST'])
 def delete_all_photos_admin():
-    """Gestisce la cancellazione di tutte le foto da S3 e dal database."""
+    """Avvia in background (o riprende) la cancellazione di tutte le foto da S3, Rekognition e database."""
     if not session.get('logged_in_admin'):
         flash('Unauthorized access', 'danger')
         return redirect(url_for('admin'))
 
     try:
-        all_photo_urls = get_all_photos()
-        
-        objects_to_delete = []
-        for url in all_photo_urls:
-            object_key = url.split('/')[-1]
-            objects_to_delete.append({'Key': object_key})
-
-        if objects_to_delete:
-            s3_client.delete_objects(
-                Bucket=Config.S3_GALLERY_BUCKET,
-                Delete={'Objects': objects_to_delete}
-            )
-            print(f"Deleted {len(objects_to_delete)} objects from S3.")
-        else:
-            print("No objects to delete from S3.")
-
-        delete_all_face_records()
-        
-        flash('All photos deleted from S3 and database!', 'success')
-        return redirect(url_for('admin'))
-    
+        status = start_purge(s3_client, rekognition_client)
     except Exception as e:
         print(f"ERROR deleting all photos: {e}")
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': str(e)}), 500
         flash(f'Error deleting photos: {str(e)}', 'danger')
         return redirect(url_for('admin'))
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(status), 202
+
+    flash('Deleting all photos in the background: progress is shown below.', 'info')
+    return redirect(url_for('admin'))
+
+@app.route('/admin/purge')
+def admin_purge_status():
+    """Restituisce in JSON l'avanzamento della cancellazione di tutte le foto (solo admin)."""
+    if not session.get('logged_in_admin'):
+        return jsonify({'error': 'Unauthorized access'}), 401
+
+    # Una cancellazione rimasta senza processo (es. dopo un riavvio) riprende da qui
+    resume_interrupted_purge(s3_client, rekognition_client)
+    status = get_purge_status()
+    if status is None:
+        return jsonify({'error': 'No purge found'}), 404
+    return jsonify(status)
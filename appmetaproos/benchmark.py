@@ -0,0 +1,618 @@
+# benchmark.py
+#
+# Benchmark offline dell'applicazione senza costi AWS: upload admin
+# (/admin/upload -> upload_photos), ricerca dei selfie (/search), pagina della
+# galleria e helper del database, eseguiti contro S3 e Rekognition finti in
+# processo, con latenza, throttling e numero di volti configurabili.
+# Il database è PostgreSQL locale se indicato con --database-url (i dati del
+# benchmark vengono eliminati alla fine), altrimenti un archivio in memoria.
+# Le immagini sono generate al volo. Throughput, latenze p50/p95/p99 e picco
+# di memoria finiscono in un file JSON, per confrontare esecuzioni diverse.
+#
+#   python benchmark.py --photos 500 --searches 200 --rekognition-tps 50
+#   python benchmark.py --database-url postgresql://localhost/bench --output bench.json
+
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from PIL import Image, ImageDraw
+
+# Bucket e prefisso riconoscibili: le righe scritte su un PostgreSQL reale vengono eliminate alla fine
+BENCH_BUCKET = 'benchmark-bucket'
+BENCH_FACE_PREFIX = 'bench-'
+
+
+# --- Statistiche e report ---
+
+def percentile(ordered, fraction):
+    """Percentile (nearest-rank) di una lista già ordinata."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize(latencies, seconds, errors=0):
+    """Throughput e latenze (in ms) di uno scenario."""
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput_per_second': round(len(ordered) / seconds, 2) if seconds > 0 else None,
+        'latency_ms': {
+            'p50': ms(percentile(ordered, 0.50)),
+            'p95': ms(percentile(ordered, 0.95)),
+            'p99': ms(percentile(ordered, 0.99)),
+            'mean': ms(sum(ordered) / len(ordered)) if ordered else None,
+            'max': ms(ordered[-1]) if ordered else None,
+        },
+    }
+
+
+def operation_summary(snapshot):
+    """Chiamate, errori e durata media per operazione, dalle metriche raccolte durante il benchmark."""
+    operations = {}
+    histogram = snapshot.get('operation_duration_seconds', {'samples': {}})
+    for (component, operation), (counts, total) in histogram['samples'].items():
+        calls = sum(counts)
+        if calls:
+            operations[f"{component}.{operation}"] = {'calls': calls, 'mean_ms': round(total / calls * 1000, 2)}
+    for (component, operation, error_type), count in snapshot.get('errors_total', {'samples': {}})['samples'].items():
+        entry = operations.setdefault(f"{component}.{operation}", {'calls': 0})
+        entry.setdefault('errors', {})[error_type] = int(count)
+    return operations
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo restituisce in KB, macOS in byte
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+# --- Immagini sintetiche ---
+
+def synthetic_photo(rng, width, height, quality=85):
+    """JPEG con sfumatura e forme casuali: ogni immagine è diversa (la deduplicazione non la scarta)."""
+    img = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(img)
+    top = tuple(rng.randrange(256) for _ in range(3))
+    bottom = tuple(rng.randrange(256) for _ in range(3))
+    for y in range(0, height, 4):
+        t = y / height
+        draw.rectangle([0, y, width, y + 4], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+    for _ in range(rng.randint(5, 20)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        size = rng.randint(width // 20, width // 4)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape([x, y, x + size, y + size], fill=tuple(rng.randrange(256) for _ in range(3)))
+    encoded = io.BytesIO()
+    img.save(encoded, 'JPEG', quality=quality)
+    return encoded.getvalue()
+
+
+def synthetic_corpus(count, width, height, seed):
+    rng = random.Random(seed)
+    return [(f"photo_{index:06d}.jpg", synthetic_photo(rng, width, height)) for index in range(count)]
+
+
+# --- Servizi finti ---
+
+def parse_range(value):
+    """'3' -> (3, 3), '0-5' -> (0, 5)."""
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+class Latency:
+    """Latenza log-normale attorno a una mediana (ms), con una parte proporzionale ai byte trasferiti."""
+
+    def __init__(self, median_ms, jitter, per_mb_ms=0.0, seed=0):
+        self.median = median_ms / 1000
+        self.jitter = jitter
+        self.per_mb = per_mb_ms / 1000
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sleep(self, size=0):
+        if self.median <= 0 and self.per_mb <= 0:
+            return
+        with self._lock:
+            factor = self._rng.lognormvariate(0, self.jitter) if self.jitter > 0 else 1.0
+        time.sleep(self.median * factor + self.per_mb * size / (1024 * 1024))
+
+
+class Throttle:
+    """Token bucket: oltre `tps` richieste al secondo risponde come AWS, con un errore di throttling."""
+
+    def __init__(self, tps, code):
+        self.tps = tps
+        self.code = code
+        self.tokens = float(tps)
+        self.updated = time.monotonic()
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def check(self, operation):
+        if self.tps <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.tps, self.tokens + (now - self.updated) * self.tps)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            self.throttled += 1
+        from botocore.exceptions import ClientError
+        raise ClientError({'Error': {'Code': self.code, 'Message': 'Rate exceeded (benchmark)'}}, operation)
+
+
+class FakeS3:
+    """Client S3 in processo: upload_fileobj, delete_objects e generate_presigned_url."""
+
+    def __init__(self, latency, throttle):
+        self.latency = latency
+        self.throttle = throttle
+        self.objects = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        data = fileobj.read()
+        self.throttle.check('PutObject')
+        self.latency.sleep(len(data))
+        with self._lock:
+            self.objects[(bucket, key)] = len(data)
+            self.requests += 1
+
+    def delete_objects(self, Bucket, Delete):
+        self.throttle.check('DeleteObjects')
+        self.latency.sleep()
+        with self._lock:
+            for item in Delete['Objects']:
+                self.objects.pop((Bucket, item['Key']), None)
+            self.requests += 1
+        return {'Deleted': Delete['Objects']}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn=3600):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+
+class FakeRekognition:
+    """Client Rekognition in processo: index_faces crea volti, search_faces_by_image ne restituisce alcuni."""
+
+    def __init__(self, latency, throttle, faces_per_photo, matches_per_search, seed=0):
+        self.latency = latency
+        self.throttle = throttle
+        self.faces_per_photo = faces_per_photo
+        self.matches_per_search = matches_per_search
+        self.face_ids = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def index_faces(self, CollectionId, Image, ExternalImageId=None, DetectionAttributes=None, **kwargs):
+        self.throttle.check('IndexFaces')
+        self.latency.sleep(len(Image['Bytes']))
+        with self._lock:
+            count = self._rng.randint(*self.faces_per_photo)
+            face_ids = [f"{BENCH_FACE_PREFIX}{uuid.uuid4()}" for _ in range(count)]
+            self.face_ids.extend(face_ids)
+        return {'FaceRecords': [{'Face': {'FaceId': face_id, 'ExternalImageId': ExternalImageId}}
+                                for face_id in face_ids]}
+
+    def search_faces_by_image(self, CollectionId, Image, MaxFaces=5, FaceMatchThreshold=80, **kwargs):
+        self.throttle.check('SearchFacesByImage')
+        self.latency.sleep(len(Image['Bytes']))
+        with self._lock:
+            count = min(len(self.face_ids), self._rng.randint(*self.matches_per_search), MaxFaces)
+            matches = self._rng.sample(self.face_ids, count)
+        return {'FaceMatches': [{'Face': {'FaceId': face_id}, 'Similarity': 99.0} for face_id in matches]}
+
+
+class MemoryDatabase:
+    """Stand-in in memoria degli helper di database.py usati da app.py e ingestion.py."""
+
+    def __init__(self, latency):
+        from config import Config
+        self.latency = latency
+        self.default_event = Config.DEFAULT_EVENT
+        self.faces = {}    # face_id -> (id, photo_url, thumb_url, web_url, event_key)
+        self.hashes = {}   # (event_key, content_hash) -> (phash, photo_url, thumb_url, web_url, face_count)
+        self.events = {self.default_event: {'event_key': self.default_event, 'name': Config.DEFAULT_EVENT_NAME,
+                                            'status': 'active', 'created_at': None, 'archived_at': None}}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def init_db(self):
+        pass
+
+    def add_face_records(self, records, event_key=None):
+        self.latency.sleep()
+        with self._lock:
+            for record in records:
+                face_id, photo_url, thumb_url, web_url = tuple(record) + (None,) * (4 - len(record))
+                self.faces[face_id] = (self._next_id, photo_url, thumb_url, web_url, event_key or self.default_event)
+                self._next_id += 1
+        return True
+
+    def delete_face_records(self, face_ids):
+        with self._lock:
+            for face_id in face_ids:
+                self.faces.pop(face_id, None)
+        return True
+
+    def get_photo_renditions_by_face_ids(self, face_ids, event_key=None):
+        self.latency.sleep()
+        event_key = event_key or self.default_event
+        with self._lock:
+            rows = {self.faces[face_id][1:4] for face_id in face_ids
+                    if face_id in self.faces and self.faces[face_id][4] == event_key}
+        return sorted(rows)
+
+    def get_all_photos(self):
+        self.latency.sleep()
+        with self._lock:
+            return [row[1] for row in sorted(self.faces.values(), reverse=True)]
+
+    def get_photos_page(self, before_id=None, limit=50, event_key=None):
+        self.latency.sleep()
+        with self._lock:
+            rows = sorted((row[:4] for row in self.faces.values()
+                           if (before_id is None or row[0] < before_id) and event_key in (None, row[4])),
+                          reverse=True)
+        rows = rows[:limit]
+        return rows, (rows[-1][0] if len(rows) == limit else None)
+
+    def delete_all_face_records(self):
+        self.latency.sleep()
+        with self._lock:
+            self.faces.clear()
+            self.hashes.clear()
+
+    def get_all_unique_face_ids_with_counts(self):
+        self.latency.sleep()
+        with self._lock:
+            return [(face_id, 1) for face_id in sorted(self.faces)]
+
+    def get_photos_by_single_face_id(self, face_id):
+        self.latency.sleep()
+        with self._lock:
+            return [self.faces[face_id][1]] if face_id in self.faces else []
+
+    def find_photo_by_hash(self, content_hash, event_key=None):
+        self.latency.sleep()
+        with self._lock:
+            found = self.hashes.get((event_key or self.default_event, content_hash))
+        return found[1:] if found else None
+
+    def find_photo_by_phash(self, phash, max_distance, event_key=None):
+        self.latency.sleep()
+        event_key = event_key or self.default_event
+        with self._lock:
+            for (stored_event, _), (stored, *row) in self.hashes.items():
+                if stored_event == event_key and stored is not None \
+                        and bin((stored ^ phash) & ((1 << 64) - 1)).count('1') <= max_distance:
+                    return tuple(row)
+        return None
+
+    def add_photo_hash(self, content_hash, phash, photo_url, thumb_url, web_url, face_count, event_key=None):
+        self.latency.sleep()
+        with self._lock:
+            self.hashes.setdefault((event_key or self.default_event, content_hash),
+                                   (phash, photo_url, thumb_url, web_url, face_count))
+        return True
+
+    def get_purge_run(self):
+        return None
+
+    def add_event(self, event_key, name):
+        with self._lock:
+            if event_key in self.events:
+                return False
+            self.events[event_key] = {'event_key': event_key, 'name': name, 'status': 'active',
+                                      'created_at': None, 'archived_at': None}
+            return True
+
+    def get_event(self, event_key):
+        with self._lock:
+            event = self.events.get(event_key)
+            return dict(event) if event else None
+
+    def list_events(self, status=None, face_counts=False):
+        with self._lock:
+            events = [dict(event) for event in self.events.values() if status in (None, event['status'])]
+            if face_counts:
+                for event in events:
+                    event['face_count'] = sum(1 for row in self.faces.values() if row[4] == event['event_key'])
+            return events
+
+    def set_event_status(self, event_key, status):
+        with self._lock:
+            if event_key not in self.events:
+                return False
+            self.events[event_key]['status'] = status
+            return True
+
+    HELPERS = ('init_db', 'get_purge_run', 'add_face_records', 'get_photo_renditions_by_face_ids', 'get_all_photos',
+               'get_photos_page', 'delete_all_face_records', 'get_all_unique_face_ids_with_counts',
+               'get_photos_by_single_face_id', 'find_photo_by_hash', 'find_photo_by_phash', 'add_photo_hash',
+               'add_event', 'get_event', 'list_events', 'set_event_status', 'delete_face_records')
+
+    def install(self, database_module):
+        """Sostituisce gli helper nel modulo database (prima che app e ingestion li importino)."""
+        from metrics import tracked
+        for name in self.HELPERS:
+            setattr(database_module, name, tracked('db', name)(getattr(self, name)))
+
+
+# --- Scenari ---
+
+def bench_upload(app, corpus, batch_size):
+    """Upload admin a lotti di batch_size foto: latenza della richiesta e di ogni file fino all'indicizzazione."""
+    import jobs
+
+    file_latencies = []
+    lock = threading.Lock()
+    process_photo = jobs.process_photo
+
+    def timed_process_photo(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return process_photo(*args, **kwargs)
+        finally:
+            with lock:
+                file_latencies.append(time.perf_counter() - started)
+
+    jobs.process_photo = timed_process_photo
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in_admin'] = True
+
+    request_latencies = []
+    job_ids = []
+    started = time.perf_counter()
+    try:
+        for start in range(0, len(corpus), batch_size):
+            batch = corpus[start:start + batch_size]
+            request_started = time.perf_counter()
+            response = client.post('/admin/upload', data={'photos': [(io.BytesIO(data), name) for name, data in batch]},
+                                   content_type='multipart/form-data', headers={'Accept': 'application/json'})
+            request_latencies.append(time.perf_counter() - request_started)
+            job_ids.append(response.get_json()['job_id'])
+
+        failed = 0
+        for job_id in job_ids:
+            while True:
+                job = jobs.get_job(job_id).to_dict()
+                if job['status'] == 'done':
+                    failed += job['failed']
+                    break
+                time.sleep(0.02)
+        elapsed = time.perf_counter() - started
+    finally:
+        jobs.process_photo = process_photo
+
+    return {
+        'upload_request': summarize(request_latencies, elapsed),
+        'upload_file': summarize(file_latencies, elapsed, errors=failed),
+    }
+
+
+def bench_search(app, selfies, concurrency, gallery_pages):
+    """Ricerche dei selfie in parallelo (una sessione per cliente), poi le pagine della galleria trovata."""
+    search_latencies = []
+    gallery_latencies = []
+    errors = {'search': 0, 'gallery': 0}
+    lock = threading.Lock()
+
+    def run_client(chunk):
+        client = app.test_client()
+        for _, data in chunk:
+            started = time.perf_counter()
+            response = client.post('/search', data={'selfie': (io.BytesIO(data), 'selfie.jpg')},
+                                   content_type='multipart/form-data')
+            elapsed = time.perf_counter() - started
+            body = response.get_json() or {}
+            with lock:
+                search_latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors['search'] += 1
+            if not body.get('gallery_url'):
+                continue
+            for page in range(1, gallery_pages + 1):
+                started = time.perf_counter()
+                response = client.get(f"{body['gallery_url']}?page={page}")
+                with lock:
+                    gallery_latencies.append(time.perf_counter() - started)
+                    if response.status_code != 200:
+                        errors['gallery'] += 1
+
+    chunks = [selfies[index::concurrency] for index in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_client, chunks))
+    elapsed = time.perf_counter() - started
+    return {
+        'search': summarize(search_latencies, elapsed, errors['search']),
+        'gallery_page': summarize(gallery_latencies, elapsed, errors['gallery']),
+    }
+
+
+def bench_database(database_module, faces, queries, seed):
+    """Helper del database su PostgreSQL: scritture a lotti per foto e le letture più frequenti."""
+    rng = random.Random(seed)
+    results = {}
+
+    def run(name, calls):
+        latencies = []
+        started = time.perf_counter()
+        for call in calls:
+            call_started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - call_started)
+        results[f"db.{name}"] = summarize(latencies, time.perf_counter() - started)
+
+    base = f"https://{BENCH_BUCKET}.s3.amazonaws.com/"
+    face_ids = [f"{BENCH_FACE_PREFIX}{uuid.uuid4()}" for _ in range(faces)]
+    photos = [face_ids[start:start + 4] for start in range(0, len(face_ids), 4)]
+    run('add_face_records', [
+        (lambda ids=ids, n=n: database_module.add_face_records(
+            [(face_id, f"{base}db_{n}.jpg", f"{base}db_{n}-400w.webp", f"{base}db_{n}-1600w.webp") for face_id in ids]))
+        for n, ids in enumerate(photos)
+    ])
+    run('get_photo_renditions_by_face_ids', [
+        (lambda: database_module.get_photo_renditions_by_face_ids(rng.sample(face_ids, min(5, len(face_ids)))))
+        for _ in range(queries)
+    ])
+    run('get_photos_page', [(lambda: database_module.get_photos_page(limit=60)) for _ in range(queries)])
+    run('find_photo_by_hash', [(lambda: database_module.find_photo_by_hash(uuid.uuid4().hex * 2)) for _ in range(queries)])
+    run('find_photo_by_phash', [(lambda: database_module.find_photo_by_phash(rng.getrandbits(63), 4))
+                                for _ in range(max(1, queries // 10))])
+    return results
+
+
+def cleanup_database(database_module):
+    """Elimina da PostgreSQL le righe scritte dal benchmark (riconoscibili dal bucket e dal prefisso)."""
+    with database_module.db_cursor() as cur:
+        cur.execute("DELETE FROM faces WHERE face_id LIKE %s OR photo_url LIKE %s;",
+                    (f"{BENCH_FACE_PREFIX}%", f"https://{BENCH_BUCKET}.%"))
+        cur.execute("DELETE FROM photo_hashes WHERE photo_url LIKE %s;", (f"https://{BENCH_BUCKET}.%",))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photos', type=int, default=200, help="foto caricate con /admin/upload")
+    parser.add_argument('--upload-batch', type=int, default=50, help="foto per richiesta di upload")
+    parser.add_argument('--searches', type=int, default=100)
+    parser.add_argument('--search-concurrency', type=int, default=8, help="clienti che cercano in parallelo")
+    parser.add_argument('--gallery-pages', type=int, default=1, help="pagine della galleria aperte dopo ogni ricerca")
+    parser.add_argument('--width', type=int, default=2400)
+    parser.add_argument('--height', type=int, default=1600)
+    parser.add_argument('--selfie-size', type=int, default=800)
+    parser.add_argument('--faces-per-photo', default='0-6', help="volti restituiti da index_faces (N o MIN-MAX)")
+    parser.add_argument('--matches-per-search', default='0-5', help="volti trovati da search_faces_by_image")
+    parser.add_argument('--s3-latency-ms', type=float, default=40)
+    parser.add_argument('--s3-ms-per-mb', type=float, default=20, help="latenza S3 aggiuntiva per MB caricato")
+    parser.add_argument('--rekognition-latency-ms', type=float, default=250)
+    parser.add_argument('--db-latency-ms', type=float, default=2, help="solo per il database in memoria")
+    parser.add_argument('--latency-jitter', type=float, default=0.3, help="sigma della latenza log-normale (0 = fissa)")
+    parser.add_argument('--s3-tps', type=float, default=0, help="richieste S3 al secondo prima del throttling (0 = nessun limite)")
+    parser.add_argument('--rekognition-tps', type=float, default=0, help="come --s3-tps per Rekognition (il limite AWS predefinito è 50)")
+    parser.add_argument('--ingest-workers', type=int, default=None, help="INGEST_MAX_WORKERS (default: quello configurato)")
+    parser.add_argument('--search-cache', default='none', help="SEARCH_CACHE_BACKEND durante il benchmark")
+    parser.add_argument('--database-url', default=None, help="PostgreSQL locale; senza, gli helper del database sono in memoria")
+    parser.add_argument('--db-faces', type=int, default=20000, help="righe scritte dallo scenario del database (solo PostgreSQL)")
+    parser.add_argument('--db-queries', type=int, default=500)
+    parser.add_argument('--tracemalloc', action='store_true', help="misura anche il picco delle allocazioni Python (più lento)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="file JSON dei risultati (default: benchmark-<data>.json)")
+    args = parser.parse_args()
+
+    # La configurazione va impostata prima di importare app.py, che crea client e cache all'import
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    # Credenziali fittizie: la firma locale degli URL della galleria lavora come in produzione
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'BENCHMARK')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark-secret')
+    from config import Config
+    Config.S3_GALLERY_BUCKET = BENCH_BUCKET
+    Config.SEARCH_CACHE_BACKEND = args.search_cache
+    if args.ingest_workers:
+        Config.INGEST_MAX_WORKERS = args.ingest_workers
+
+    import database
+    import metrics
+    if not args.database_url:
+        MemoryDatabase(Latency(args.db_latency_ms, args.latency_jitter, seed=args.seed + 3)).install(database)
+    import app as webapp
+
+    s3 = FakeS3(Latency(args.s3_latency_ms, args.latency_jitter, args.s3_ms_per_mb, seed=args.seed + 1),
+                Throttle(args.s3_tps, 'SlowDown'))
+    rekognition = FakeRekognition(Latency(args.rekognition_latency_ms, args.latency_jitter, seed=args.seed + 2),
+                                  Throttle(args.rekognition_tps, 'ThrottlingException'),
+                                  parse_range(args.faces_per_photo), parse_range(args.matches_per_search), args.seed)
+    webapp.s3_client = s3
+    webapp.rekognition_client = rekognition
+    webapp.url_signer.s3_client = s3
+
+    print(f"Generazione di {args.photos} foto {args.width}x{args.height} e {args.searches} selfie...")
+    corpus = synthetic_corpus(args.photos, args.width, args.height, args.seed)
+    selfies = synthetic_corpus(args.searches, args.selfie_size, args.selfie_size, args.seed + 100)
+    corpus_mb = sum(len(data) for _, data in corpus) / (1024 * 1024)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    metrics.REGISTRY.reset()
+
+    scenarios = {}
+    print("Upload admin...")
+    scenarios.update(bench_upload(webapp.app, corpus, args.upload_batch))
+    print("Ricerche dei selfie...")
+    scenarios.update(bench_search(webapp.app, selfies, args.search_concurrency, args.gallery_pages))
+    skipped = {}
+    if args.database_url:
+        print("Helper del database...")
+        try:
+            scenarios.update(bench_database(database, args.db_faces, args.db_queries, args.seed))
+        finally:
+            cleanup_database(database)
+    else:
+        skipped['database'] = "serve --database-url (con il database in memoria non misura PostgreSQL)"
+
+    report = {
+        'benchmark': 'appmetaproos',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args) | {'database_url': bool(args.database_url)},
+        'corpus': {'photos': len(corpus), 'megabytes': round(corpus_mb, 1), 'selfies': len(selfies)},
+        'scenarios': scenarios,
+        'skipped': skipped,
+        'operations': operation_summary(metrics.REGISTRY.snapshot()),
+        'fakes': {
+            's3_requests': s3.requests, 's3_throttled': s3.throttle.throttled,
+            'rekognition_faces': len(rekognition.face_ids), 'rekognition_throttled': rekognition.throttle.throttled,
+        },
+        'memory': {'peak_rss_mb': peak_rss_mb()},
+    }
+    if args.tracemalloc:
+        report['memory']['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'scenario':<36}{'n':>7}{'err':>6}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in scenarios.items():
+        latency = result['latency_ms']
+        print(f"{name:<36}{result['count']:>7}{result['errors']:>6}{result['throughput_per_second'] or 0:>10.1f}"
+              f"{latency['p50'] or 0:>10.1f}{latency['p95'] or 0:>10.1f}{latency['p99'] or 0:>10.1f}")
+    print(f"Picco di memoria: {report['memory']['peak_rss_mb']} MB. Risultati in {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# cache.py
+#
+# Cache chiave/valore con scadenza (TTL), intercambiabili:
+# - MemoryCache: in-process, con eviction LRU (ogni worker gunicorn ha la sua)
+# - RedisCache: condivisa tra processi e macchine (richiede il pacchetto 'redis')
+# I valori devono essere serializzabili in JSON.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """Cache in memoria thread-safe con TTL ed eviction LRU."""
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # chiave -> (scadenza, valore)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisCache:
+    """Cache su Redis: ogni voce è una stringa JSON con SETEX."""
+
+    def __init__(self, url, namespace, ttl=300):
+        import redis # dipendenza opzionale, necessaria solo con questo backend
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.setex(self._key(key), int(ttl or self.ttl), json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+def create_cache(backend, namespace, max_entries, ttl, redis_url=None):
+    """Crea la cache richiesta dalla configurazione ('memory' o 'redis')."""
+    if backend == 'redis':
+        if not redis_url:
+            raise ValueError("REDIS_URL non è impostato: impossibile usare il backend 'redis'.")
+        return RedisCache(redis_url, namespace, ttl=ttl)
+    if backend == 'memory':
+        return MemoryCache(max_entries=max_entries, ttl=ttl)
+    raise ValueError(f"Backend di cache sconosciuto: {backend}")
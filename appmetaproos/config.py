@@ -22,11 +22,77 @@ class Config:
     TEMP_DIR = os.environ.get('TEMP_DIR', '/tmp')
     # Estensioni di file consentite per l'upload
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    # Numero massimo di foto elaborate in parallelo durante l'upload admin
+    INGEST_MAX_WORKERS = int(os.environ.get('INGEST_MAX_WORKERS', 8))
+    # Oltre questa dimensione (in byte) le foto caricate vengono bufferizzate su disco invece che in memoria
+    SPOOL_MAX_SIZE = int(os.environ.get('SPOOL_MAX_SIZE', 16 * 1024 * 1024))
+    # Per quanti secondi restano consultabili i job di indicizzazione terminati
+    JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 3600))
 
     # Crea la directory temporanea se non esiste (utile per lo sviluppo locale)
     if not os.path.exists(TEMP_DIR):
         os.makedirs(TEMP_DIR)
 
+    # Limiti delle immagini inviate a Rekognition (Image.Bytes accetta al massimo 5 MB)
+    REKOGNITION_MAX_BYTES = int(os.environ.get('REKOGNITION_MAX_BYTES', 5 * 1024 * 1024))
+    # Lato massimo delle immagini ricodificate per Rekognition
+    REKOGNITION_MAX_DIMENSION = int(os.environ.get('REKOGNITION_MAX_DIMENSION', 1920))
+
+    # Versioni ridotte generate all'upload (nome -> larghezza in pixel) e qualità di codifica
+    DERIVATIVE_WIDTHS = {
+        'thumb': int(os.environ.get('THUMB_WIDTH', 400)),
+        'web': int(os.environ.get('WEB_WIDTH', 1600)),
+    }
+    DERIVATIVE_QUALITY = int(os.environ.get('DERIVATIVE_QUALITY', 80))
+
+    # Eventi (album): ogni evento ha la propria collection Rekognition e /search cerca in un solo evento.
+    # L'evento predefinito usa REKOGNITION_COLLECTION_ID e raccoglie le foto caricate senza evento.
+    DEFAULT_EVENT = os.environ.get('DEFAULT_EVENT', 'default')
+    DEFAULT_EVENT_NAME = os.environ.get('DEFAULT_EVENT_NAME', 'All photos')
+    # Archiviando un evento si elimina anche la sua collection Rekognition (le foto restano su S3 e nel database)
+    ARCHIVE_DELETES_COLLECTION = os.environ.get('ARCHIVE_DELETES_COLLECTION', 'false').lower() in ('1', 'true', 'yes')
+
+    # Deduplicazione all'upload: 'sha256' (file identici), 'phash' (anche foto ricodificate
+    # o ridimensionate, con dHash a 64 bit) oppure 'off'. Con 'phash' scatti a raffica quasi
+    # identici possono risultare duplicati: tenere DEDUP_PHASH_MAX_DISTANCE basso.
+    DEDUP_MODE = os.environ.get('DEDUP_MODE', 'sha256')
+    DEDUP_PHASH_MAX_DISTANCE = int(os.environ.get('DEDUP_PHASH_MAX_DISTANCE', 4))
+
+    # Eliminazione di tutte le foto (purge.py): volti per lotto (ogni lotto salva l'avanzamento),
+    # chiamate S3/Rekognition in parallelo e secondi dopo i quali un'eliminazione
+    # non aggiornata dal suo processo può essere ripresa da un altro
+    PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 4000))
+    PURGE_CONCURRENCY = int(os.environ.get('PURGE_CONCURRENCY', 8))
+    PURGE_LEASE_SECONDS = int(os.environ.get('PURGE_LEASE_SECONDS', 300))
+
+    # Foto per pagina nella vista admin di tutte le foto
+    PHOTOS_PAGE_SIZE = int(os.environ.get('PHOTOS_PAGE_SIZE', 60))
+
+    # URL pre-firmati della galleria: validi almeno PRESIGN_TTL secondi e identici
+    # per tutta una finestra di PRESIGN_BUCKET_SECONDS (così browser e CDN li mettono in cache)
+    PRESIGN_TTL = int(os.environ.get('PRESIGN_TTL', 3600))
+    PRESIGN_BUCKET_SECONDS = int(os.environ.get('PRESIGN_BUCKET_SECONDS', 900))
+
+    # Redis (opzionale): usato dalle cache quando il backend è 'redis'
+    REDIS_URL = os.environ.get('REDIS_URL')
+
+    # Cache dei risultati di ricerca dei selfie: 'memory', 'redis' oppure 'none'
+    SEARCH_CACHE_BACKEND = os.environ.get('SEARCH_CACHE_BACKEND', 'memory')
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 600))
+    # Numero massimo di sessioni tenute in memoria (solo backend 'memory')
+    SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 4096))
+    # Bit diversi (su 256) entro cui due selfie della stessa sessione sono considerati uguali
+    SEARCH_CACHE_MAX_DISTANCE = int(os.environ.get('SEARCH_CACHE_MAX_DISTANCE', 12))
+
+    # Gallerie dei clienti salvate sul server dopo /search: 'memory' o 'redis'
+    GALLERY_STORE_BACKEND = os.environ.get('GALLERY_STORE_BACKEND', 'memory')
+    GALLERY_TTL = int(os.environ.get('GALLERY_TTL', 24 * 3600))
+    GALLERY_STORE_MAX_ENTRIES = int(os.environ.get('GALLERY_STORE_MAX_ENTRIES', 10000))
+    GALLERY_PAGE_SIZE = int(os.environ.get('GALLERY_PAGE_SIZE', 48))
+
+    # Metriche Prometheus su /metrics: se impostato, serve 'Authorization: Bearer <token>'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
     # Admin Password
     # Legge la password admin dalle variabili d'ambiente.
     # Il valore di fallback 'admin' è SOLO per lo sviluppo locale, CAMBIALO IN UNA PASSWORD FORTE!
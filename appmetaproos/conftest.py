@@ -0,0 +1,54 @@
+# conftest.py
+#
+# Test dell'applicazione, da lanciare da questa cartella (python -m pytest).
+# Niente AWS né PostgreSQL: S3 e Rekognition sono oggetti finti e le query
+# passano da un cursore finto che le registra.
+
+from contextlib import contextmanager
+
+import pytest
+
+import database
+
+
+class FakeCursor:
+    """Registra le query eseguite e restituisce le righe preparate dal test."""
+
+    def __init__(self):
+        self.queries = []
+        self.rows = []
+        self.description = []
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+@pytest.fixture
+def fake_cursor(monkeypatch):
+    cursor = FakeCursor()
+
+    @contextmanager
+    def db_cursor():
+        yield cursor
+
+    monkeypatch.setattr(database, 'db_cursor', db_cursor)
+    return cursor
+
+
+@pytest.fixture
+def s3_client():
+    from benchmark import FakeS3, Latency, Throttle
+    return FakeS3(Latency(0, 0), Throttle(0, 'SlowDown'))
+
+
+@pytest.fixture
+def rekognition_client():
+    from benchmark import FakeRekognition, Latency, Throttle
+    return FakeRekognition(Latency(0, 0), Throttle(0, 'ThrottlingException'), (1, 1), (0, 0))
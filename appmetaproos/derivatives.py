@@ -0,0 +1,79 @@
+# derivatives.py
+#
+# Versioni ridotte delle foto generate all'upload: una miniatura per le griglie
+# e una versione per lo schermo. Vengono salvate su S3 accanto all'originale,
+# con chiavi prevedibili ricavate dalla chiave dell'originale:
+#   <uuid>.jpg -> derivatives/<uuid>-400.webp, derivatives/<uuid>-1600.webp
+
+import io
+import os
+
+from PIL import Image, features
+
+from config import Config
+from metrics import track, tracked
+
+DERIVATIVES_PREFIX = 'derivatives/'
+
+# WebP se Pillow è compilato con il supporto, altrimenti JPEG
+if features.check('webp'):
+    DERIVATIVE_FORMAT, DERIVATIVE_EXTENSION, DERIVATIVE_CONTENT_TYPE = 'WEBP', '.webp', 'image/webp'
+else:
+    DERIVATIVE_FORMAT, DERIVATIVE_EXTENSION, DERIVATIVE_CONTENT_TYPE = 'JPEG', '.jpg', 'image/jpeg'
+
+
+def derivative_key(original_key, width):
+    """Chiave S3 della versione larga `width` pixel di un originale."""
+    stem = os.path.splitext(original_key)[0]
+    return f"{DERIVATIVES_PREFIX}{stem}-{width}{DERIVATIVE_EXTENSION}"
+
+
+def derivative_keys(original_key):
+    """Chiavi S3 di tutte le versioni ridotte di un originale."""
+    return [derivative_key(original_key, width) for width in Config.DERIVATIVE_WIDTHS.values()]
+
+
+@tracked('image')
+def render_derivatives(image):
+    """
+    Produce tutte le versioni configurate da un'immagine già decodificata
+    (RGB, orientata, vedi normalizer.decode_image).
+    Restituisce {nome: (larghezza, byte codificati)}, es. {'thumb': (400, b'...')}.
+    """
+    widths = sorted(Config.DERIVATIVE_WIDTHS.items(), key=lambda item: item[1], reverse=True)
+
+    renditions = {}
+    # Si parte dalla versione più grande e ogni successiva viene ridotta dalla precedente
+    current = image
+    for name, width in widths:
+        if current.width > width:
+            height = max(1, round(current.height * width / current.width))
+            current = current.resize((width, height), Image.LANCZOS)
+        encoded = io.BytesIO()
+        current.save(encoded, DERIVATIVE_FORMAT, quality=Config.DERIVATIVE_QUALITY)
+        renditions[name] = (width, encoded.getvalue())
+    return renditions
+
+
+def upload_derivatives(image, original_key, s3_client):
+    """
+    Genera e carica su S3 le versioni ridotte di una foto già decodificata.
+    Restituisce {nome: URL pubblico} (es. {'thumb': ..., 'web': ...}).
+    """
+    urls = {}
+    for name, (width, data) in render_derivatives(image).items():
+        key = derivative_key(original_key, width)
+        with track('s3', 'upload_derivative'):
+            s3_client.upload_fileobj(
+                io.BytesIO(data),
+                Config.S3_GALLERY_BUCKET,
+                key,
+                ExtraArgs={
+                    'ACL': 'public-read',
+                    'ContentType': DERIVATIVE_CONTENT_TYPE,
+                    # Le chiavi contengono un UUID e non cambiano mai: il browser può tenerle in cache a lungo
+                    'CacheControl': 'public, max-age=31536000, immutable',
+                }
+            )
+        urls[name] = f"https://{Config.S3_GALLERY_BUCKET}.s3.{Config.AWS_REGION}.amazonaws.com/{key}"
+    return urls
@@ -0,0 +1,113 @@
+# events.py
+#
+# Eventi (album) delle foto. Ogni evento ha la propria collection Rekognition,
+# così /search confronta il selfie solo con i volti di quell'evento e il costo
+# della ricerca non cresce con lo storico. Nel database le righe di faces e
+# photo_hashes portano la chiave dell'evento (indici su (event_key, ...)).
+# Un evento archiviato esce dall'indice "caldo": non accetta upload né ricerche
+# e, con ARCHIVE_DELETES_COLLECTION, la sua collection viene eliminata;
+# le foto restano su S3 e nel database (vista admin).
+
+import re
+
+import psycopg2
+from botocore.exceptions import ClientError
+
+from config import Config
+from database import add_event, get_event, list_events, set_event_status
+from metrics import track
+
+# Chiavi brevi e sicure nei nomi delle collection (che ammettono [a-zA-Z0-9_.-], max 255)
+EVENT_KEY_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+
+
+class EventError(Exception):
+    """Evento non valido, inesistente o archiviato; `status` è il codice HTTP da restituire."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def collection_id(event_key):
+    """Collection Rekognition dell'evento: quella configurata per l'evento predefinito."""
+    if not event_key or event_key == Config.DEFAULT_EVENT:
+        return Config.REKOGNITION_COLLECTION_ID
+    return f"{Config.REKOGNITION_COLLECTION_ID}-{event_key}"
+
+
+def _error_code(error):
+    return error.response.get('Error', {}).get('Code') if isinstance(error, ClientError) else None
+
+
+def create_event(event_key, name, rekognition_client):
+    """
+    Crea l'evento e la sua collection Rekognition (una collection già esistente
+    viene riusata). Restituisce il dizionario dell'evento.
+    """
+    event_key = (event_key or '').strip().lower()
+    if not EVENT_KEY_PATTERN.match(event_key):
+        raise EventError("Event key must be 1-63 lowercase letters, digits, '-' or '_'")
+
+    try:
+        with track('rekognition', 'create_collection'):
+            rekognition_client.create_collection(CollectionId=collection_id(event_key))
+    except ClientError as e:
+        if _error_code(e) != 'ResourceAlreadyExistsException':
+            raise
+
+    created = add_event(event_key, (name or '').strip() or event_key)
+    if created is None:
+        raise RuntimeError(f"Unable to save event {event_key} in the database")
+    if not created:
+        raise EventError(f"Event {event_key} already exists", status=409)
+    return get_event(event_key)
+
+
+def resolve_event(event_key):
+    """
+    Chiave dell'evento attivo richiesto (quello predefinito se vuota).
+    Solleva EventError (404) se non esiste, (410) se è archiviato e (503) se il
+    database non risponde.
+    """
+    event_key = (event_key or '').strip().lower() or Config.DEFAULT_EVENT
+    try:
+        event = get_event(event_key)
+    except psycopg2.Error as e:
+        print(f"Error getting event {event_key}: {e}")
+        raise EventError("Events are temporarily unavailable, please try again later", status=503)
+    if event is None:
+        raise EventError(f"Event {event_key} not found", status=404)
+    if event['status'] != 'active':
+        raise EventError(f"Event {event_key} has been archived", status=410)
+    return event_key
+
+
+def archive_event(event_key, rekognition_client):
+    """
+    Toglie l'evento dall'indice caldo: niente più upload né ricerche e, con
+    ARCHIVE_DELETES_COLLECTION, collection Rekognition eliminata.
+    L'evento predefinito non si può archiviare.
+    """
+    if event_key == Config.DEFAULT_EVENT:
+        raise EventError("The default event cannot be archived")
+    if get_event(event_key) is None:
+        raise EventError(f"Event {event_key} not found", status=404)
+
+    if Config.ARCHIVE_DELETES_COLLECTION:
+        try:
+            with track('rekognition', 'delete_collection'):
+                rekognition_client.delete_collection(CollectionId=collection_id(event_key))
+        except ClientError as e:
+            if _error_code(e) != 'ResourceNotFoundException':
+                raise
+
+    if not set_event_status(event_key, 'archived'):
+        raise RuntimeError(f"Unable to archive event {event_key} in the database")
+    print(f"EVENT {event_key}: archived")
+    return get_event(event_key)
+
+
+def active_events():
+    """Eventi attivi (per i form di upload e di ricerca), senza il conteggio dei volti."""
+    return list_events(status='active')
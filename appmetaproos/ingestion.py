@@ -0,0 +1,220 @@
+# ingestion.py
+#
+# Elaborazione di una singola foto caricata dall'admin: upload su S3,
+# indicizzazione con Rekognition e scrittura dei volti nel database.
+# Le foto già caricate (stesso SHA-256 o, in modalità 'phash', stesso hash
+# percettivo) non vengono ricaricate né reindicizzate: si usa la foto esistente.
+# Ogni foto appartiene a un evento: viene indicizzata nella collection dell'evento
+# e i duplicati si cercano solo tra le foto dello stesso evento.
+# L'orchestrazione in background (pool di thread e avanzamento) è in jobs.py.
+
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import uuid
+
+from werkzeug.utils import secure_filename
+
+from config import Config
+from database import add_face_records, add_photo_hash, delete_face_records, find_photo_by_hash, find_photo_by_phash
+from derivatives import derivative_keys, upload_derivatives
+from events import collection_id
+from metrics import track
+from normalizer import decode_image, encode_within_budget, fits_rekognition
+from search_cache import perceptual_hash
+
+# Dimensione dei blocchi usati per copiare lo stream dell'upload nel buffer
+SPOOL_CHUNK_SIZE = 1024 * 1024
+# Lato della griglia del dHash per la deduplicazione: 8 -> 64 bit (una colonna BIGINT)
+DEDUP_PHASH_SIZE = 8
+
+# Lock per hash: due copie dello stesso file nello stesso lotto vengono elaborate
+# una dopo l'altra, così la seconda trova la prima nel database
+_hash_locks = [threading.Lock() for _ in range(256)]
+
+
+def allowed_file(filename):
+    """Controlla se l'estensione del file è consentita."""
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
+
+
+def spool_upload(photo, in_memory=True):
+    """
+    Legge lo stream del file caricato UNA sola volta in un buffer, calcolandone
+    intanto lo SHA-256. Il buffer resta in memoria e viene scritto su disco
+    (in TEMP_DIR) solo se supera Config.SPOOL_MAX_SIZE; con in_memory=False
+    viene scritto subito su disco.
+    Restituisce (buffer, dimensione in byte, SHA-256 esadecimale).
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=Config.SPOOL_MAX_SIZE, dir=Config.TEMP_DIR)
+    if not in_memory:
+        buffer.rollover()
+    digest = hashlib.sha256()
+    try:
+        while True:
+            chunk = photo.stream.read(SPOOL_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            buffer.write(chunk)
+    except Exception:
+        buffer.close()
+        raise
+    size = buffer.tell()
+    buffer.seek(0)
+    return buffer, size, digest.hexdigest()
+
+
+def new_object_key(filename):
+    """Genera una chiave S3 univoca mantenendo l'estensione del file originale."""
+    return str(uuid.uuid4()) + os.path.splitext(secure_filename(filename))[1]
+
+
+def _signed_int64(value):
+    """Intero senza segno a 64 bit -> valore con segno per una colonna BIGINT."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def find_duplicate(buffer, content_hash, event_key=None):
+    """
+    Cerca una foto già caricata nell'evento uguale a questa: per SHA-256 e, in modalità
+    'phash', anche per hash percettivo. Restituisce (riga trovata o None, phash o None);
+    il phash calcolato serve poi a registrare la foto se non è un duplicato.
+    """
+    existing = find_photo_by_hash(content_hash, event_key)
+    if existing is not None or Config.DEDUP_MODE != 'phash':
+        return existing, None
+
+    buffer.seek(0)
+    phash = _signed_int64(perceptual_hash(buffer, hash_size=DEDUP_PHASH_SIZE))
+    buffer.seek(0)
+    return find_photo_by_phash(phash, Config.DEDUP_PHASH_MAX_DISTANCE, event_key), phash
+
+
+def process_photo(unique_filename, buffer, size, s3_client, rekognition_client, content_hash=None,
+                  event_key=None):
+    """
+    Elabora UNA foto già bufferizzata dell'evento `event_key` (predefinito se None).
+    Se è un duplicato di una foto già caricata nell'evento restituisce quella,
+    senza upload né indicizzazione; altrimenti la indicizza e ne registra l'impronta.
+    """
+    if content_hash is None or Config.DEDUP_MODE == 'off':
+        return index_photo(unique_filename, buffer, size, s3_client, rekognition_client, event_key)
+
+    with _hash_locks[int(content_hash[:8], 16) % len(_hash_locks)]:
+        duplicate, phash = find_duplicate(buffer, content_hash, event_key)
+        if duplicate is not None:
+            photo_url, thumb_url, web_url, face_count = duplicate
+            print(f"DUPLICATE {unique_filename}: same photo as {photo_url}, skipping upload and indexing")
+            return {'url': photo_url, 'thumb_url': thumb_url, 'web_url': web_url, 'faces': face_count,
+                    'duplicate_of': photo_url, 'timings': {}}
+
+        return index_photo(unique_filename, buffer, size, s3_client, rekognition_client, event_key,
+                           photo_hash=(content_hash, phash))
+
+
+def discard_indexed_photo(unique_filename, face_ids, s3_client, rekognition_client, event_key=None):
+    """
+    Annulla l'indicizzazione di una foto che Rekognition non ha indicizzato o che
+    non è stato possibile salvare nel database: toglie i volti dalla collection ed
+    elimina gli oggetti S3, così non restano volti ricercabili né file senza
+    record. Gli errori vengono solo registrati.
+    """
+    if face_ids:
+        try:
+            with track('rekognition', 'delete_faces'):
+                rekognition_client.delete_faces(CollectionId=collection_id(event_key), FaceIds=face_ids)
+        except Exception as e:
+            print(f"Error removing faces of {unique_filename} from the collection: {e}")
+    try:
+        with track('s3', 'delete_objects'):
+            s3_client.delete_objects(
+                Bucket=Config.S3_GALLERY_BUCKET,
+                Delete={'Objects': [{'Key': key} for key in [unique_filename, *derivative_keys(unique_filename)]],
+                        'Quiet': True}
+            )
+    except Exception as e:
+        print(f"Error deleting S3 objects of {unique_filename}: {e}")
+
+
+def index_photo(unique_filename, buffer, size, s3_client, rekognition_client, event_key=None, photo_hash=None):
+    """
+    Carica su S3, indicizza (nella collection dell'evento) e salva nel database i volti di UNA foto già bufferizzata.
+    Con photo_hash=(content_hash, phash) registra anche l'impronta della foto.
+    Se Rekognition fallisce o il database non salva i record, gli oggetti già caricati
+    su S3 (e gli eventuali volti indicizzati) vengono eliminati e l'errore viene sollevato.
+    """
+    # Decodifica UNA volta la foto (ridotta, orientata): serve sia alle versioni ridotte
+    # sia, se l'originale non rientra nei limiti di Rekognition, alla ricodifica
+    decode_dimension = max(Config.REKOGNITION_MAX_DIMENSION, *Config.DERIVATIVE_WIDTHS.values())
+    image, decode_ms = decode_image(buffer, decode_dimension)
+    timings = {'decode_ms': round(decode_ms, 1)}
+
+    # Byte da inviare a Rekognition: l'originale se è già un JPEG/PNG sotto i 5 MB
+    if fits_rekognition(buffer):
+        buffer.seek(0)
+        rekognition_bytes = buffer.read()
+    else:
+        rekognition_bytes, encode_stats = encode_within_budget(image)
+        timings.update(encode_stats)
+        print(f"NORMALIZED {unique_filename}: {size} -> {encode_stats['output_bytes']} bytes, "
+              f"decode {timings['decode_ms']}ms, encode {encode_stats['encode_ms']}ms, "
+              f"{encode_stats['attempts']} attempt(s)")
+
+    # Indovina il tipo di file dall'originale
+    content_type, _ = mimetypes.guess_type(unique_filename)
+    if content_type is None:
+        content_type = 'application/octet-stream'
+
+    # Carica la FOTO ORIGINALE di alta qualità su S3 direttamente dal buffer
+    buffer.seek(0)
+    with track('s3', 'upload'):
+        s3_client.upload_fileobj(
+            buffer,
+            Config.S3_GALLERY_BUCKET,
+            unique_filename,
+            ExtraArgs={'ACL': 'public-read', 'ContentType': content_type}
+        )
+
+    s3_url = f"https://{Config.S3_GALLERY_BUCKET}.s3.{Config.AWS_REGION}.amazonaws.com/{unique_filename}"
+
+    # Versioni ridotte per gallerie e griglie: se falliscono la foto viene comunque indicizzata
+    renditions = {}
+    try:
+        renditions = upload_derivatives(image, unique_filename, s3_client)
+    except Exception as e:
+        print(f"Error generating derivatives for {unique_filename}: {e}")
+
+    # Invia l'IMMAGINE OTTIMIZZATA a Rekognition per l'analisi
+    try:
+        with track('rekognition', 'index_faces'):
+            response = rekognition_client.index_faces(
+                CollectionId=collection_id(event_key),
+                Image={'Bytes': rekognition_bytes},
+                ExternalImageId=unique_filename,
+                DetectionAttributes=['ALL']
+            )
+    except Exception:
+        # Throttling, immagine non valida, ...: originale e versioni ridotte non restano orfani su S3
+        discard_indexed_photo(unique_filename, [], s3_client, rekognition_client, event_key)
+        raise
+
+    # Salva i record nel database
+    face_ids = [face_record['Face']['FaceId'] for face_record in response['FaceRecords']]
+    saved = add_face_records([(face_id, s3_url, renditions.get('thumb'), renditions.get('web')) for face_id in face_ids],
+                             event_key)
+    if saved and photo_hash is not None:
+        content_hash, phash = photo_hash
+        saved = add_photo_hash(content_hash, phash, s3_url, renditions.get('thumb'), renditions.get('web'),
+                               len(face_ids), event_key)
+        if not saved:
+            delete_face_records(face_ids)
+    if not saved:
+        discard_indexed_photo(unique_filename, face_ids, s3_client, rekognition_client, event_key)
+        raise RuntimeError(f"Unable to save {unique_filename} in the database: upload and indexing rolled back")
+
+    return {'url': s3_url, 'thumb_url': renditions.get('thumb'), 'web_url': renditions.get('web'),
+            'faces': len(face_ids), 'timings': timings}
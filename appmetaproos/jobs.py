@@ -0,0 +1,193 @@
+# jobs.py
+#
+# Job di indicizzazione in background per l'upload admin.
+# La richiesta HTTP bufferizza i file e crea un job; l'elaborazione (S3,
+# Rekognition, database) avviene in un pool di thread condiviso dal processo.
+# Lo stato dei job vive in memoria: con gunicorn è visibile solo al worker
+# che ha accettato l'upload (il Procfile ne avvia uno solo).
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from ingestion import allowed_file, new_object_key, process_photo, spool_upload
+from metrics import Counter, Gauge, Histogram, count_error
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+# Buffer in memoria dei file accodati o in elaborazione: al massimo INGEST_MAX_WORKERS,
+# gli altri file vengono bufferizzati su disco finché il pool non li elabora
+_memory_buffers = 0
+_memory_lock = threading.Lock()
+
+FILES = Counter('ingest_files_total', "File degli upload admin per esito (done, duplicate, failed)", ['status'])
+PENDING = Gauge('ingest_files_pending', "File accodati nel pool di indicizzazione e non ancora completati")
+FILE_SECONDS = Histogram('ingest_file_duration_seconds', "Elaborazione di un file (S3, Rekognition, database)")
+
+
+def _get_executor():
+    """Crea (una sola volta per processo) il pool di thread che elabora i file."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.INGEST_MAX_WORKERS,
+                                           thread_name_prefix='ingest')
+        return _executor
+
+
+def _reserve_memory_buffer():
+    """True se il prossimo file può restare in memoria (e occupa un posto), False se va su disco."""
+    global _memory_buffers
+    with _memory_lock:
+        if _memory_buffers >= Config.INGEST_MAX_WORKERS:
+            return False
+        _memory_buffers += 1
+        return True
+
+
+def _release_memory_buffer():
+    global _memory_buffers
+    with _memory_lock:
+        _memory_buffers -= 1
+
+
+class IndexingJob:
+    """Stato di un upload admin: un elemento per file con esito e tempi."""
+
+    def __init__(self, event_key=None):
+        self.id = uuid.uuid4().hex
+        self.event_key = event_key or Config.DEFAULT_EVENT
+        self.created_at = time.time()
+        self.finished_at = None
+        self.files = []
+        self._lock = threading.Lock()
+
+    def add_file(self, filename, size=0, status='queued', error=None):
+        entry = {'filename': filename, 'size': size, 'status': status,
+                 'faces': 0, 'url': None, 'error': error}
+        self.files.append(entry)
+        return entry
+
+    def update(self, entry, **changes):
+        with self._lock:
+            entry.update(changes)
+            if all(item['status'] in ('done', 'failed') for item in self.files):
+                self.finished_at = time.time()
+
+    def to_dict(self):
+        """Riepilogo serializzabile in JSON con avanzamento e throughput."""
+        with self._lock:
+            files = [dict(entry) for entry in self.files]
+            finished_at = self.finished_at
+
+        completed = [entry for entry in files if entry['status'] in ('done', 'failed')]
+        succeeded = [entry for entry in completed if entry['status'] == 'done']
+        elapsed = (finished_at or time.time()) - self.created_at
+        processed_bytes = sum(entry['size'] for entry in succeeded)
+
+        if finished_at:
+            status = 'done'
+        elif any(entry['status'] != 'queued' for entry in files):
+            status = 'running'
+        else:
+            status = 'queued'
+
+        return {
+            'job_id': self.id,
+            'status': status,
+            'event': self.event_key,
+            'total': len(files),
+            'completed': len(completed),
+            'succeeded': len(succeeded),
+            'failed': len(completed) - len(succeeded),
+            'faces': sum(entry['faces'] for entry in succeeded if not entry.get('duplicate_of')),
+            # Foto già presenti: collegate all'originale senza nuovo upload né indicizzazione
+            'duplicates': sum(1 for entry in succeeded if entry.get('duplicate_of')),
+            'elapsed_seconds': round(elapsed, 2),
+            'files_per_second': round(len(completed) / elapsed, 2) if elapsed > 0 else 0.0,
+            'bytes_per_second': round(processed_bytes / elapsed) if elapsed > 0 else 0,
+            'files': files,
+        }
+
+
+def _run_file(job, entry, unique_filename, buffer, size, content_hash, in_memory, s3_client, rekognition_client):
+    """Elabora un file del job nel pool e ne registra l'esito."""
+    job.update(entry, status='processing')
+    started = time.perf_counter()
+    try:
+        outcome = process_photo(unique_filename, buffer, size, s3_client, rekognition_client, content_hash,
+                                job.event_key)
+        job.update(entry, status='done', **outcome)
+        FILES.labels(status='duplicate' if outcome.get('duplicate_of') else 'done').inc()
+    except Exception as e:
+        print(f"ADMIN UPLOAD ERROR ({entry['filename']}): {e}")
+        job.update(entry, status='failed', error=str(e))
+        FILES.labels(status='failed').inc()
+        count_error('ingest', 'process_photo', e)
+    finally:
+        buffer.close()
+        if in_memory:
+            _release_memory_buffer()
+        FILE_SECONDS.observe(time.perf_counter() - started)
+        PENDING.dec()
+
+
+def _purge_expired_jobs():
+    """Dimentica i job terminati da più di JOB_RETENTION_SECONDS."""
+    cutoff = time.time() - Config.JOB_RETENTION_SECONDS
+    with _jobs_lock:
+        for job_id in [job_id for job_id, job in _jobs.items()
+                       if job.finished_at and job.finished_at < cutoff]:
+            del _jobs[job_id]
+
+
+def submit_indexing_job(photos, s3_client, rekognition_client, event_key=None):
+    """
+    Bufferizza i file della richiesta e li accoda nel pool in background,
+    per l'evento `event_key` (quello predefinito se None).
+    Va chiamata nel thread della richiesta: gli stream di Flask vengono chiusi
+    a fine richiesta. Restituisce subito l'IndexingJob creato.
+    """
+    _purge_expired_jobs()
+    job = IndexingJob(event_key)
+    queued = []
+
+    for photo in photos:
+        if not photo or not allowed_file(photo.filename):
+            job.add_file(getattr(photo, 'filename', ''), status='failed', error='File type not allowed')
+            continue
+        # Memoria limitata anche con centinaia di file: oltre INGEST_MAX_WORKERS buffer si scrive su disco
+        in_memory = _reserve_memory_buffer()
+        try:
+            buffer, size, content_hash = spool_upload(photo, in_memory)
+        except Exception as e:
+            if in_memory:
+                _release_memory_buffer()
+            print(f"ADMIN UPLOAD ERROR ({photo.filename}): {e}")
+            job.add_file(photo.filename, status='failed', error=str(e))
+            continue
+        entry = job.add_file(photo.filename, size=size)
+        queued.append((entry, new_object_key(photo.filename), buffer, size, content_hash, in_memory))
+
+    if not queued:
+        job.finished_at = time.time()
+
+    with _jobs_lock:
+        _jobs[job.id] = job
+
+    executor = _get_executor()
+    PENDING.inc(len(queued))
+    for entry, unique_filename, buffer, size, content_hash, in_memory in queued:
+        executor.submit(_run_file, job, entry, unique_filename, buffer, size, content_hash, in_memory,
+                        s3_client, rekognition_client)
+    return job
+
+
+def get_job(job_id):
+    """Restituisce l'IndexingJob con questo id, oppure None."""
+    with _jobs_lock:
+        return _jobs.get(job_id)
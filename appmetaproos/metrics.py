@@ -0,0 +1,346 @@
+# metrics.py
+#
+# Metriche in formato testo Prometheus, senza dipendenze esterne: contatori,
+# gauge e istogrammi con etichette. Sul percorso caldo una misura costa una
+# ricerca in un dizionario, una ricerca binaria nei bucket e un lock non conteso
+# (pochi microsecondi, contro i millisecondi delle operazioni misurate).
+#
+# Le metriche sono per processo: con più worker gunicorn ogni lettura di
+# /metrics mostra quelle del worker che risponde (il Procfile ne avvia uno solo).
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket (in secondi) adatti sia alle query PostgreSQL sia alle chiamate a S3 e Rekognition
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Value:
+    """Valore di un contatore o di un gauge per una combinazione di etichette."""
+
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self._value = float(value)
+
+    def get(self):
+        return self._value
+
+    def reset(self):
+        self._value = 0.0
+
+
+class _Buckets:
+    """Conteggi di un istogramma per una combinazione di etichette."""
+
+    __slots__ = ('_upper_bounds', '_counts', '_sum', '_lock')
+
+    def __init__(self, upper_bounds):
+        self._upper_bounds = upper_bounds
+        self._counts = [0] * (len(upper_bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # Il bucket 'le' è il primo limite >= valore; l'ultimo conteggio è +Inf
+        index = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def get(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * len(self._counts)
+            self._sum = 0.0
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, **labels):
+        """Serie per i valori di etichetta indicati (da ottenere una volta e riusare sui percorsi caldi)."""
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: etichette attese {self.labelnames}, ricevute {tuple(labels)}")
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self):
+        return {key: child.get() for key, child in list(self._children.items())}
+
+    def reset(self):
+        """Azzera i valori mantenendo le serie (e i riferimenti già ottenuti con labels())."""
+        for child in list(self._children.values()):
+            child.reset()
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self._function = None
+        super().__init__(name, documentation, labelnames, registry)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set_function(self, function):
+        """
+        Valore calcolato a ogni lettura delle metriche: un numero, oppure (con
+        etichette) un dizionario {valore o tupla di valori delle etichette: numero}.
+        """
+        self._function = function
+
+    def _samples(self):
+        if self._function is None:
+            return super()._samples()
+        value = self._function()
+        if not isinstance(value, dict):
+            return {(): float(value)}
+        return {(key if isinstance(key, tuple) else (key,)): float(number) for key, number in value.items()}
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metrica già registrata: {metric.name}")
+            self._metrics[metric.name] = metric
+
+    def snapshot(self):
+        """Stato di tutte le metriche come dizionario semplice."""
+        snapshot = {}
+        for metric in list(self._metrics.values()):
+            try:
+                samples = metric._samples()
+            except Exception as e:
+                # Un gauge calcolato che fallisce (es. Redis irraggiungibile) non deve bloccare le altre metriche
+                ERRORS.labels(component='metrics', operation=metric.name, type=type(e).__name__).inc()
+                continue
+            snapshot[metric.name] = {
+                'kind': metric.kind,
+                'help': metric.documentation,
+                'labelnames': metric.labelnames,
+                'buckets': getattr(metric, 'buckets', None),
+                'samples': samples,
+            }
+        return snapshot
+
+    def reset(self):
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def render(self):
+        return render(self.snapshot())
+
+
+REGISTRY = Registry()
+
+
+def merge_snapshots(snapshots):
+    """Somma più snapshot (es. di più processi): contatori, gauge e istogrammi si sommano."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, 'samples': {}})
+            for key, value in metric['samples'].items():
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = value
+                elif metric['kind'] == 'histogram':
+                    counts, total = value
+                    target['samples'][key] = ([a + b for a, b in zip(current[0], counts)], current[1] + total)
+                else:
+                    target['samples'][key] = current + value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(snapshot):
+    """Testo nel formato di esposizione Prometheus 0.0.4."""
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        names = metric['labelnames']
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key in sorted(metric['samples']):
+            value = metric['samples'][key]
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_labels(names, key)} {_number(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for upper_bound, count in zip(tuple(metric['buckets']) + (math.inf,), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(names, key, ('le', _number(upper_bound)))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(names, key)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+# --- Metriche comuni a tutta l'applicazione ---
+
+OPERATION_SECONDS = Histogram(
+    'operation_duration_seconds',
+    "Durata delle operazioni esterne o costose (S3, Rekognition, database, elaborazione delle immagini)",
+    ['component', 'operation']
+)
+ERRORS = Counter('errors_total', "Errori per componente, operazione e tipo di eccezione",
+                 ['component', 'operation', 'type'])
+
+
+def count_error(component, operation, error):
+    ERRORS.labels(component=component, operation=operation, type=type(error).__name__).inc()
+
+
+@contextmanager
+def track(component, operation):
+    """Misura la durata del blocco e conta le eccezioni che ne escono."""
+    histogram = OPERATION_SECONDS.labels(component=component, operation=operation)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        count_error(component, operation, e)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+def tracked(component, operation=None):
+    """Come track(), come decoratore: l'operazione predefinita è il nome della funzione."""
+    def decorator(func):
+        name = operation or func.__name__
+        histogram = OPERATION_SECONDS.labels(component=component, operation=name)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                count_error(component, name, e)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def instrument_flask(app):
+    """Durata e numero delle richieste HTTP per endpoint (e stato della risposta)."""
+    from flask import g, request
+
+    request_seconds = Histogram('http_request_duration_seconds', "Durata delle richieste HTTP", ['endpoint'])
+    requests_total = Counter('http_requests_total', "Richieste HTTP per endpoint e stato", ['endpoint', 'status'])
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = getattr(g, '_metrics_started', None)
+        # La regola (es. /result/<job_id>), non il percorso: il numero di serie resta limitato
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        if started is not None:
+            request_seconds.labels(endpoint=endpoint).observe(time.perf_counter() - started)
+        requests_total.labels(endpoint=endpoint, status=response.status_code).inc()
+        return response
+
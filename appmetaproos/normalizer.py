@@ -0,0 +1,128 @@
+# normalizer.py
+#
+# Prepara le immagini per Rekognition, che con Image={'Bytes': ...} accetta solo
+# JPEG o PNG fino a 5 MB. Condiviso dall'indicizzazione admin e dalla ricerca
+# dei selfie:
+# - se il file è già un JPEG/PNG entro il limite viene inviato così com'è;
+# - altrimenti viene decodificato UNA volta, con la decodifica ridotta dei JPEG
+#   (draft, scalatura DCT) e l'orientamento EXIF applicato, e ricodificato
+#   scegliendo dimensioni e qualità per stare sotto il limite in pochi tentativi.
+
+import io
+import math
+import time
+
+from PIL import Image, ImageOps
+
+from config import Config
+from metrics import tracked
+
+# Formati accettati da Rekognition
+REKOGNITION_FORMATS = ('JPEG', 'PNG')
+# Tentativi massimi di codifica prima di arrendersi
+MAX_ENCODE_ATTEMPTS = 4
+# Qualità JPEG del primo tentativo e minima accettata
+START_QUALITY = 90
+MIN_QUALITY = 70
+
+
+def _read_all(source):
+    source.seek(0)
+    data = source.read()
+    source.seek(0)
+    return data
+
+
+def fits_rekognition(source, max_bytes=None):
+    """
+    True se l'immagine può essere inviata a Rekognition senza modifiche.
+    Legge solo l'intestazione del file, senza decodificare i pixel.
+    """
+    max_bytes = max_bytes or Config.REKOGNITION_MAX_BYTES
+    source.seek(0, io.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    if size > max_bytes:
+        return False
+    try:
+        with Image.open(source) as img:
+            return img.format in REKOGNITION_FORMATS
+    finally:
+        source.seek(0)
+
+
+@tracked('image')
+def decode_image(source, max_dimension):
+    """
+    Decodifica l'immagine già ridotta al lato massimo `max_dimension`, in RGB e
+    con l'orientamento EXIF applicato. Per i JPEG la riduzione avviene già in
+    decodifica (draft), senza mai espandere in memoria l'immagine intera.
+    Restituisce (immagine, millisecondi di decodifica).
+    """
+    started = time.perf_counter()
+    source.seek(0)
+    img = Image.open(source)
+    img.draft('RGB', (max_dimension, max_dimension))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    return img, (time.perf_counter() - started) * 1000
+
+
+@tracked('image')
+def encode_within_budget(img, max_bytes=None, max_dimension=None):
+    """
+    Codifica l'immagine in JPEG sotto max_bytes.
+    Se un tentativo sfora, le nuove dimensioni vengono stimate dal rapporto tra
+    byte ottenuti e budget (la dimensione del JPEG cresce circa con il numero di
+    pixel), così di solito basta un secondo tentativo.
+    Restituisce (byte JPEG, statistiche).
+    """
+    max_bytes = max_bytes or Config.REKOGNITION_MAX_BYTES
+    max_dimension = max_dimension or Config.REKOGNITION_MAX_DIMENSION
+
+    started = time.perf_counter()
+    if max(img.size) > max_dimension:
+        img = img.copy()
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    quality = START_QUALITY
+    for attempt in range(1, MAX_ENCODE_ATTEMPTS + 1):
+        encoded = io.BytesIO()
+        img.save(encoded, 'JPEG', quality=quality, optimize=True)
+        size = encoded.tell()
+        if size <= max_bytes:
+            return encoded.getvalue(), {
+                'encode_ms': round((time.perf_counter() - started) * 1000, 1),
+                'attempts': attempt,
+                'width': img.width,
+                'height': img.height,
+                'quality': quality,
+                'output_bytes': size,
+            }
+        # Margine del 10% per non mancare il budget di poco; la qualità scende solo fino a MIN_QUALITY
+        scale = math.sqrt(max_bytes / size) * 0.9
+        quality = max(MIN_QUALITY, quality - 5)
+        new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(new_size, Image.LANCZOS)
+
+    raise ValueError(f"Impossibile ridurre l'immagine sotto {max_bytes} byte in {MAX_ENCODE_ATTEMPTS} tentativi")
+
+
+def normalize_for_rekognition(source, max_bytes=None, max_dimension=None):
+    """
+    Restituisce (byte da inviare a Rekognition, statistiche).
+    `source` è un file o buffer binario; le statistiche riportano se l'immagine
+    è stata ricodificata e i tempi di decodifica/codifica in millisecondi.
+    """
+    max_bytes = max_bytes or Config.REKOGNITION_MAX_BYTES
+    max_dimension = max_dimension or Config.REKOGNITION_MAX_DIMENSION
+
+    if fits_rekognition(source, max_bytes):
+        data = _read_all(source)
+        return data, {'reencoded': False, 'output_bytes': len(data)}
+
+    img, decode_ms = decode_image(source, max_dimension)
+    data, stats = encode_within_budget(img, max_bytes, max_dimension)
+    return data, {'reencoded': True, 'decode_ms': round(decode_ms, 1), **stats}
@@ -0,0 +1,268 @@
+# purge.py
+#
+# Eliminazione di tutte le foto in background: oggetti S3 (originale e versioni
+# ridotte), volti della collection Rekognition e righe del database.
+# Si procede per lotti di PURGE_BATCH_SIZE volti: per ogni lotto le chiavi S3
+# vengono eliminate in blocchi da 1000 (il massimo di DeleteObjects) e i volti
+# con DeleteFaces, tutto in parallelo; poi le righe del lotto e l'avanzamento
+# vengono salvati in una sola transazione (tabella purge_runs). Le eliminazioni
+# su S3 e Rekognition sono idempotenti, quindi un'eliminazione interrotta
+# riprende dall'ultimo lotto salvato rifacendo al più un lotto.
+# Dopo i volti vengono eliminate le foto rimaste solo in photo_hashes (quelle senza volti).
+# Si eliminano le foto di tutti gli eventi: ogni volto viene tolto dalla collection del suo evento.
+#
+# Ogni eliminazione appartiene a un processo (owner) che la aggiorna a ogni
+# lotto: se il processo termina, dopo PURGE_LEASE_SECONDS un altro processo
+# (o lo stesso dopo il riavvio) può riprenderla.
+
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from config import Config
+from database import (claim_purge_run, delete_purged_faces, delete_purged_hashes, get_purge_face_batch,
+                      get_purge_hash_batch, get_purge_run, set_purge_run_state, start_purge_run)
+from derivatives import derivative_keys
+from events import collection_id
+from metrics import Counter, count_error, track
+from signing import object_key_from_url
+
+# Limiti delle API: chiavi per DeleteObjects e FaceIds per DeleteFaces
+S3_DELETE_MAX_KEYS = 1000
+REKOGNITION_DELETE_MAX_FACES = 4096
+
+DELETED = Counter('purge_deleted_total', "Elementi eliminati dalla purge (s3_objects, rekognition_faces, db_rows)",
+                  ['kind'])
+
+_executor = None
+_executor_lock = threading.Lock()
+_threads = {}
+_threads_lock = threading.Lock()
+
+
+class PurgeInterrupted(Exception):
+    """L'avanzamento di un lotto non è stato salvato (errore del database o eliminazione ripresa da un altro processo)."""
+
+
+def _get_executor():
+    """Pool di thread (uno per processo) per le chiamate di eliminazione in parallelo."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.PURGE_CONCURRENCY, thread_name_prefix='purge')
+        return _executor
+
+
+def _new_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def object_keys(photo_urls):
+    """Chiavi S3 delle foto: l'originale e le versioni ridotte, ricavabili dall'originale."""
+    keys = []
+    for url in dict.fromkeys(photo_urls):
+        object_key = object_key_from_url(url)
+        keys.append(object_key)
+        keys.extend(derivative_keys(object_key))
+    return keys
+
+
+def _delete_objects(s3_client, keys):
+    """Elimina fino a 1000 chiavi con una richiesta; gli errori per chiave fanno fallire il lotto."""
+    with track('s3', 'delete_objects'):
+        response = s3_client.delete_objects(
+            Bucket=Config.S3_GALLERY_BUCKET,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        )
+    errors = response.get('Errors') or []
+    if errors:
+        first = errors[0]
+        raise RuntimeError(f"S3 did not delete {len(errors)} objects (e.g. {first.get('Key')}: {first.get('Code')})")
+    DELETED.labels(kind='s3_objects').inc(len(keys))
+    return len(keys)
+
+
+def _delete_faces(rekognition_client, collection, face_ids):
+    """
+    Toglie i volti dalla collection; quelli già assenti non sono un errore,
+    e nemmeno la collection già eliminata (evento archiviato).
+    """
+    try:
+        with track('rekognition', 'delete_faces'):
+            response = rekognition_client.delete_faces(CollectionId=collection, FaceIds=face_ids)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ResourceNotFoundException':
+            raise
+        return 0
+    unsuccessful = response.get('UnsuccessfulFaceDeletions') or []
+    if unsuccessful:
+        print(f"PURGE: Rekognition did not delete {len(unsuccessful)} faces "
+              f"(e.g. {unsuccessful[0].get('FaceId')}: {unsuccessful[0].get('Reasons')})")
+    deleted = len(response.get('DeletedFaces') or [])
+    DELETED.labels(kind='rekognition_faces').inc(deleted)
+    return deleted
+
+
+def _delete_remote(s3_client, rekognition_client, keys, face_ids):
+    """
+    Elimina le chiavi S3 (in blocchi da 1000) e i volti (collection -> face_id,
+    in blocchi da 4096 per collection) in parallelo.
+    Attende tutte le chiamate prima di sollevare il primo errore.
+    Restituisce (oggetti eliminati, volti eliminati).
+    """
+    executor = _get_executor()
+    s3_futures = [executor.submit(_delete_objects, s3_client, chunk) for chunk in _chunks(keys, S3_DELETE_MAX_KEYS)]
+    face_futures = [executor.submit(_delete_faces, rekognition_client, collection, chunk)
+                    for collection, ids in face_ids.items()
+                    for chunk in _chunks(ids, REKOGNITION_DELETE_MAX_FACES)]
+    errors = [future.exception() for future in s3_futures + face_futures if future.exception() is not None]
+    if errors:
+        raise errors[0]
+    return sum(future.result() for future in s3_futures), sum(future.result() for future in face_futures)
+
+
+def _purge_faces(run, owner, s3_client, rekognition_client):
+    after_id = run['last_face_id']
+    while True:
+        rows = get_purge_face_batch(after_id, run['cutoff_face_id'], Config.PURGE_BATCH_SIZE)
+        if rows is None:
+            raise PurgeInterrupted("could not read the next batch of faces")
+        if not rows:
+            return
+        photo_urls = list(dict.fromkeys(photo_url for _, _, photo_url, _ in rows))
+        face_ids = {}
+        for _, face_id, _, event_key in rows:
+            face_ids.setdefault(collection_id(event_key), []).append(face_id)
+        deleted_objects, deleted_faces = _delete_remote(s3_client, rekognition_client, object_keys(photo_urls),
+                                                        face_ids)
+        last_id = rows[-1][0]
+        if not delete_purged_faces(run['id'], owner, after_id, last_id, photo_urls, deleted_objects, deleted_faces):
+            raise PurgeInterrupted(f"could not save progress after face id {last_id}")
+        DELETED.labels(kind='db_rows').inc(len(rows))
+        print(f"PURGE {run['id']}: deleted faces up to id {last_id} ({len(rows)} faces, {deleted_objects} objects)")
+        after_id = last_id
+
+
+def _purge_hashes(run, owner, s3_client, rekognition_client):
+    # Posizione (content_hash, event_key): la stessa foto può essere registrata in più eventi
+    after = (run['last_content_hash'], run['last_hash_event'])
+    while True:
+        rows = get_purge_hash_batch(after, run['cutoff_hash_at'], Config.PURGE_BATCH_SIZE)
+        if rows is None:
+            raise PurgeInterrupted("could not read the next batch of photo hashes")
+        if not rows:
+            return
+        deleted_objects, _ = _delete_remote(s3_client, rekognition_client,
+                                            object_keys(photo_url for _, _, photo_url in rows), {})
+        last = rows[-1][:2]
+        if not delete_purged_hashes(run['id'], owner, after, last, run['cutoff_hash_at'], deleted_objects):
+            raise PurgeInterrupted(f"could not save progress after hash {last[0]} ({last[1]})")
+        DELETED.labels(kind='db_rows').inc(len(rows))
+        after = last
+
+
+def _run_purge(run, owner, s3_client, rekognition_client):
+    """Esegue (o riprende dalla fase e dal lotto salvati) un'eliminazione."""
+    phase = run['phase']
+    print(f"PURGE {run['id']}: {'resuming' if run['deleted_faces'] or run['deleted_hashes'] else 'starting'} "
+          f"({phase}, {run['total_faces']} faces, {run['total_hashes']} photo hashes)")
+    try:
+        if phase == 'faces':
+            _purge_faces(run, owner, s3_client, rekognition_client)
+            phase = 'hashes'
+            set_purge_run_state(run['id'], owner, 'running', phase)
+        _purge_hashes(run, owner, s3_client, rekognition_client)
+        set_purge_run_state(run['id'], owner, 'done', phase)
+        print(f"PURGE {run['id']}: completed")
+    except Exception as e:
+        print(f"PURGE {run['id']} ERROR: {e}")
+        count_error('purge', phase, e)
+        # Se l'eliminazione è passata a un altro processo l'aggiornamento non ha effetto
+        set_purge_run_state(run['id'], owner, 'failed', phase, str(e))
+    finally:
+        with _threads_lock:
+            _threads.pop(run['id'], None)
+
+
+def _spawn(run, owner, s3_client, rekognition_client):
+    with _threads_lock:
+        thread = _threads.get(run['id'])
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=_run_purge, args=(run, owner, s3_client, rekognition_client),
+                                  name=f"purge-{run['id']}", daemon=True)
+        _threads[run['id']] = thread
+    thread.start()
+
+
+def start_purge(s3_client, rekognition_client):
+    """
+    Avvia l'eliminazione di tutte le foto, oppure riprende quella non completata
+    (fallita o rimasta senza proprietario). Se un altro processo la sta già
+    eseguendo non fa nulla. Restituisce lo stato dell'eliminazione.
+    """
+    owner = _new_owner()
+    run, created = start_purge_run(owner)
+    if run is None:
+        raise RuntimeError("Unable to create the purge in the database")
+    if not created:
+        run = claim_purge_run(run['id'], owner, Config.PURGE_LEASE_SECONDS)
+    if run is not None:
+        _spawn(run, owner, s3_client, rekognition_client)
+    return get_purge_status()
+
+
+def resume_interrupted_purge(s3_client, rekognition_client):
+    """
+    Riprende un'eliminazione in corso il cui processo non la aggiorna da più di
+    PURGE_LEASE_SECONDS (es. riavvio dell'app). Quelle fallite ripartono solo su richiesta dell'admin.
+    """
+    run = get_purge_run()
+    if run is None or run['status'] != 'running':
+        return False
+    with _threads_lock:
+        thread = _threads.get(run['id'])
+        if thread is not None and thread.is_alive():
+            return False
+    owner = _new_owner()
+    run = claim_purge_run(run['id'], owner, Config.PURGE_LEASE_SECONDS)
+    if run is None:
+        return False
+    _spawn(run, owner, s3_client, rekognition_client)
+    return True
+
+
+def get_purge_status():
+    """Avanzamento dell'eliminazione più recente, serializzabile in JSON (None se non ce ne sono)."""
+    run = get_purge_run()
+    if run is None:
+        return None
+    total = run['total_faces'] + run['total_hashes']
+    deleted = run['deleted_faces'] + run['deleted_hashes']
+    end = run['finished_at'] or run['heartbeat_at'] or run['started_at']
+    elapsed = (end - run['started_at']).total_seconds()
+    return {
+        'purge_id': run['id'],
+        'status': run['status'],
+        'phase': run['phase'],
+        'total_faces': run['total_faces'],
+        'deleted_faces': run['deleted_faces'],
+        'total_photo_hashes': run['total_hashes'],
+        'deleted_photo_hashes': run['deleted_hashes'],
+        'deleted_objects': run['deleted_objects'],
+        'deleted_rekognition_faces': run['deleted_rekognition_faces'],
+        'percent': 100 if run['status'] == 'done' or not total else min(99, round(deleted * 100 / total)),
+        'error': run['error'],
+        'started_at': run['started_at'].isoformat(),
+        'finished_at': run['finished_at'].isoformat() if run['finished_at'] else None,
+        'elapsed_seconds': round(elapsed, 1),
+        'faces_per_second': round(run['deleted_faces'] / elapsed, 1) if elapsed > 0 else 0.0,
+    }
@@ -0,0 +1,108 @@
+# search_cache.py
+#
+# Cache dei risultati di search_faces_by_image, indicizzata per hash percettivo
+# del selfie. Le voci sono legate alla sessione del browser: un selfie ripetuto
+# (o quasi identico) dallo stesso cliente non richiama Rekognition, ma un
+# selfie simile di un'altra persona non può mai ricevere i risultati altrui.
+
+import io
+import threading
+
+from PIL import Image
+
+from cache import create_cache
+from config import Config
+from metrics import Counter
+
+# Lato della griglia del dHash: 16 -> hash da 256 bit
+HASH_SIZE = 16
+
+
+def perceptual_hash(image_bytes, hash_size=HASH_SIZE):
+    """
+    Calcola il dHash (difference hash) dell'immagine (byte o file binario) come intero.
+    L'immagine viene ridotta a (hash_size + 1) x hash_size in scala di grigi e
+    ogni bit indica se un pixel è più chiaro del vicino a destra; ricompressioni
+    e piccole variazioni cambiano pochi bit.
+    """
+    source = io.BytesIO(image_bytes) if isinstance(image_bytes, (bytes, bytearray)) else image_bytes
+    with Image.open(source) as img:
+        # Per i JPEG decodifica direttamente a risoluzione ridotta (scalatura DCT)
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        small = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+LOOKUPS = Counter('search_cache_lookups_total', "Ricerche nella cache dei selfie per esito (hit, miss)", ['result'])
+
+class SearchCache:
+    """
+    Per ogni sessione conserva gli ultimi selfie cercati (hash + FaceId/similarità
+    trovati). Una ricerca è un 'hit' se l'hash dista al massimo max_distance bit
+    da uno di quelli salvati.
+    """
+
+    def __init__(self, backend, max_distance=0, per_session=8):
+        self.backend = backend
+        self.max_distance = max_distance
+        self.per_session = per_session
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        LOOKUPS.labels(result='hit' if hit else 'miss').inc()
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, session_key, phash):
+        """Restituisce la lista di match salvata per questo selfie, oppure None."""
+        for entry in self.backend.get(session_key) or []:
+            if bin(int(entry['phash'], 16) ^ phash).count('1') <= self.max_distance:
+                self._count(True)
+                return entry['matches']
+        self._count(False)
+        return None
+
+    def put(self, session_key, phash, matches):
+        """Salva i match (lista di {'face_id', 'similarity'}) per questo selfie."""
+        phash_hex = format(phash, 'x')
+        entries = [entry for entry in self.backend.get(session_key) or []
+                   if entry['phash'] != phash_hex]
+        entries.insert(0, {'phash': phash_hex, 'matches': matches})
+        self.backend.set(session_key, entries[:self.per_session])
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_search_cache():
+    """Crea la cache configurata in Config (None se SEARCH_CACHE_BACKEND è 'none')."""
+    if Config.SEARCH_CACHE_BACKEND == 'none':
+        return None
+    backend = create_cache(
+        Config.SEARCH_CACHE_BACKEND,
+        namespace=f"search:{Config.REKOGNITION_COLLECTION_ID}",
+        max_entries=Config.SEARCH_CACHE_MAX_ENTRIES,
+        ttl=Config.SEARCH_CACHE_TTL,
+        redis_url=Config.REDIS_URL
+    )
+    return SearchCache(backend, max_distance=Config.SEARCH_CACHE_MAX_DISTANCE)
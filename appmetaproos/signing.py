@@ -0,0 +1,144 @@
+# signing.py
+#
+# URL pre-firmati per le foto della galleria, stabili nel tempo.
+# generate_presigned_url firma con l'ora corrente, quindi ogni URL è diverso e
+# né il browser né una CDN possono metterlo in cache. Qui l'istante di firma
+# viene arrotondato all'inizio di una finestra fissa (PRESIGN_BUCKET_SECONDS):
+# entro la stessa finestra lo stesso oggetto ha sempre lo stesso URL, anche
+# tra worker diversi. La firma è SigV4 in query string, come quella di boto3.
+
+import hashlib
+import hmac
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote, urlparse
+
+import boto3
+
+from cache import MemoryCache
+from metrics import tracked
+
+# Durata massima di un URL pre-firmato SigV4 (7 giorni)
+MAX_EXPIRES = 7 * 24 * 3600
+
+
+def object_key_from_url(url):
+    """Chiave S3 di un URL https://<bucket>.s3.<regione>.amazonaws.com/<chiave>."""
+    return unquote(urlparse(url).path.lstrip('/'))
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _uri_encode(value, safe='~'):
+    return quote(value, safe=safe)
+
+
+def presign_get_urls(keys, host, region, access_key, secret_key, session_token,
+                     signed_at, expires_in):
+    """
+    Firma in un solo passaggio una lista di chiavi S3 (GET, SigV4 in query string).
+    La chiave di firma e la parte comune della query vengono calcolate una volta
+    per tutto il lotto; per ogni oggetto restano un SHA-256 e un HMAC.
+    Restituisce un dizionario chiave -> URL.
+    """
+    timestamp = datetime.fromtimestamp(signed_at, tz=timezone.utc)
+    amz_date = timestamp.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = timestamp.strftime('%Y%m%d')
+    scope = f"{date_stamp}/{region}/s3/aws4_request"
+
+    signing_key = _hmac(('AWS4' + secret_key).encode('utf-8'), date_stamp)
+    signing_key = _hmac(signing_key, region)
+    signing_key = _hmac(signing_key, 's3')
+    signing_key = _hmac(signing_key, 'aws4_request')
+
+    params = [
+        ('X-Amz-Algorithm', 'AWS4-HMAC-SHA256'),
+        ('X-Amz-Credential', f"{access_key}/{scope}"),
+        ('X-Amz-Date', amz_date),
+        ('X-Amz-Expires', str(expires_in)),
+        ('X-Amz-SignedHeaders', 'host'),
+    ]
+    if session_token:
+        params.append(('X-Amz-Security-Token', session_token))
+    query = '&'.join(f"{_uri_encode(name)}={_uri_encode(value)}" for name, value in sorted(params))
+
+    # Tutto ciò che nella richiesta canonica segue il path è uguale per ogni oggetto
+    canonical_tail = f"\n{query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+    string_to_sign_head = f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+
+    urls = {}
+    for key in keys:
+        path = '/' + _uri_encode(key, safe='/~')
+        canonical_request = 'GET\n' + path + canonical_tail
+        string_to_sign = string_to_sign_head + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        urls[key] = f"https://{host}{path}?{query}&X-Amz-Signature={signature}"
+    return urls
+
+
+class UrlSigner:
+    """
+    Firma (e tiene in cache) gli URL GET degli oggetti di un bucket.
+    Ogni URL è valido per almeno `ttl` secondi da quando viene restituito;
+    la cache scade alla fine della finestra in cui l'URL è stato firmato.
+    """
+
+    def __init__(self, s3_client, bucket, region, bucket_seconds=900, ttl=3600, max_entries=50000):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.region = region
+        self.host = f"{bucket}.s3.{region}.amazonaws.com"
+        self.bucket_seconds = bucket_seconds
+        self.expires_in = min(ttl + bucket_seconds, MAX_EXPIRES)
+        self._cache = MemoryCache(max_entries=max_entries, ttl=bucket_seconds)
+        self._session = boto3.session.Session()
+
+    def _credentials(self):
+        credentials = self._session.get_credentials()
+        return credentials.get_frozen_credentials() if credentials else None
+
+    @tracked('s3', 'presign')
+    def sign_many(self, keys):
+        """Restituisce un dizionario chiave -> URL pre-firmato per tutte le chiavi."""
+        now = time.time()
+        window_start = int(now // self.bucket_seconds) * self.bucket_seconds
+        remaining = window_start + self.bucket_seconds - now
+
+        urls = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            cached = self._cache.get(f"{window_start}:{key}")
+            if cached is not None:
+                urls[key] = cached
+            else:
+                missing.append(key)
+        if not missing:
+            return urls
+
+        credentials = self._credentials()
+        if credentials is not None:
+            signed = presign_get_urls(
+                missing, self.host, self.region,
+                credentials.access_key, credentials.secret_key, credentials.token,
+                signed_at=window_start, expires_in=self.expires_in
+            )
+        else:
+            # Senza credenziali esplicite (caso raro) si ricade sulla firma di boto3
+            signed = {
+                key: self.s3_client.generate_presigned_url(
+                    'get_object',
+                    Params={'Bucket': self.bucket, 'Key': key},
+                    ExpiresIn=int(self.expires_in - (now - window_start))
+                )
+                for key in missing
+            }
+
+        for key, url in signed.items():
+            self._cache.set(f"{window_start}:{key}", url, ttl=remaining)
+        urls.update(signed)
+        return urls
+
+    def sign(self, key):
+        return self.sign_many([key])[key]
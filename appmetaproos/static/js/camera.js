@@ -47,6 +47,11 @@ captureBtn.addEventListener('click', function() {
         // Create FormData to send the image
         const formData = new FormData();
         formData.append('selfie', blob, 'selfie.jpg');
+        // Search only the photos of the selected event
+        const eventKey = document.getElementById('eventKey');
+        if (eventKey && eventKey.value) {
+            formData.append('event', eventKey.value);
+        }
         
         // Send the selfie to the server
         fetch('/search', {
@@ -64,14 +69,9 @@ captureBtn.addEventListener('click', function() {
                 throw new Error(data.error);
             }
             
-            // Redirect to gallery with photo URLs
-            if (data.photo_urls && data.photo_urls.length > 0) {
-                // Create URL with photo parameters
-                const url = new URL('/gallery', window.location.origin);
-                data.photo_urls.forEach(photo => {
-                    url.searchParams.append('photos', photo);
-                });
-                window.location.href = url.toString();
+            // Redirect to the gallery stored on the server for this search
+            if (data.gallery_url && data.photo_count > 0) {
+                window.location.href = data.gallery_url;
             } else {
                 // No matching photos found
                 showMessage("No matching photos found. Please try again with a clearer selfie.", "warning");
@@ -0,0 +1,53 @@
+import psycopg2
+import pytest
+
+import database
+import events
+from config import Config
+
+
+def test_active_events_do_not_count_faces(fake_cursor):
+    events.active_events()
+
+    query, params = fake_cursor.queries[-1]
+    assert 'faces' not in query
+    assert params == ('active', 'active')
+
+
+def test_admin_listing_counts_faces(fake_cursor):
+    database.list_events(face_counts=True)
+
+    query, _ = fake_cursor.queries[-1]
+    assert 'COUNT(*) FROM faces' in query
+
+
+def test_resolve_event_missing_is_404(monkeypatch):
+    monkeypatch.setattr(events, 'get_event', lambda event_key: None)
+
+    with pytest.raises(events.EventError) as error:
+        events.resolve_event('gita')
+    assert error.value.status == 404
+
+
+def test_resolve_event_archived_is_410(monkeypatch):
+    monkeypatch.setattr(events, 'get_event', lambda event_key: {'event_key': event_key, 'status': 'archived'})
+
+    with pytest.raises(events.EventError) as error:
+        events.resolve_event('gita')
+    assert error.value.status == 410
+
+
+def test_resolve_event_database_outage_is_503(monkeypatch):
+    def unavailable(event_key):
+        raise psycopg2.OperationalError("connection refused")
+    monkeypatch.setattr(events, 'get_event', unavailable)
+
+    with pytest.raises(events.EventError) as error:
+        events.resolve_event('')
+    assert error.value.status == 503
+
+
+def test_resolve_event_defaults_to_default_event(monkeypatch):
+    monkeypatch.setattr(events, 'get_event', lambda event_key: {'event_key': event_key, 'status': 'active'})
+
+    assert events.resolve_event('  ') == Config.DEFAULT_EVENT
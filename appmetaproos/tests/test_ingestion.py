@@ -0,0 +1,48 @@
+import io
+
+import pytest
+from botocore.exceptions import ClientError
+from PIL import Image
+
+import ingestion
+
+
+def photo():
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), (120, 90, 60)).save(buffer, 'JPEG')
+    size = buffer.tell()
+    buffer.seek(0)
+    return buffer, size
+
+
+def test_rekognition_failure_removes_uploaded_objects(s3_client, rekognition_client, monkeypatch):
+    def throttled(**kwargs):
+        raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'IndexFaces')
+    monkeypatch.setattr(rekognition_client, 'index_faces', throttled)
+    buffer, size = photo()
+
+    with pytest.raises(ClientError):
+        ingestion.index_photo('gita.jpg', buffer, size, s3_client, rekognition_client)
+
+    assert s3_client.requests > 1
+    assert s3_client.objects == {}
+
+
+def test_database_failure_removes_uploaded_objects(s3_client, rekognition_client, monkeypatch):
+    monkeypatch.setattr(ingestion, 'add_face_records', lambda records, event_key=None: False)
+    buffer, size = photo()
+
+    with pytest.raises(RuntimeError):
+        ingestion.index_photo('gita.jpg', buffer, size, s3_client, rekognition_client)
+
+    assert s3_client.objects == {}
+
+
+def test_indexed_photo_keeps_its_objects(s3_client, rekognition_client, monkeypatch):
+    monkeypatch.setattr(ingestion, 'add_face_records', lambda records, event_key=None: True)
+    buffer, size = photo()
+
+    result = ingestion.index_photo('gita.jpg', buffer, size, s3_client, rekognition_client)
+
+    assert result['faces'] == 1
+    assert any(key == 'gita.jpg' for _, key in s3_client.objects)
@@ -0,0 +1,486 @@
+# benchmark_worker.py
+#
+# Benchmark offline della pipeline uploader -> coda -> worker: caricamenti su
+# /upload e /upload/batch, il ciclo di run_worker (micro-batching, indice della
+# galleria, archivio dei risultati SQLite) e la lettura dei risultati su /results.
+# Tutto gira in un processo: Redis è simulato in memoria (o un Redis locale con
+# --redis-url, su chiavi dedicate poi eliminate), DeepFace è sostituito da un
+# modello finto con latenza e volti per immagine configurabili (--real-model
+# per usare quello vero) e i file finiscono in una cartella temporanea.
+# Le immagini sono generate al volo. Throughput, latenze p50/p95/p99 e picco di
+# memoria finiscono in un file JSON, per confrontare esecuzioni diverse.
+#
+#   python benchmark_worker.py --images 500 --batch-files 50 --gallery-faces 20000
+#   python benchmark_worker.py --real-model --images 100 --output bench.json
+
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import config
+
+
+# --- Statistiche e report ---
+
+def percentile(ordered, fraction):
+    """Percentile (nearest-rank) di una lista già ordinata."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def summarize(latencies, seconds, errors=0, items=None):
+    """Throughput e latenze (in ms) di uno scenario; `items` conta le unità del throughput se diverse dalle misure."""
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    items = len(ordered) if items is None else items
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput_per_second': round(items / seconds, 2) if seconds > 0 else None,
+        'latency_ms': {
+            'p50': ms(percentile(ordered, 0.50)),
+            'p95': ms(percentile(ordered, 0.95)),
+            'p99': ms(percentile(ordered, 0.99)),
+            'mean': ms(sum(ordered) / len(ordered)) if ordered else None,
+            'max': ms(ordered[-1]) if ordered else None,
+        },
+    }
+
+
+def operation_summary(snapshot):
+    """Chiamate, errori e durata media per operazione, dalle metriche raccolte durante il benchmark."""
+    operations = {}
+    histogram = snapshot.get('operation_duration_seconds', {'samples': {}})
+    for (component, operation), (counts, total) in histogram['samples'].items():
+        calls = sum(counts)
+        if calls:
+            operations[f"{component}.{operation}"] = {'calls': calls, 'mean_ms': round(total / calls * 1000, 2)}
+    for (component, operation, error_type), count in snapshot.get('errors_total', {'samples': {}})['samples'].items():
+        entry = operations.setdefault(f"{component}.{operation}", {'calls': 0})
+        entry.setdefault('errors', {})[error_type] = int(count)
+    return operations
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo restituisce in KB, macOS in byte
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+# --- Immagini sintetiche ---
+
+def synthetic_photo(rng, width, height, quality=85):
+    """JPEG con sfumatura e forme casuali: ogni immagine è diversa (la deduplicazione non la scarta)."""
+    img = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(img)
+    top = tuple(rng.randrange(256) for _ in range(3))
+    bottom = tuple(rng.randrange(256) for _ in range(3))
+    for y in range(0, height, 4):
+        t = y / height
+        draw.rectangle([0, y, width, y + 4], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+    for _ in range(rng.randint(5, 20)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        size = rng.randint(width // 20, width // 4)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape([x, y, x + size, y + size], fill=tuple(rng.randrange(256) for _ in range(3)))
+    encoded = io.BytesIO()
+    img.save(encoded, 'JPEG', quality=quality)
+    return encoded.getvalue()
+
+
+def synthetic_corpus(count, width, height, duplicates, seed):
+    """`count` immagini, di cui una frazione `duplicates` copie esatte di altre (per la deduplicazione)."""
+    rng = random.Random(seed)
+    unique = max(1, count - int(count * duplicates))
+    corpus = [(f"img_{index:06d}.jpg", synthetic_photo(rng, width, height)) for index in range(unique)]
+    for index in range(unique, count):
+        corpus.append((f"img_{index:06d}.jpg", rng.choice(corpus[:unique])[1]))
+    rng.shuffle(corpus)
+    return corpus
+
+
+# --- Redis e DeepFace finti ---
+
+class FakeRedis:
+    """I comandi Redis usati da ListQueue e DrainRate, in memoria e thread-safe."""
+
+    def __init__(self):
+        self._lists = defaultdict(list)
+        self._values = {}
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def _encode(value):
+        return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    def rpush(self, name, *values):
+        with self._condition:
+            self._lists[name].extend(self._encode(value) for value in values)
+            self._condition.notify_all()
+            return len(self._lists[name])
+
+    def lpop(self, name, count=None):
+        with self._condition:
+            items = self._lists[name]
+            if count is None:
+                return items.pop(0) if items else None
+            taken, items[:count] = items[:count], []
+            return taken or None
+
+    def blpop(self, keys, timeout=0):
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._condition:
+            while True:
+                for key in keys:
+                    if self._lists[key]:
+                        return key.encode('utf-8'), self._lists[key].pop(0)
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def llen(self, name):
+        with self._condition:
+            return len(self._lists[name])
+
+    def incrby(self, name, amount=1):
+        with self._condition:
+            value = int(self._values.get(name, 0)) + amount
+            self._values[name] = str(value).encode('utf-8')
+            return value
+
+    def expire(self, name, seconds):
+        return True
+
+    def mget(self, keys):
+        with self._condition:
+            return [self._values.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        def queue_call(*args, **kwargs):
+            self._calls.append((getattr(self._client, name), args, kwargs))
+            return self
+        return queue_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+def sleep_ms(milliseconds, rng, jitter):
+    if milliseconds > 0:
+        time.sleep(milliseconds / 1000 * (rng.lognormvariate(0, jitter) if jitter > 0 else 1.0))
+
+
+class FakeEmbeddingModel:
+    """Al posto del modello Keras: latenza per gruppo più una parte per volto, embedding casuali."""
+
+    def __init__(self, dim, batch_ms, face_ms, jitter, seed):
+        self.dim = dim
+        self.batch_ms = batch_ms
+        self.face_ms = face_ms
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+        self._vectors = np.random.default_rng(seed)
+
+    def predict_on_batch(self, batch):
+        sleep_ms(self.batch_ms + self.face_ms * len(batch), self._rng, self.jitter)
+        return self._vectors.normal(size=(len(batch), self.dim)).astype(np.float32)
+
+
+def fake_detector(faces_per_image, detect_ms, face_size, jitter, seed):
+    """Al posto di DeepFace.extract_faces: apre l'immagine, attende e restituisce volti RGB 0-1."""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    faces = [np.random.default_rng(seed + n).random((face_size, face_size, 3), dtype=np.float32) for n in range(8)]
+
+    def detect_faces(image):
+        if isinstance(image, str):
+            with Image.open(image) as img:
+                img.load()
+        with lock:
+            count = rng.randint(*faces_per_image)
+        sleep_ms(detect_ms, rng, jitter)
+        return [faces[n % len(faces)] for n in range(count)]
+    return detect_faces
+
+
+def parse_range(value):
+    """'3' -> (3, 3), '0-5' -> (0, 5)."""
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+# --- Scenari ---
+
+def bench_uploads(app, corpus, batch_files, concurrency):
+    """
+    Caricamenti in parallelo: un file per richiesta su /upload, oppure gruppi di
+    batch_files file multipart su /upload/batch. Restituisce le misure e {job_id: istante di invio}.
+    """
+    latencies = []
+    job_ids = []
+    rejected = 0
+    errors = 0
+    lock = threading.Lock()
+    if batch_files > 1:
+        requests = [corpus[start:start + batch_files] for start in range(0, len(corpus), batch_files)]
+    else:
+        requests = [[item] for item in corpus]
+
+    def send(files):
+        nonlocal rejected, errors
+        client = app.test_client()
+        started = time.perf_counter()
+        if batch_files > 1:
+            response = client.post('/upload/batch', content_type='multipart/form-data',
+                                   data={'files': [(io.BytesIO(data), name) for name, data in files]})
+        else:
+            name, data = files[0]
+            response = client.post('/upload', content_type='multipart/form-data',
+                                   data={'file': (io.BytesIO(data), name)})
+        elapsed = time.perf_counter() - started
+        body = response.get_json() or {}
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code == 429:
+                rejected += 1
+            elif response.status_code not in (200, 202):
+                errors += 1
+            elif batch_files > 1:
+                job_ids.extend(entry['job_id'] for entry in body['jobs'] if not entry.get('duplicate'))
+            elif not body.get('duplicate'):
+                job_ids.append(body['job_id'])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, requests))
+    elapsed = time.perf_counter() - started
+    result = summarize(latencies, elapsed, errors, items=len(corpus))
+    result['endpoint'] = '/upload/batch' if batch_files > 1 else '/upload'
+    result['rejected_429'] = rejected
+    result['jobs_queued'] = len(job_ids)
+    return result, job_ids
+
+
+def wait_for_jobs(job_ids, timeout):
+    """Attende che il worker completi tutti i lavori; restituisce i risultati."""
+    from result_store import STATUS_QUEUED, get_results
+    deadline = time.monotonic() + timeout
+    while True:
+        results = get_results(job_ids)
+        pending = [job_id for job_id in job_ids if results.get(job_id, {}).get('status', STATUS_QUEUED) == STATUS_QUEUED]
+        if not pending or time.monotonic() > deadline:
+            return results, len(pending)
+        time.sleep(0.05)
+
+
+def bench_results(app, job_ids, chunk):
+    """Letture dei risultati come un client: GET /results con fino a `chunk` job_id per richiesta."""
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for start in range(0, len(job_ids), chunk):
+        ids = ','.join(job_ids[start:start + chunk])
+        request_started = time.perf_counter()
+        response = client.get(f"/results?ids={ids}")
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code != 200:
+            errors += 1
+    return summarize(latencies, time.perf_counter() - started, errors, items=len(job_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--duplicates', type=float, default=0.0, help="frazione di immagini identiche ad altre già caricate")
+    parser.add_argument('--batch-files', type=int, default=1, help="file per richiesta (1 = /upload, più di 1 = /upload/batch)")
+    parser.add_argument('--upload-concurrency', type=int, default=8, help="client che caricano in parallelo")
+    parser.add_argument('--worker-batch-size', type=int, default=config.WORKER_BATCH_SIZE)
+    parser.add_argument('--worker-batch-wait-ms', type=int, default=config.WORKER_BATCH_WAIT_MS)
+    parser.add_argument('--real-model', action='store_true', help="usa DeepFace (modello e detector di config.py)")
+    parser.add_argument('--faces-per-image', default='0-3', help="volti restituiti dal detector finto (N o MIN-MAX)")
+    parser.add_argument('--detect-latency-ms', type=float, default=40, help="rilevazione finta, per immagine")
+    parser.add_argument('--embed-batch-ms', type=float, default=30, help="inferenza finta, per gruppo")
+    parser.add_argument('--embed-face-ms', type=float, default=10, help="inferenza finta, per volto")
+    parser.add_argument('--latency-jitter', type=float, default=0.2, help="sigma della latenza log-normale (0 = fissa)")
+    parser.add_argument('--embedding-dim', type=int, default=4096, help="dimensione degli embedding finti (VGG-Face: 4096)")
+    parser.add_argument('--gallery-faces', type=int, default=10000, help="embedding sintetici nell'indice della galleria")
+    parser.add_argument('--threshold', type=float, default=0.4, help="soglia di distanza dell'indice con il modello finto")
+    parser.add_argument('--redis-url', default=None, help="Redis locale al posto di quello in memoria")
+    parser.add_argument('--timeout', type=float, default=600, help="attesa massima per il completamento dei lavori")
+    parser.add_argument('--tracemalloc', action='store_true', help="misura anche il picco delle allocazioni Python (più lento)")
+    parser.add_argument('--verbose', action='store_true', help="mantiene i log INFO di uploader e worker")
+    parser.add_argument('--keep-files', action='store_true', help="non elimina la cartella temporanea del benchmark")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="file JSON dei risultati (default: benchmark-worker-<data>.json)")
+    args = parser.parse_args()
+
+    # Percorsi e chiavi del benchmark, impostati prima di importare uploader.py e worker.py
+    workdir = tempfile.mkdtemp(prefix='benchmark-worker-')
+    config.UPLOAD_FOLDER = os.path.join(workdir, 'images_to_process')
+    config.DB_PATH = os.path.join(workdir, 'gallery')
+    config.RESULTS_DB_PATH = os.path.join(workdir, 'results.db')
+    config.FACE_INDEX_PATH = os.path.join(workdir, 'face_index.npz')
+    config.EVENTS_DIR = os.path.join(workdir, 'events')
+    config.REDIS_QUEUE_NAME = f"benchmark:{uuid.uuid4().hex[:8]}"
+    config.QUEUE_BACKEND = 'list'
+    config.QUEUE_MAX_DEPTH = {lane: max(depth, args.images) for lane, depth in config.QUEUE_MAX_DEPTH.items()}
+    config.WORKER_BATCH_SIZE = args.worker_batch_size
+    config.WORKER_BATCH_WAIT_MS = args.worker_batch_wait_ms
+    config.WORKER_POLL_SECONDS = 0.2
+    config.WORKER_METRICS_PORT = None
+    os.makedirs(config.UPLOAD_FOLDER)
+    os.makedirs(config.DB_PATH)
+
+    import metrics
+    import image_processor
+    import uploader
+    import worker
+    from face_index import FaceIndex
+    from job_queue import create_queue, export_queue_metrics
+    if not args.verbose:
+        # Una riga di log per lavoro altererebbe le misure (e nasconderebbe il riepilogo)
+        logging.getLogger().setLevel(logging.WARNING)
+
+    if args.redis_url:
+        import redis
+        client = redis.Redis.from_url(args.redis_url)
+    else:
+        client = FakeRedis()
+    job_queue = create_queue(client)
+    uploader.job_queue = job_queue
+    worker.job_queue = job_queue
+    export_queue_metrics(job_queue)
+
+    if args.real_model:
+        image_processor.warm_up()
+        face_index = image_processor.get_face_index()
+        dim = image_processor.get_embedding_model()[0].output_shape[-1]
+    else:
+        model = FakeEmbeddingModel(args.embedding_dim, args.embed_batch_ms, args.embed_face_ms,
+                                   args.latency_jitter, args.seed)
+        image_processor._embedding_model = (model, (224, 224))
+        image_processor.detect_faces = metrics.tracked('deepface', 'detect_faces')(
+            fake_detector(parse_range(args.faces_per_image), args.detect_latency_ms, 152, args.latency_jitter, args.seed))
+        face_index = FaceIndex(db_path=config.DB_PATH, index_path=config.FACE_INDEX_PATH,
+                               embed_fn=image_processor.compute_embeddings, threshold=args.threshold,
+                               distance_metric=config.FACE_DISTANCE_METRIC, model_name='benchmark',
+                               rescan_seconds=config.FACE_INDEX_RESCAN_SECONDS, backend=image_processor.create_backend())
+        dim = args.embedding_dim
+    if args.gallery_faces:
+        vectors = np.random.default_rng(args.seed).normal(size=(args.gallery_faces, dim)).astype(np.float32)
+        face_index.add_embeddings([f"gallery/face_{row:07d}.jpg" for row in range(args.gallery_faces)], vectors)
+        del vectors
+
+    print(f"Generazione di {args.images} immagini {args.width}x{args.height}...")
+    corpus = synthetic_corpus(args.images, args.width, args.height, args.duplicates, args.seed)
+    corpus_mb = sum(len(data) for _, data in corpus) / (1024 * 1024)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    metrics.REGISTRY.reset()
+
+    batch_latencies = []
+    worker_thread = threading.Thread(target=worker.run_worker, name='benchmark-worker',
+                                     args=(face_index, lambda done, failed, seconds: batch_latencies.append(seconds)))
+    worker_thread.start()
+    scenarios = {}
+    try:
+        print(f"Caricamenti ({'/upload/batch' if args.batch_files > 1 else '/upload'}) con il worker attivo...")
+        started = time.perf_counter()
+        scenarios['upload'], job_ids = bench_uploads(uploader.app, corpus, args.batch_files, args.upload_concurrency)
+        results, pending = wait_for_jobs(job_ids, args.timeout)
+        pipeline_seconds = time.perf_counter() - started
+    finally:
+        worker._stopping = True
+        worker_thread.join()
+
+    # Dal caricamento al risultato salvato, per lavoro (istanti registrati dall'archivio dei risultati)
+    finished = [result for result in results.values() if result['finished_at'] is not None]
+    failed = sum(1 for result in finished if result['status'] != 'done')
+    scenarios['job_end_to_end'] = summarize([result['finished_at'] - result['created_at'] for result in finished],
+                                            pipeline_seconds, errors=failed + pending)
+    scenarios['worker_batch'] = summarize(batch_latencies, sum(batch_latencies), items=len(finished))
+    print("Lettura dei risultati...")
+    scenarios['results'] = bench_results(uploader.app, job_ids, config.RESULTS_MAX_BATCH // 10)
+
+    report = {
+        'benchmark': 'worker',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args) | {'redis_url': bool(args.redis_url)},
+        'corpus': {'images': len(corpus), 'megabytes': round(corpus_mb, 1), 'gallery_faces': len(face_index)},
+        'scenarios': scenarios,
+        'operations': operation_summary(metrics.REGISTRY.snapshot()),
+        'memory': {'peak_rss_mb': peak_rss_mb()},
+    }
+    if args.tracemalloc:
+        report['memory']['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+
+    if args.redis_url:
+        keys = list(client.scan_iter(f"{config.REDIS_QUEUE_NAME}*"))
+        if keys:
+            client.delete(*keys)
+    if not args.keep_files:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or f"benchmark-worker-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'scenario':<20}{'n':>7}{'err':>6}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in scenarios.items():
+        latency = result['latency_ms']
+        print(f"{name:<20}{result['count']:>7}{result['errors']:>6}{result['throughput_per_second'] or 0:>10.1f}"
+              f"{latency['p50'] or 0:>10.1f}{latency['p95'] or 0:>10.1f}{latency['p99'] or 0:>10.1f}")
+    print(f"Picco di memoria: {report['memory']['peak_rss_mb']} MB. Risultati in {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@
 # Percorsi cartelle
 DB_PATH = "./BDD"
 UPLOAD_FOLDER = "./images_to_process"
-RESULTS_FOLDER = "./results"
 
 # Impostazioni per la coda di lavori (Redis)
 REDIS_HOST = "localhost"
@@ -11,4 +10,78 @@ REDIS_PORT = 6379
 REDIS_QUEUE_NAME = "image_queue"
 
 # Impostazioni per ridurre le immagini
-MAX_IMAGE_SIZE = (1500, 1500)
\ No newline at end of file
+MAX_IMAGE_SIZE = (1500, 1500)
+
+# Indice degli embedding della galleria (vedi face_index.py)
+FACE_INDEX_PATH = "./face_index.npz"
+FACE_MODEL_NAME = "VGG-Face"
+FACE_DETECTOR_BACKEND = "opencv"
+FACE_DISTANCE_METRIC = "cosine" # 'cosine' o 'euclidean_l2'
+FACE_DISTANCE_THRESHOLD = None # None = soglia predefinita di DeepFace per modello e metrica
+FACE_INDEX_RESCAN_SECONDS = 10 # intervallo minimo tra due scansioni di DB_PATH
+FACE_INDEX_BACKEND = "exact" # 'exact' o 'ivf' (approssimato, per gallerie molto grandi)
+FACE_IVF_NLIST = None # numero di liste IVF (None = 4 * sqrt(volti))
+FACE_IVF_NPROBE = 32 # liste visitate per ricerca: più alto = recall migliore, ricerca più lenta
+FACE_IVF_MIN_TRAIN = 10000 # sotto questo numero di volti la ricerca resta esatta
+
+# Eventi (album): ogni evento ha la propria galleria DeepFace e il proprio indice, e un caricamento
+# viene confrontato solo con la galleria del suo evento (?event=... su /upload e /upload/batch).
+# L'evento predefinito usa DB_PATH e FACE_INDEX_PATH, gli altri EVENTS_DIR/<evento>/gallery e EVENTS_DIR/<evento>/face_index.npz
+DEFAULT_EVENT = "default"
+EVENTS_DIR = "./events"
+EVENT_INDEX_CACHE_SIZE = 8 # indici di altri eventi tenuti in memoria dal worker (i meno usati vengono scaricati)
+
+# Micro-batching del worker: lavori analizzati insieme e attesa massima per riempire il gruppo
+WORKER_BATCH_SIZE = 8
+WORKER_BATCH_WAIT_MS = 50
+
+# Processi worker (worker.py --concurrency N) e supervisore
+WORKER_CONCURRENCY = 1
+WORKER_POLL_SECONDS = 1 # attesa massima di BLPOP prima di ricontrollare la richiesta di arresto
+WORKER_SHUTDOWN_TIMEOUT = 60 # secondi concessi ai figli per finire i lavori in corso
+WORKER_RESTART_BACKOFF_SECONDS = 5
+WORKER_REPORT_SECONDS = 60 # intervallo dei log con lavori e latenze per figlio
+
+# Backend della coda dei lavori: 'list' (RPUSH/BLPOP) o 'stream' (Redis Streams con consumer group)
+QUEUE_BACKEND = "list"
+REDIS_STREAM_NAME = "image_stream"
+REDIS_STREAM_GROUP = "workers"
+REDIS_DEAD_LETTER_STREAM = "image_stream:dead"
+STREAM_VISIBILITY_TIMEOUT = 300 # secondi dopo i quali un lavoro non confermato può essere ripreso da un altro worker
+STREAM_MAX_DELIVERIES = 3 # consegne massime prima del dead-letter
+STREAM_MAXLEN = 100000 # lunghezza massima (approssimata) degli stream
+
+# Archivio dei risultati (SQLite in WAL), interrogabile da uploader.py
+RESULTS_DB_PATH = "./results.db"
+RESULTS_RETENTION_SECONDS = 7 * 24 * 3600 # i risultati più vecchi vengono eliminati
+RESULTS_PURGE_INTERVAL = 3600
+RESULT_MAX_WAIT_SECONDS = 30 # attesa massima del long-polling di /result e /results
+RESULTS_MAX_BATCH = 1000 # job_id massimi per richiesta a /results
+
+# Deduplicazione dei caricamenti: un file identico byte per byte a uno già
+# accodato (e non fallito) restituisce il job_id esistente invece di essere rianalizzato
+DEDUP_UPLOADS = True
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Caricamento a gruppi (/upload/batch): più file multipart o un archivio ZIP/TAR
+BATCH_MAX_FILES = 5000 # file massimi per richiesta
+ARCHIVE_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp') # file degli archivi considerati immagini
+ARCHIVE_SPOOL_MAX_MEMORY = 8 * 1024 * 1024 # oltre questa dimensione uno ZIP ricevuto in streaming (corpo grezzo o multipart) viene appoggiato su disco
+
+# Corsie di priorità della coda e pesi del round robin con cui il worker le svuota.
+# La prima corsia usa i nomi storici (REDIS_QUEUE_NAME / REDIS_STREAM_NAME), le altre vi aggiungono ':<corsia>'
+QUEUE_LANES = {'interactive': 4, 'bulk': 1}
+UPLOAD_LANE = 'interactive' # corsia predefinita di /upload
+BATCH_UPLOAD_LANE = 'bulk' # corsia predefinita di /upload/batch
+
+# Controllo di ammissione dell'uploader: oltre questi limiti risponde 429 con Retry-After
+QUEUE_MAX_DEPTH = {'interactive': 1000, 'bulk': 50000} # lavori in attesa per corsia
+RETRY_AFTER_DEFAULT_SECONDS = 30 # quando il ritmo dei worker non è noto (es. nessun worker attivo)
+RETRY_AFTER_MAX_SECONDS = 3600
+DRAIN_RATE_BUCKET_SECONDS = 10 # il ritmo di smaltimento è misurato su DRAIN_RATE_BUCKETS intervalli di questa durata
+DRAIN_RATE_BUCKETS = 6
+
+# Metriche Prometheus (GET /metrics): l'uploader le espone con Flask, il worker su questa porta (None = disattivate)
+WORKER_METRICS_PORT = 9100
+WORKER_METRICS_PUSH_SECONDS = 5 # in prefork, intervallo minimo con cui i figli inviano le metriche al supervisore
+METRICS_TOKEN = None # se impostato, /metrics dell'uploader richiede "Authorization: Bearer <token>"
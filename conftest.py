@@ -0,0 +1,43 @@
+# conftest.py
+#
+# Test di uploader, worker e moduli collegati. Come benchmark_worker.py, i
+# percorsi e la coda vengono impostati prima di importare i moduli: database
+# SQLite e cartelle in una directory temporanea, Redis simulato in memoria.
+# appmetaproos/ ha moduli con gli stessi nomi (config, database, metrics):
+# i suoi test si lanciano dalla sua cartella.
+
+import os
+import tempfile
+
+import pytest
+
+import config
+
+collect_ignore = ['appmetaproos']
+
+_workdir = tempfile.mkdtemp(prefix='tests-')
+config.UPLOAD_FOLDER = os.path.join(_workdir, 'images_to_process')
+config.DB_PATH = os.path.join(_workdir, 'gallery')
+config.RESULTS_DB_PATH = os.path.join(_workdir, 'results.db')
+config.FACE_INDEX_PATH = os.path.join(_workdir, 'face_index.npz')
+config.EVENTS_DIR = os.path.join(_workdir, 'events')
+config.QUEUE_BACKEND = 'list'
+config.WORKER_METRICS_PORT = None
+os.makedirs(config.UPLOAD_FOLDER)
+os.makedirs(config.DB_PATH)
+
+
+@pytest.fixture
+def fake_redis():
+    from benchmark_worker import FakeRedis
+    return FakeRedis()
+
+
+@pytest.fixture
+def uploader_client(fake_redis, tmp_path, monkeypatch):
+    """Client di test dell'uploader con una coda vuota e una cartella di caricamento propria."""
+    import uploader
+    from job_queue import create_queue
+    monkeypatch.setattr(uploader, 'job_queue', create_queue(fake_redis))
+    monkeypatch.setitem(uploader.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    return uploader.app.test_client()
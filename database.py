@@ -1,47 +1,166 @@
+import os
+import random
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from metrics import OPERATION_SECONDS, count_error
 
 DATABASE_NAME = 'faces.db' # O 'faces.dbf' se preferisci quel nome
 
-def get_db_connection():
-    """Crea una connessione al database."""
-    conn = sqlite3.connect(DATABASE_NAME)
+# Quanto a lungo SQLite attende un lock prima di restituire "database is locked" (ms)
+BUSY_TIMEOUT_MS = 5000
+# Tentativi aggiuntivi (con backoff esponenziale) quando il database resta occupato
+BUSY_RETRIES = 5
+BUSY_BACKOFF_SECONDS = 0.05
+# Numero massimo di parametri per query: SQLite < 3.32 ne accetta al massimo 999
+MAX_QUERY_PARAMS = 500
+
+_local = threading.local()
+
+
+def _open_connection(path=DATABASE_NAME):
+    """Apre e configura una connessione SQLite ottimizzata per molti lettori e scritture concorrenti."""
+    # isolation_level=None: le transazioni sono gestite esplicitamente con BEGIN IMMEDIATE
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000,
+                           isolation_level=None, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL: i lettori non bloccano lo scrittore (e viceversa) tra worker diversi
+    conn.execute("PRAGMA journal_mode=WAL")
+    # In WAL, NORMAL è sicuro contro la corruzione e evita un fsync per ogni commit
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000") # ~20MB di cache delle pagine
+    return conn
+
+
+def get_db_connection():
+    """
+    Restituisce la connessione del thread corrente, aprendola al primo uso.
+    Le connessioni sono riutilizzate tra le chiamate e riaperte dopo un fork
+    (worker di gunicorn), perché una connessione SQLite non va condivisa tra processi.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _open_connection()
+        _local.conn = conn
+        _local.pid = os.getpid()
     return conn
 
+
+def close_db_connection():
+    """Chiude la connessione del thread corrente (verrà riaperta al prossimo uso)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+def _is_busy_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def retry_on_busy(func):
+    """
+    Riprova la funzione se SQLite è ancora occupato dopo il busy_timeout,
+    con backoff esponenziale e un po' di jitter per non far ripartire
+    tutti i worker nello stesso istante. La durata complessiva (attese
+    comprese) finisce nella metrica operation_duration_seconds{component="db"}.
+    """
+    histogram = OPERATION_SECONDS.labels(component='db', operation=func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            for attempt in range(BUSY_RETRIES + 1):
+                try:
+                    return func(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if not _is_busy_error(e) or attempt == BUSY_RETRIES:
+                        raise
+                    time.sleep(BUSY_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random()))
+        except Exception as e:
+            count_error('db', func.__name__, e)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+@contextmanager
+def _write_transaction(conn):
+    """
+    Transazione di scrittura: BEGIN IMMEDIATE prende subito il lock di scrittura,
+    così un'altra scrittura concorrente attende il busy_timeout invece di
+    fallire a metà transazione quando prova a passare da lettura a scrittura.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+@retry_on_busy
 def init_db():
     """
     Inizializza il database creando la tabella 'photos'.
     Questa tabella lega un FaceId a un URL di un'immagine.
     """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS photos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            face_id TEXT NOT NULL,
-            image_url TEXT NOT NULL,
-            UNIQUE(face_id, image_url)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with _write_transaction(conn):
+        # L'indice creato da UNIQUE(face_id, image_url) inizia con face_id e contiene
+        # image_url: get_photos_by_face_ids lo usa come indice coprente, senza
+        # leggere la tabella. Un indice separato solo su face_id sarebbe ridondante
+        # (e raddoppierebbe il costo di ogni INSERT).
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS photos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                face_id TEXT NOT NULL,
+                image_url TEXT NOT NULL,
+                UNIQUE(face_id, image_url)
+            )
+        ''')
+    # Aggiorna le statistiche del planner sulle tabelle che ne hanno bisogno
+    conn.execute("PRAGMA optimize")
 
+@retry_on_busy
 def add_face_record(face_id, image_url):
     """Aggiunge un record che collega un face_id a un URL di un'immagine."""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO photos (face_id, image_url) VALUES (?, ?)",
+    with _write_transaction(conn):
+        # Ignora l'inserimento se la coppia face_id/image_url esiste già.
+        conn.execute(
+            "INSERT OR IGNORE INTO photos (face_id, image_url) VALUES (?, ?)",
             (face_id, image_url)
         )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        # Ignora l'inserimento se la coppia face_id/image_url esiste già.
-        pass
-    finally:
-        conn.close()
 
+@retry_on_busy
+def add_face_records(records):
+    """
+    Aggiunge più record (face_id, image_url) in una sola transazione,
+    ad esempio tutti i volti di una foto o di un intero lotto.
+    Le coppie già presenti vengono ignorate.
+    """
+    records = list(records)
+    if not records:
+        return
+
+    conn = get_db_connection()
+    with _write_transaction(conn):
+        conn.executemany(
+            "INSERT OR IGNORE INTO photos (face_id, image_url) VALUES (?, ?)",
+            records
+        )
+
+@retry_on_busy
 def get_photos_by_face_ids(face_ids):
     """
     Recupera tutti gli URL delle immagini associate a una lista di face_id.
@@ -50,15 +169,15 @@ def get_photos_by_face_ids(face_ids):
         return set()
 
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Prepara i '?' per la query IN
-    placeholders = ','.join('?' for _ in face_ids)
-    query = f"SELECT DISTINCT image_url FROM photos WHERE face_id IN ({placeholders})"
-    
-    cursor.execute(query, face_ids)
-    rows = cursor.fetchall()
-    conn.close()
-    
+    face_ids = list(face_ids)
+    urls = set()
+
+    # Le liste molto lunghe vengono divise per restare sotto il limite di parametri di SQLite
+    for start in range(0, len(face_ids), MAX_QUERY_PARAMS):
+        chunk = face_ids[start:start + MAX_QUERY_PARAMS]
+        placeholders = ','.join('?' for _ in chunk)
+        query = f"SELECT DISTINCT image_url FROM photos WHERE face_id IN ({placeholders})"
+        urls.update(row['image_url'] for row in conn.execute(query, chunk))
+
     # Restituisce un set di URL unici
-    return {row['image_url'] for row in rows}
+    return urls
@@ -0,0 +1,267 @@
+# face_index.py
+#
+# Indice residente degli embedding dei volti della galleria (config.DB_PATH).
+# Gli embedding normalizzati stanno in un'unica matrice NumPy (una riga per
+# volto) con accanto l'identità, cioè il percorso del file come lo riporta
+# DeepFace.find. Una ricerca è un solo prodotto matrice-vettore; le immagini
+# nuove o modificate nella galleria vengono aggiunte senza ricostruire tutto.
+# L'indice viene salvato su disco (.npz) e ricaricato all'avvio del worker.
+# La ricerca dei vicini è delegata a un backend (vedi ann.py): esatta oppure
+# approssimata (IVF) per gallerie molto grandi.
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from ann import ExactSearch
+
+# Estensioni considerate da DeepFace.find nella galleria
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Versione del formato del file salvato
+INDEX_FORMAT = 1
+
+
+def normalize_rows(vectors):
+    """Normalizza ogni riga a norma 1 (le righe nulle restano nulle)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def scan_gallery(db_path):
+    """Restituisce {identità: (mtime, dimensione)} per le immagini della galleria."""
+    files = {}
+    for root, _, filenames in os.walk(db_path):
+        for filename in filenames:
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (stat.st_mtime, stat.st_size)
+    return files
+
+
+class FaceIndex:
+    """
+    Matrice degli embedding normalizzati + tabella delle identità.
+    `embed_fn(percorso)` deve restituire una matrice (volti, dimensione) con gli
+    embedding dei volti trovati nell'immagine; di solito è
+    image_processor.compute_embeddings. `backend` è un backend di ann.py
+    (predefinito: ricerca esatta). Con persist=False l'indice non viene mai
+    salvato su disco (es. processi worker che non sono i proprietari del file).
+    """
+
+    def __init__(self, db_path, index_path, embed_fn, threshold,
+                 distance_metric='cosine', model_name='', rescan_seconds=10, backend=None, persist=True):
+        if distance_metric not in ('cosine', 'euclidean_l2'):
+            raise ValueError(f"Metrica non supportata dall'indice: {distance_metric}")
+        self.db_path = db_path
+        self.index_path = index_path
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.distance_metric = distance_metric
+        self.model_name = model_name
+        self.rescan_seconds = rescan_seconds
+        self.backend = backend or ExactSearch()
+        self.persist = persist
+
+        self._matrix = None     # capacità >= _size righe, cresce raddoppiando
+        self._size = 0
+        self._identities = []   # riga -> identità
+        self._files = {}        # identità -> [mtime, dimensione]
+        self._last_sync = 0.0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def embeddings(self):
+        return self._matrix[:self._size] if self._matrix is not None else np.empty((0, 0), np.float32)
+
+    # --- Persistenza ---
+
+    def load(self):
+        """Carica l'indice salvato, se esiste ed è stato creato con lo stesso modello."""
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with np.load(self.index_path, allow_pickle=False) as data, self._lock:
+                meta = json.loads(str(data['meta']))
+                if meta.get('format') != INDEX_FORMAT or meta.get('model_name') != self.model_name:
+                    logging.info(f"Indice {self.index_path} creato con un altro modello: verrà ricostruito")
+                    return False
+                embeddings = data['embeddings']
+                identities = data['identities'].tolist()
+                files = json.loads(str(data['files']))
+                self._set_matrix(embeddings)
+                self._identities = identities
+                self._files = files
+                self.backend.load_state(data, self.embeddings)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Impossibile leggere l'indice {self.index_path}: {e}")
+            return False
+        logging.info(f"Indice caricato: {self._size} volti da {len(self._files)} immagini")
+        return True
+
+    def save(self):
+        """
+        Salva l'indice su disco in modo atomico: file temporaneo con nome univoco
+        nella stessa cartella + rename, così più processi non scrivono mai nello stesso file.
+        """
+        if not self.persist:
+            return
+        with self._lock:
+            meta = {'format': INDEX_FORMAT, 'model_name': self.model_name}
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.index_path) + '.',
+                                            suffix='.tmp', dir=os.path.dirname(self.index_path) or '.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(
+                        f,
+                        embeddings=self.embeddings,
+                        identities=np.array(self._identities, dtype=str),
+                        files=np.array(json.dumps(self._files)),
+                        meta=np.array(json.dumps(meta)),
+                        **self.backend.state()
+                    )
+                os.replace(tmp_path, self.index_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    # --- Aggiornamento ---
+
+    def _set_matrix(self, vectors):
+        self._matrix = None
+        self._size = 0
+        if len(vectors):
+            self._grow(vectors)
+
+    def _append(self, vectors):
+        first_row = self._size
+        self._grow(vectors)
+        self.backend.add(self.embeddings, first_row)
+
+    def _grow(self, vectors):
+        needed = self._size + len(vectors)
+        if self._matrix is None:
+            self._matrix = np.empty((max(needed, 64), vectors.shape[1]), dtype=np.float32)
+        elif vectors.shape[1] != self._matrix.shape[1]:
+            raise ValueError(f"Dimensione embedding {vectors.shape[1]} diversa da quella dell'indice {self._matrix.shape[1]}")
+        elif needed > len(self._matrix):
+            grown = np.empty((max(needed, 2 * len(self._matrix)), self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+        self._matrix[self._size:needed] = vectors
+        self._size = needed
+
+    def add_embeddings(self, identities, vectors):
+        """Aggiunge righe già calcolate: identities[i] è l'identità della riga vectors[i]."""
+        if not len(vectors):
+            return
+        with self._lock:
+            self._append(normalize_rows(vectors))
+            self._identities.extend(identities)
+
+    def add_image(self, path, stat=None):
+        """Calcola gli embedding di un'immagine della galleria e li aggiunge all'indice."""
+        if stat is None:
+            st = os.stat(path)
+            stat = (st.st_mtime, st.st_size)
+        vectors = self.embed_fn(path)
+        with self._lock:
+            if path in self._files:
+                self.remove_images([path])
+            self.add_embeddings([path] * len(vectors), vectors)
+            # Anche le immagini senza volti vengono registrate, per non rianalizzarle a ogni scansione
+            self._files[path] = list(stat)
+        return len(vectors)
+
+    def remove_images(self, paths):
+        """Toglie dall'indice tutte le righe delle immagini indicate."""
+        paths = set(paths)
+        with self._lock:
+            keep = [row for row, identity in enumerate(self._identities) if identity not in paths]
+            if len(keep) != self._size:
+                self._set_matrix(self._matrix[keep])
+                self.backend.remove(keep)
+                self._identities = [self._identities[row] for row in keep]
+            for path in paths:
+                self._files.pop(path, None)
+
+    def sync(self):
+        """
+        Allinea l'indice al contenuto della galleria: aggiunge le immagini nuove,
+        ricalcola quelle modificate e toglie quelle cancellate.
+        Restituisce (aggiunte, rimosse).
+        """
+        current = scan_gallery(self.db_path)
+        with self._lock:
+            removed = [path for path in self._files if path not in current]
+            changed = [path for path, stat in current.items()
+                       if path not in self._files or tuple(self._files[path]) != stat]
+            if removed:
+                self.remove_images(removed)
+            added = 0
+            for path in changed:
+                try:
+                    self.add_image(path, current[path])
+                    added += 1
+                except Exception as e:
+                    logging.error(f"Impossibile indicizzare {path}: {e}")
+            self._last_sync = time.monotonic()
+            if added or removed:
+                self.save()
+                logging.info(f"Indice aggiornato: +{added} immagini, -{len(removed)} immagini, {self._size} volti")
+        return added, len(removed)
+
+    def maybe_sync(self):
+        """Esegue sync() se dall'ultima scansione sono passati almeno rescan_seconds."""
+        if time.monotonic() - self._last_sync >= self.rescan_seconds:
+            return self.sync()
+        return 0, 0
+
+    # --- Ricerca ---
+
+    def _to_distance(self, similarities):
+        if self.distance_metric == 'cosine':
+            return 1.0 - similarities
+        return np.sqrt(np.maximum(2.0 - 2.0 * similarities, 0.0))
+
+    def search(self, query_embeddings):
+        """
+        Restituisce [(identità, distanza), ...] delle immagini della galleria che
+        contengono almeno un volto entro la soglia da uno dei volti della query,
+        ordinate dalla più vicina e senza ripetizioni.
+        """
+        with self._lock:
+            if self._size == 0 or len(query_embeddings) == 0:
+                return []
+            # Per ogni volto della galleria il backend restituisce la similarità con il volto della query più vicino
+            rows, similarities = self.backend.search(normalize_rows(query_embeddings), self.embeddings)
+            distances = self._to_distance(similarities)
+            within = distances <= self.threshold
+            rows, distances = rows[within], distances[within]
+            order = np.argsort(distances, kind='stable')
+
+            results = []
+            seen = set()
+            for row, distance in zip(rows[order], distances[order]):
+                identity = self._identities[row]
+                if identity not in seen:
+                    seen.add(identity)
+                    results.append((identity, float(distance)))
+            return results
@@ -1,13 +1,21 @@
 # image_processor.py
 
 import os
+import threading
+import time
+from collections import OrderedDict
 from deepface import DeepFace
 from PIL import Image
+import numpy as np
 import config
 import logging
+from face_index import FaceIndex
+from ann import create_search_backend
+from metrics import count_error, track, tracked
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+@tracked('image', 'resize')
 def preprocess_image(image_path):
     """Ridimensiona l'immagine per non crashare."""
     try:
@@ -20,33 +28,253 @@ def preprocess_image(image_path):
         logging.info(f"Immagine ridimensionata: {image_path}")
         return True
     except Exception as e:
+        count_error('image', 'resize', e)
         logging.error(f"Errore nel pre-processing di {image_path}: {e}")
         return False
 
-def find_faces_in_image(image_path):
-    """Analizza l'immagine e trova le corrispondenze."""
-    if not os.path.exists(image_path):
-        logging.error(f"File non trovato: {image_path}")
-        return None
+_embedding_model = None
+
+def get_embedding_model():
+    """Modello di riconoscimento, caricato una sola volta: (modello Keras, dimensione input (alt, larg))."""
+    global _embedding_model
+    if _embedding_model is None:
+        model = DeepFace.build_model(config.FACE_MODEL_NAME)
+        # Le versioni recenti di DeepFace restituiscono un client che contiene il modello Keras
+        keras_model = getattr(model, 'model', model)
+        height, width = keras_model.input_shape[1:3]
+        _embedding_model = (keras_model, (height, width))
+    return _embedding_model
+
+@tracked('deepface', 'detect_faces')
+def detect_faces(image):
+    """Volti allineati trovati nell'immagine (percorso o array), in RGB."""
+    faces = DeepFace.extract_faces(
+        img_path=image,
+        detector_backend=config.FACE_DETECTOR_BACKEND,
+        enforce_detection=False,
+        align=True
+    )
+    return [face['face'] for face in faces]
+
+def prepare_face(face, size):
+    """Prepara un volto come DeepFace.represent: BGR, ridimensionato con padding a `size`, valori 0-1."""
+    face = np.asarray(face, dtype=np.float32)[:, :, ::-1]
+    if face.max() > 1:
+        face = face / 255
+    height, width = size
+    scale = min(height / face.shape[0], width / face.shape[1])
+    new_size = (max(1, int(face.shape[1] * scale)), max(1, int(face.shape[0] * scale)))
+    resized = Image.fromarray((face * 255).astype(np.uint8)).resize(new_size, Image.BILINEAR)
+    resized = np.asarray(resized, dtype=np.float32) / 255
+
+    prepared = np.zeros((height, width, 3), dtype=np.float32)
+    top = (height - resized.shape[0]) // 2
+    left = (width - resized.shape[1]) // 2
+    prepared[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return prepared
+
+def compute_embeddings_batch(images, first_face_only=False):
+    """
+    Embedding dei volti di più immagini con un solo passaggio nel modello:
+    la rilevazione resta per immagine, poi tutti i volti vengono preparati e
+    passati insieme alla rete. Restituisce, nello stesso ordine, una matrice
+    (volti, dimensione) per ogni immagine, oppure None se la rilevazione è fallita.
+    Con first_face_only si usa solo il primo volto rilevato in ogni immagine.
+    """
+    model, size = get_embedding_model()
+
+    face_counts = []
+    batch = []
+    for image in images:
+        try:
+            faces = detect_faces(image)
+        except Exception as e:
+            logging.error(f"Errore nella rilevazione dei volti in {image}: {e}")
+            face_counts.append(None)
+            continue
+        if first_face_only:
+            faces = faces[:1]
+        face_counts.append(len(faces))
+        batch.extend(prepare_face(face, size) for face in faces)
+
+    vectors = None
+    if batch:
+        with track('deepface', 'embed_batch'):
+            vectors = np.asarray(model.predict_on_batch(np.stack(batch)), dtype=np.float32)
 
-    if not preprocess_image(image_path):
-        return None
+    results = []
+    offset = 0
+    for count in face_counts:
+        if count is None:
+            results.append(None)
+        elif count == 0:
+            results.append(np.empty((0, 0), dtype=np.float32))
+        else:
+            results.append(vectors[offset:offset + count])
+            offset += count
+    return results
 
-    logging.info(f"Avvio analisi per: {image_path}")
+def compute_embeddings(image_path):
+    """Embedding di tutti i volti dell'immagine, come matrice (volti, dimensione)."""
+    vectors = compute_embeddings_batch([image_path])[0]
+    if vectors is None:
+        raise ValueError(f"Rilevazione dei volti fallita per {image_path}")
+    return vectors
+
+def warm_up():
+    """Carica modello e detector e li esegue una volta, così il primo lavoro non paga il caricamento."""
+    started = time.perf_counter()
+    get_embedding_model()
+    compute_embeddings_batch([np.full((224, 224, 3), 128, dtype=np.uint8)])
+    logging.info(f"Modello {config.FACE_MODEL_NAME} e detector {config.FACE_DETECTOR_BACKEND} pronti in {time.perf_counter() - started:.1f}s")
+
+def default_threshold():
+    """Soglia di distanza usata da DeepFace.find per il modello e la metrica configurati."""
+    if config.FACE_DISTANCE_THRESHOLD is not None:
+        return config.FACE_DISTANCE_THRESHOLD
     try:
-        result_dfs = DeepFace.find(
-            img_path=image_path,
-            db_path=config.DB_PATH,
-            enforce_detection=False
+        from deepface.modules.verification import find_threshold
+    except ImportError:
+        from deepface.commons.distance import findThreshold as find_threshold
+    return find_threshold(config.FACE_MODEL_NAME, config.FACE_DISTANCE_METRIC)
+
+def create_backend():
+    """Backend di ricerca dei vicini scelto in config.FACE_INDEX_BACKEND."""
+    if config.FACE_INDEX_BACKEND == 'ivf':
+        return create_search_backend(
+            'ivf',
+            nlist=config.FACE_IVF_NLIST,
+            nprobe=config.FACE_IVF_NPROBE,
+            min_train=config.FACE_IVF_MIN_TRAIN
         )
-        
-        if not result_dfs or result_dfs[0].empty:
+    return create_search_backend(config.FACE_INDEX_BACKEND)
+
+_face_index = None
+# False nei figli prefork diversi dal primo: solo un processo salva gli indici su disco
+_persist_indexes = True
+# Indici degli altri eventi, dal meno al più usato di recente (al massimo EVENT_INDEX_CACHE_SIZE)
+_event_indexes = OrderedDict()
+_event_indexes_lock = threading.Lock()
+
+def event_paths(event=None):
+    """(galleria, file dell'indice) dell'evento: DB_PATH e FACE_INDEX_PATH per quello predefinito."""
+    if not event or event == config.DEFAULT_EVENT:
+        return config.DB_PATH, config.FACE_INDEX_PATH
+    event_dir = os.path.join(config.EVENTS_DIR, event)
+    return os.path.join(event_dir, 'gallery'), os.path.join(event_dir, 'face_index.npz')
+
+def _load_face_index(event):
+    db_path, index_path = event_paths(event)
+    os.makedirs(db_path, exist_ok=True)
+    index = FaceIndex(
+        db_path=db_path,
+        index_path=index_path,
+        embed_fn=compute_embeddings,
+        threshold=default_threshold(),
+        distance_metric=config.FACE_DISTANCE_METRIC,
+        model_name=config.FACE_MODEL_NAME,
+        rescan_seconds=config.FACE_INDEX_RESCAN_SECONDS,
+        backend=create_backend(),
+        persist=_persist_indexes
+    )
+    index.load()
+    index.sync()
+    return index
+
+def set_index_persistence(enabled):
+    """
+    Abilita o disabilita il salvataggio su disco degli indici del processo (già
+    caricati e futuri). In prefork solo un figlio li salva: gli altri li
+    aggiornano in memoria senza riscrivere lo stesso file.
+    """
+    global _persist_indexes
+    _persist_indexes = enabled
+    with _event_indexes_lock:
+        indexes = [_face_index, *_event_indexes.values()]
+    for index in indexes:
+        if index is not None:
+            index.persist = enabled
+
+def get_face_index(event=None):
+    """
+    Indice della galleria dell'evento: caricato dal disco e allineato alla sua
+    galleria al primo uso. Quello dell'evento predefinito resta sempre in memoria,
+    degli altri si tengono solo i EVENT_INDEX_CACHE_SIZE usati più di recente.
+    """
+    global _face_index
+    if not event or event == config.DEFAULT_EVENT:
+        if _face_index is None:
+            _face_index = _load_face_index(None)
+        return _face_index
+
+    with _event_indexes_lock:
+        index = _event_indexes.get(event)
+        if index is None:
+            index = _load_face_index(event)
+            _event_indexes[event] = index
+            while len(_event_indexes) > config.EVENT_INDEX_CACHE_SIZE:
+                evicted, _ = _event_indexes.popitem(last=False)
+                logging.info(f"Indice dell'evento {evicted} scaricato dalla memoria")
+        _event_indexes.move_to_end(event)
+        return index
+
+def evict_face_index(event):
+    """Scarica dalla memoria l'indice di un evento (es. archiviato). Restituisce True se era caricato."""
+    with _event_indexes_lock:
+        return _event_indexes.pop(event, None) is not None
+
+def find_faces_in_images(image_paths, index=None):
+    """
+    Analizza un gruppo di immagini con un solo passaggio nel modello.
+    Restituisce, nello stesso ordine, le corrispondenze di ogni immagine
+    (None se l'analisi di quell'immagine è fallita).
+    """
+    results = [None] * len(image_paths)
+    ready = []
+    for position, image_path in enumerate(image_paths):
+        if not os.path.exists(image_path):
+            logging.error(f"File non trovato: {image_path}")
+        elif preprocess_image(image_path):
+            ready.append(position)
+    if not ready:
+        return results
+
+    logging.info(f"Avvio analisi per {len(ready)} immagini: {[image_paths[p] for p in ready]}")
+    try:
+        if index is None:
+            index = get_face_index()
+        # Le immagini aggiunte alla galleria nel frattempo vengono indicizzate qui
+        with track('index', 'sync'):
+            index.maybe_sync()
+
+        # DeepFace serve solo per gli embedding delle query; il confronto lo fa l'indice.
+        # Come con DeepFace.find (result_dfs[0]) la query è il primo volto rilevato nell'immagine
+        embeddings = compute_embeddings_batch([image_paths[p] for p in ready], first_face_only=True)
+    except Exception as e:
+        logging.error(f"Errore DeepFace sul gruppo di {len(ready)} immagini: {e}")
+        return results
+
+    for position, query in zip(ready, embeddings):
+        image_path = image_paths[position]
+        if query is None:
+            continue
+        try:
+            with track('index', 'search'):
+                found = index.search(query)
+        except Exception as e:
+            logging.error(f"Errore nella ricerca per {image_path}: {e}")
+            continue
+
+        if not found:
             logging.info(f"Nessuna corrispondenza per {image_path}")
-            return []
+            results[position] = []
+            continue
 
-        matches = result_dfs[0]['identity'].tolist()
+        matches = [identity for identity, _ in found]
         logging.info(f"Corrispondenze per {image_path}: {matches}")
-        return matches
-    except Exception as e:
-        logging.error(f"Errore DeepFace su {image_path}: {e}")
-        return None
\ No newline at end of file
+        results[position] = matches
+    return results
+
+def find_faces_in_image(image_path, index=None):
+    """Analizza l'immagine e trova le corrispondenze."""
+    return find_faces_in_images([image_path], index)[0]
\ No newline at end of file
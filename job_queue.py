@@ -0,0 +1,514 @@
+# job_queue.py
+#
+# Coda dei lavori tra uploader e worker, con due backend selezionabili da
+# config.QUEUE_BACKEND:
+# - 'list': lista Redis (RPUSH/BLPOP). Semplice, ma un lavoro prelevato da un
+#   worker che poi muore è perso.
+# - 'stream': Redis Stream con consumer group. Ogni lavoro resta "pending"
+#   finché il worker non lo conferma (XACK); se non viene confermato entro il
+#   visibility timeout un altro worker lo riprende (XAUTOCLAIM). Dopo
+#   STREAM_MAX_DELIVERIES consegne il lavoro finisce nello stream dead-letter.
+#
+# Sopra il backend, LaneQueue divide i lavori in corsie di priorità
+# (config.QUEUE_LANES, es. 'interactive' e 'bulk'), ognuna con la propria lista
+# o il proprio stream, che il worker svuota con un round robin pesato: una
+# grossa importazione nella corsia 'bulk' non fa aspettare i caricamenti interattivi.
+
+import json
+import logging
+import math
+import os
+import socket
+import time
+from dataclasses import dataclass
+
+import config
+from metrics import Gauge, track
+
+# Ogni quanto (al massimo) eliminare dal gruppo i consumer inattivi e senza lavori
+CONSUMER_PRUNE_INTERVAL = 300
+# Inattività oltre la quale un consumer senza lavori pending viene eliminato
+CONSUMER_PRUNE_IDLE_MS = 3600 * 1000
+
+QUEUE_DEPTH = Gauge('queue_depth', "Lavori in attesa per corsia", ['lane'])
+DRAIN_RATE = Gauge('queue_drain_rate_jobs_per_second', "Lavori completati al secondo da tutti i worker")
+
+
+def encode_job(job_id, path, event=None):
+    """Contenuto di un lavoro in coda: JSON con job_id, percorso dell'immagine ed evento."""
+    return json.dumps({'job_id': job_id, 'path': path, 'event': event or config.DEFAULT_EVENT})
+
+
+def decode_job(payload):
+    """
+    Restituisce (job_id, percorso, evento) di un lavoro. I lavori accodati prima
+    dei job_id contengono solo il percorso: come job_id si usa il nome del file.
+    Quelli accodati prima degli eventi appartengono all'evento predefinito.
+    """
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return os.path.basename(payload), payload, config.DEFAULT_EVENT
+    return data['job_id'], data['path'], data.get('event') or config.DEFAULT_EVENT
+
+
+@dataclass
+class Job:
+    payload: str
+    id: str = None       # ID dell'entry nello stream (None per la lista)
+    deliveries: int = 1  # quante volte il lavoro è stato consegnato a un worker
+    lane: str = None     # corsia di priorità da cui è stato prelevato
+
+
+class ListQueue:
+    """Coda su lista Redis: RPUSH per accodare, BLPOP/LPOP per prelevare."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def push(self, payload):
+        self.client.rpush(self.name, payload)
+
+    def push_many(self, payloads):
+        """Accoda più lavori con un solo RPUSH."""
+        if payloads:
+            self.client.rpush(self.name, *payloads)
+
+    def fetch(self, max_jobs, wait_seconds, block_seconds):
+        """
+        Attende un lavoro (al massimo block_seconds), poi raccoglie quelli già in
+        coda fino a max_jobs, aspettando al massimo wait_seconds per riempire il gruppo.
+        """
+        item = self.client.blpop(self.name, timeout=block_seconds)
+        if item is None:
+            return []
+        batch = [item[1]]
+        deadline = time.monotonic() + wait_seconds
+        while len(batch) < max_jobs:
+            # LPOP con count preleva in un colpo solo tutto ciò che è già in coda
+            batch.extend(self.client.lpop(self.name, max_jobs - len(batch)) or [])
+            remaining = deadline - time.monotonic()
+            if len(batch) >= max_jobs or remaining <= 0:
+                break
+            item = self.client.blpop(self.name, timeout=max(remaining, 0.001))
+            if item is None:
+                break
+            batch.append(item[1])
+        return [Job(payload.decode('utf-8')) for payload in batch]
+
+    def poll(self, max_jobs):
+        """Preleva fino a max_jobs lavori già in coda, senza attendere."""
+        return [Job(payload.decode('utf-8')) for payload in self.client.lpop(self.name, max_jobs) or []]
+
+    def depth(self):
+        """Lavori in attesa di un worker."""
+        return self.client.llen(self.name)
+
+    def ack(self, jobs):
+        # Con la lista il lavoro è già stato rimosso al prelievo
+        pass
+
+    def fail(self, job, error):
+        """Con la lista non ci sono nuovi tentativi: il fallimento è sempre definitivo."""
+        logging.warning(f"Lavoro fallito (coda a lista, nessun nuovo tentativo): {job.payload}: {error}")
+        return True
+
+    def stats(self):
+        return {'backend': 'list', 'length': self.client.llen(self.name)}
+
+
+class StreamQueue:
+    """Coda su Redis Stream con consumer group, conferme esplicite e dead-letter."""
+
+    def __init__(self, client, stream, group, consumer=None, dead_letter_stream=None,
+                 visibility_timeout=300, max_deliveries=3, maxlen=None):
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.dead_letter_stream = dead_letter_stream or f"{stream}:dead"
+        self.visibility_timeout_ms = int(visibility_timeout * 1000)
+        self.max_deliveries = max_deliveries
+        self.maxlen = maxlen
+        self._claim_cursor = '0-0'
+        self._last_prune = 0.0
+        self._group_ready = False
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except Exception as e:
+            # Il gruppo esiste già (creato da un altro worker o da un avvio precedente)
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = True
+
+    def push(self, payload):
+        self.client.xadd(self.stream, {'payload': payload}, maxlen=self.maxlen, approximate=True)
+
+    def push_many(self, payloads):
+        """Accoda più lavori con un solo round trip: gli XADD viaggiano in pipeline."""
+        if not payloads:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for payload in payloads:
+            pipe.xadd(self.stream, {'payload': payload}, maxlen=self.maxlen, approximate=True)
+        pipe.execute()
+
+    def _dead_letter(self, job, error):
+        self.client.xadd(
+            self.dead_letter_stream,
+            {'payload': job.payload, 'original_id': job.id, 'deliveries': job.deliveries,
+             'error': str(error), 'failed_at': int(time.time())},
+            maxlen=self.maxlen, approximate=True
+        )
+        self.client.xack(self.stream, self.group, job.id)
+        logging.error(f"Lavoro {job.id} spostato in {self.dead_letter_stream} dopo {job.deliveries} consegne: {error}")
+
+    def _reclaim(self, count):
+        """Riprende i lavori pending di altri consumer inattivi da oltre il visibility timeout."""
+        response = self.client.xautoclaim(
+            self.stream, self.group, self.consumer,
+            min_idle_time=self.visibility_timeout_ms, start_id=self._claim_cursor, count=count
+        )
+        self._claim_cursor, entries = response[0], response[1]
+        if isinstance(self._claim_cursor, bytes):
+            self._claim_cursor = self._claim_cursor.decode()
+
+        jobs = []
+        for entry_id, fields in entries:
+            entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+            if not fields:
+                # Entry eliminata dallo stream (MAXLEN) mentre era pending
+                self.client.xack(self.stream, self.group, entry_id)
+                continue
+            pending = self.client.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+            deliveries = pending[0]['times_delivered'] if pending else 1
+            job = Job(fields[b'payload'].decode('utf-8'), entry_id, deliveries)
+            if deliveries > self.max_deliveries:
+                self._dead_letter(job, "numero massimo di consegne superato")
+                continue
+            logging.warning(f"Lavoro {entry_id} ripreso da un consumer inattivo (consegna {deliveries})")
+            jobs.append(job)
+        return jobs
+
+    def _read(self, count, block_ms=None):
+        # block_ms None: lettura senza attesa
+        response = self.client.xreadgroup(
+            self.group, self.consumer, {self.stream: '>'}, count=count, block=block_ms
+        )
+        jobs = []
+        for _, entries in response or []:
+            for entry_id, fields in entries:
+                entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+                jobs.append(Job(fields[b'payload'].decode('utf-8'), entry_id))
+        return jobs
+
+    def _prune_consumers(self):
+        """Elimina dal gruppo i consumer (es. worker terminati) inattivi e senza lavori pending."""
+        if time.monotonic() - self._last_prune < CONSUMER_PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+        for consumer in self.client.xinfo_consumers(self.stream, self.group):
+            name = consumer['name'].decode() if isinstance(consumer['name'], bytes) else consumer['name']
+            if name != self.consumer and consumer['pending'] == 0 and consumer['idle'] > CONSUMER_PRUNE_IDLE_MS:
+                self.client.xgroup_delconsumer(self.stream, self.group, name)
+
+    def _reclaim_abandoned(self, max_jobs):
+        self._ensure_group()
+        try:
+            self._prune_consumers()
+            return self._reclaim(max_jobs)
+        except Exception as e:
+            # Stream o gruppo cancellati nel frattempo: verranno ricreati al prossimo giro
+            if 'NOGROUP' in str(e):
+                self._group_ready = False
+            raise
+
+    def fetch(self, max_jobs, wait_seconds, block_seconds):
+        """
+        Prima riprende i lavori abbandonati da altri consumer, poi legge quelli
+        nuovi: attende al massimo block_seconds il primo e wait_seconds per
+        riempire il gruppo fino a max_jobs.
+        """
+        batch = self._reclaim_abandoned(max_jobs)
+        if not batch:
+            batch = self._read(max_jobs, max(1, int(block_seconds * 1000)))
+            if not batch:
+                return []
+        deadline = time.monotonic() + wait_seconds
+        while len(batch) < max_jobs:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            jobs = self._read(max_jobs - len(batch), max(1, int(remaining * 1000)))
+            if not jobs:
+                break
+            batch.extend(jobs)
+        return batch
+
+    def poll(self, max_jobs):
+        """Lavori abbandonati da riprendere e nuovi lavori già nello stream, senza attendere."""
+        batch = self._reclaim_abandoned(max_jobs)
+        if len(batch) < max_jobs:
+            batch.extend(self._read(max_jobs - len(batch)))
+        return batch
+
+    def _group_info(self):
+        return next((g for g in self.client.xinfo_groups(self.stream)
+                     if g['name'] in (self.group, self.group.encode())), {})
+
+    def depth(self):
+        """
+        Lavori non ancora completati: quelli mai consegnati (lag del gruppo)
+        più quelli pending. La lunghezza dello stream non basta, perché
+        contiene anche le entry già confermate fino a MAXLEN.
+        """
+        self._ensure_group()
+        group = self._group_info()
+        lag = group.get('lag')
+        if lag is None:
+            # Redis < 7 non calcola il lag: stima prudente con la lunghezza dello stream
+            return self.client.xlen(self.stream)
+        return lag + group.get('pending', 0)
+
+    def ack(self, jobs):
+        ids = [job.id for job in jobs]
+        if ids:
+            self.client.xack(self.stream, self.group, *ids)
+
+    def fail(self, job, error):
+        """
+        Un lavoro fallito non viene confermato: dopo il visibility timeout verrà
+        ripreso; all'ultima consegna consentita finisce invece nel dead-letter.
+        Restituisce True se il fallimento è definitivo.
+        """
+        if job.deliveries >= self.max_deliveries:
+            self._dead_letter(job, error)
+            return True
+        logging.warning(f"Lavoro {job.id} fallito (consegna {job.deliveries}/{self.max_deliveries}), "
+                        f"verrà ritentato: {error}")
+        return False
+
+    def stats(self):
+        """Lunghezza dello stream, lavori pending e lag del gruppo, stato di ogni consumer."""
+        self._ensure_group()
+        group = self._group_info()
+        consumers = [
+            {'name': c['name'].decode() if isinstance(c['name'], bytes) else c['name'],
+             'pending': c['pending'], 'idle_ms': c['idle']}
+            for c in self.client.xinfo_consumers(self.stream, self.group)
+        ]
+        return {
+            'backend': 'stream',
+            'length': self.client.xlen(self.stream),
+            'pending': group.get('pending', 0),
+            'lag': group.get('lag'),
+            'dead_letter': self.client.xlen(self.dead_letter_stream),
+            'consumers': consumers,
+        }
+
+
+class DrainRate:
+    """
+    Lavori completati al secondo da tutti i worker, su una finestra mobile:
+    ogni worker incrementa un contatore Redis per intervallo di
+    bucket_seconds (con scadenza), l'uploader somma gli ultimi `buckets`.
+    """
+
+    def __init__(self, client, key, bucket_seconds=10, buckets=6):
+        self.client = client
+        self.key = key
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+
+    def record(self, count):
+        if count <= 0:
+            return
+        bucket = int(time.time() // self.bucket_seconds)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incrby(f"{self.key}:{bucket}", count)
+        pipe.expire(f"{self.key}:{bucket}", self.bucket_seconds * (self.buckets + 2))
+        pipe.execute()
+
+    def rate(self):
+        now = time.time()
+        current = int(now // self.bucket_seconds)
+        keys = [f"{self.key}:{bucket}" for bucket in range(current - self.buckets, current + 1)]
+        done = sum(int(value) for value in self.client.mget(keys) if value is not None)
+        # I bucket completi più la parte già trascorsa di quello corrente
+        elapsed = self.buckets * self.bucket_seconds + (now - current * self.bucket_seconds)
+        return done / elapsed
+
+
+class LaneQueue:
+    """
+    Corsie di priorità, ognuna con la propria coda (lista o stream), svuotate
+    con un round robin pesato: con tutte le corsie piene ogni corsia riceve
+    una quota dei posti nei gruppi proporzionale al suo peso, e i posti non
+    usati da una corsia vuota passano alle altre. I crediti del round robin
+    restano tra un gruppo e l'altro, così le proporzioni valgono anche con
+    gruppi più piccoli della somma dei pesi.
+    """
+
+    def __init__(self, lanes, weights, drain_rate=None):
+        self.lanes = lanes                  # {corsia: coda}, la prima è la predefinita
+        self.weights = weights              # {corsia: peso}
+        self.drain_rate = drain_rate
+        self._credits = dict.fromkeys(lanes, 0)
+        # Quando tutte le corsie sono vuote si attende su quella col peso maggiore
+        self._blocking_lane = max(lanes, key=lambda lane: weights[lane])
+
+    @property
+    def default_lane(self):
+        return next(iter(self.lanes))
+
+    def push(self, payload, lane=None):
+        with track('redis', 'push'):
+            self.lanes[lane or self.default_lane].push(payload)
+
+    def push_many(self, payloads, lane=None):
+        with track('redis', 'push'):
+            self.lanes[lane or self.default_lane].push_many(payloads)
+
+    def _allocate(self, slots):
+        """Distribuisce i posti del gruppo tra le corsie (smooth weighted round robin)."""
+        total = sum(self.weights.values())
+        quotas = dict.fromkeys(self.lanes, 0)
+        for _ in range(slots):
+            for lane in self.lanes:
+                self._credits[lane] += self.weights[lane]
+            lane = max(self.lanes, key=lambda name: self._credits[name])
+            self._credits[lane] -= total
+            quotas[lane] += 1
+        return quotas
+
+    @staticmethod
+    def _tag(jobs, lane):
+        for job in jobs:
+            job.lane = lane
+        return jobs
+
+    def _take(self, max_jobs):
+        """Preleva senza attendere, rispettando le quote; i posti avanzati vanno alle corsie non vuote."""
+        batch = []
+        exhausted = set()
+        for lane, quota in self._allocate(max_jobs).items():
+            if quota:
+                jobs = self._tag(self.lanes[lane].poll(quota), lane)
+                if len(jobs) < quota:
+                    exhausted.add(lane)
+                batch.extend(jobs)
+        for lane in sorted(self.lanes, key=lambda name: -self.weights[name]):
+            if len(batch) >= max_jobs:
+                break
+            if lane not in exhausted:
+                batch.extend(self._tag(self.lanes[lane].poll(max_jobs - len(batch)), lane))
+        return batch
+
+    def fetch(self, max_jobs, wait_seconds, block_seconds):
+        """
+        Preleva un gruppo dalle corsie secondo i pesi. Se sono tutte vuote attende
+        (al massimo block_seconds) sulla corsia col peso maggiore: un lavoro
+        arrivato nel frattempo nelle altre corsie viene preso al giro successivo.
+        """
+        batch = self._take(max_jobs)
+        if batch:
+            return batch
+        batch = self._tag(self.lanes[self._blocking_lane].fetch(max_jobs, wait_seconds, block_seconds),
+                          self._blocking_lane)
+        if batch and len(batch) < max_jobs:
+            batch.extend(self._take(max_jobs - len(batch)))
+        return batch
+
+    def ack(self, jobs):
+        with track('redis', 'ack'):
+            for lane, queue in self.lanes.items():
+                queue.ack([job for job in jobs if job.lane == lane])
+        if self.drain_rate:
+            self.drain_rate.record(len(jobs))
+
+    def fail(self, job, error):
+        final = self.lanes[job.lane or self.default_lane].fail(job, error)
+        if final and self.drain_rate:
+            self.drain_rate.record(1)
+        return final
+
+    def depths(self):
+        with track('redis', 'depth'):
+            return {lane: queue.depth() for lane, queue in self.lanes.items()}
+
+    def admission(self, lane, incoming, max_depth, default_retry, max_retry):
+        """
+        Controllo di ammissione per `incoming` nuovi lavori nella corsia `lane`:
+        rifiuta se la corsia supererebbe max_depth lavori in attesa. Il ritmo con
+        cui i worker completano i lavori serve a stimare l'attesa e, in caso di
+        rifiuto, dopo quanti secondi ci sarà di nuovo posto (Retry-After).
+        Il ritmo misura i lavori completati, non la capacità: dopo un periodo
+        senza lavori è sottostimato, per questo non è usato per rifiutare.
+        Restituisce (ammesso, secondi di Retry-After, profondità, attesa stimata o None).
+        """
+        depths = self.depths()
+        depth = depths[lane]
+        rate = self.drain_rate.rate() if self.drain_rate else 0.0
+        # Con altre corsie non vuote questa corsia ottiene solo la sua quota del ritmo complessivo
+        busy = [name for name, value in depths.items() if value > 0 or name == lane]
+        lane_rate = rate * self.weights[lane] / sum(self.weights[name] for name in busy)
+        estimated_wait = (depth + incoming) / lane_rate if lane_rate > 0 else None
+
+        excess = depth + incoming - max_depth
+        if excess <= 0:
+            return True, 0, depth, estimated_wait
+        retry = math.ceil(excess / lane_rate) if lane_rate > 0 else default_retry
+        return False, max(1, min(retry, max_retry)), depth, estimated_wait
+
+    def stats(self):
+        stats = {lane: queue.stats() for lane, queue in self.lanes.items()}
+        if self.drain_rate:
+            stats['drain_rate'] = round(self.drain_rate.rate(), 2)
+        return stats
+
+
+def _lane_queue(client, consumer, lane, first):
+    """Coda di una corsia: la prima usa i nomi storici, le altre vi aggiungono ':<corsia>'."""
+    suffix = '' if first else f":{lane}"
+    if config.QUEUE_BACKEND == 'stream':
+        return StreamQueue(
+            client,
+            stream=config.REDIS_STREAM_NAME + suffix,
+            group=config.REDIS_STREAM_GROUP,
+            consumer=consumer,
+            dead_letter_stream=config.REDIS_DEAD_LETTER_STREAM,
+            visibility_timeout=config.STREAM_VISIBILITY_TIMEOUT,
+            max_deliveries=config.STREAM_MAX_DELIVERIES,
+            maxlen=config.STREAM_MAXLEN
+        )
+    if config.QUEUE_BACKEND == 'list':
+        return ListQueue(client, config.REDIS_QUEUE_NAME + suffix)
+    raise ValueError(f"Backend di coda sconosciuto: {config.QUEUE_BACKEND}")
+
+
+def create_queue(client, consumer=None):
+    """
+    Crea le corsie di config.QUEUE_LANES sul backend scelto in
+    config.QUEUE_BACKEND, con la misura del ritmo di smaltimento condivisa tra i worker.
+    """
+    lanes = {
+        lane: _lane_queue(client, consumer, lane, position == 0)
+        for position, lane in enumerate(config.QUEUE_LANES)
+    }
+    drain_rate = DrainRate(client, f"{config.REDIS_QUEUE_NAME}:drained",
+                           bucket_seconds=config.DRAIN_RATE_BUCKET_SECONDS,
+                           buckets=config.DRAIN_RATE_BUCKETS)
+    return LaneQueue(lanes, dict(config.QUEUE_LANES), drain_rate)
+
+
+def export_queue_metrics(queue):
+    """Espone profondità delle corsie e ritmo di smaltimento, letti da Redis a ogni lettura delle metriche."""
+    QUEUE_DEPTH.set_function(queue.depths)
+    DRAIN_RATE.set_function(queue.drain_rate.rate)
@@ -0,0 +1,325 @@
+# result_store.py
+#
+# Risultati dei lavori del worker, indicizzati per job_id in un database
+# SQLite dedicato (config.RESULTS_DB_PATH), con le stesse impostazioni di
+# database.py: WAL, connessione per thread, BEGIN IMMEDIATE e nuovi tentativi
+# quando il database è occupato. L'uploader registra il lavoro come 'queued',
+# il worker scrive 'done' (con le corrispondenze) oppure 'failed'.
+# Qui vive anche l'elenco degli eventi (album) con il loro stato: i lavori di
+# un evento archiviato non vengono più analizzati.
+
+import json
+import os
+import threading
+import time
+
+import config
+from database import MAX_QUERY_PARAMS, _open_connection, _write_transaction, retry_on_busy
+
+STATUS_QUEUED = 'queued'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+EVENT_ACTIVE = 'active'
+EVENT_ARCHIVED = 'archived'
+
+_local = threading.local()
+
+
+def get_connection():
+    """Connessione del thread corrente al database dei risultati (riaperta dopo un fork)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _open_connection(config.RESULTS_DB_PATH)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+@retry_on_busy
+def init_results_db():
+    """Crea la tabella dei risultati. WITHOUT ROWID: la tabella è essa stessa l'indice su job_id."""
+    conn = get_connection()
+    with _write_transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS job_results (
+                job_id TEXT PRIMARY KEY,
+                source_image TEXT NOT NULL,
+                status TEXT NOT NULL,
+                matches TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            ) WITHOUT ROWID
+        ''')
+        if not _has_column(conn, 'job_results', 'event'):
+            conn.execute("ALTER TABLE job_results ADD COLUMN event TEXT")
+        # Serve solo all'eliminazione dei risultati scaduti
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_job_results_created_at ON job_results (created_at)")
+        # (evento, SHA-256) dei file caricati -> lavoro che li ha analizzati (deduplicazione dei caricamenti):
+        # la stessa foto caricata in due eventi viene analizzata in entrambi
+        if _has_column(conn, 'content_hashes', 'content_hash') and not _has_column(conn, 'content_hashes', 'event'):
+            # Tabella creata prima degli eventi: la chiave primaria cambia, quindi va ricostruita
+            conn.execute("ALTER TABLE content_hashes RENAME TO content_hashes_old")
+            conn.execute("DROP INDEX IF EXISTS idx_content_hashes_created_at")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS content_hashes (
+                event TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                job_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (event, content_hash)
+            ) WITHOUT ROWID
+        ''')
+        if _has_column(conn, 'content_hashes_old', 'content_hash'):
+            conn.execute(
+                "INSERT OR IGNORE INTO content_hashes (event, content_hash, job_id, created_at) "
+                "SELECT ?, content_hash, job_id, created_at FROM content_hashes_old",
+                (config.DEFAULT_EVENT,)
+            )
+            conn.execute("DROP TABLE content_hashes_old")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_content_hashes_created_at ON content_hashes (created_at)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                event TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                archived_at REAL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute("INSERT OR IGNORE INTO events (event, status, created_at) VALUES (?, ?, ?)",
+                     (config.DEFAULT_EVENT, EVENT_ACTIVE, time.time()))
+
+
+def _has_column(conn, table, column):
+    return any(row['name'] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+@retry_on_busy
+def record_queued_many(jobs, event=None):
+    """
+    Registra in una sola transazione i lavori appena accodati per l'evento, come
+    lista di (job_id, source_image); quelli già completati dal worker non cambiano.
+    """
+    now = time.time()
+    event = event or config.DEFAULT_EVENT
+    conn = get_connection()
+    with _write_transaction(conn):
+        conn.executemany(
+            "INSERT OR IGNORE INTO job_results (job_id, source_image, status, event, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(job_id, source_image, STATUS_QUEUED, event, now) for job_id, source_image in jobs]
+        )
+
+
+def record_queued(job_id, source_image, event=None):
+    """Registra un lavoro appena accodato (se il worker lo ha già completato non cambia nulla)."""
+    record_queued_many([(job_id, source_image)], event)
+
+
+@retry_on_busy
+def save_results(results):
+    """
+    Salva in una sola transazione i risultati di un gruppo di lavori.
+    `results` è una lista di (job_id, source_image, matches o None, errore o None):
+    con matches None il lavoro è registrato come fallito.
+    """
+    results = list(results)
+    if not results:
+        return
+    now = time.time()
+    rows = [
+        (job_id, source_image,
+         STATUS_DONE if matches is not None else STATUS_FAILED,
+         json.dumps(matches) if matches is not None else None,
+         error, now, now)
+        for job_id, source_image, matches, error in results
+    ]
+    conn = get_connection()
+    with _write_transaction(conn):
+        conn.executemany('''
+            INSERT INTO job_results (job_id, source_image, status, matches, error, created_at, finished_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (job_id) DO UPDATE SET
+                status = excluded.status,
+                matches = excluded.matches,
+                error = excluded.error,
+                finished_at = excluded.finished_at
+        ''', rows)
+
+
+@retry_on_busy
+def claim_content_hashes(uploads, event=None):
+    """
+    Associa ogni contenuto caricato al suo nuovo lavoro e registra i lavori
+    come 'queued', tutto in una sola transazione. `uploads` è una lista di
+    (content_hash, job_id, source_image) dell'evento. Restituisce {job_id: job_id esistente}
+    per i contenuti che appartengono già a un lavoro non fallito dello stesso
+    evento (anche uno dello stesso gruppo): quelli non vanno accodati.
+    """
+    uploads = list(uploads)
+    if not uploads:
+        return {}
+    event = event or config.DEFAULT_EVENT
+    conn = get_connection()
+    now = time.time()
+    duplicates = {}
+    with _write_transaction(conn):
+        for content_hash, job_id, source_image in uploads:
+            row = conn.execute('''
+                SELECT h.job_id, r.status FROM content_hashes h
+                LEFT JOIN job_results r ON r.job_id = h.job_id
+                WHERE h.event = ? AND h.content_hash = ?
+            ''', (event, content_hash)).fetchone()
+            # Un lavoro fallito (o i cui risultati sono già scaduti) non vale come originale
+            if row is not None and row['status'] in (STATUS_QUEUED, STATUS_DONE):
+                duplicates[job_id] = row['job_id']
+                continue
+            conn.execute(
+                "INSERT OR REPLACE INTO content_hashes (event, content_hash, job_id, created_at) VALUES (?, ?, ?, ?)",
+                (event, content_hash, job_id, now)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO job_results (job_id, source_image, status, event, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, source_image, STATUS_QUEUED, event, now)
+            )
+    return duplicates
+
+
+@retry_on_busy
+def fail_unqueued_jobs(job_ids, error):
+    """
+    Lavori registrati come 'queued' ma mai arrivati nella coda (es. Redis non
+    raggiungibile): vengono segnati come falliti e i loro hash dei contenuti
+    rilasciati, così un nuovo caricamento della stessa foto viene accodato.
+    """
+    job_ids = list(dict.fromkeys(job_ids))
+    now = time.time()
+    conn = get_connection()
+    with _write_transaction(conn):
+        for start in range(0, len(job_ids), MAX_QUERY_PARAMS):
+            chunk = job_ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' for _ in chunk)
+            conn.execute(f"DELETE FROM content_hashes WHERE job_id IN ({placeholders})", chunk)
+            conn.execute(
+                f"UPDATE job_results SET status = ?, error = ?, finished_at = ? "
+                f"WHERE job_id IN ({placeholders}) AND status = ?",
+                [STATUS_FAILED, error, now, *chunk, STATUS_QUEUED]
+            )
+
+
+def _row_to_dict(row):
+    return {
+        'job_id': row['job_id'],
+        'status': row['status'],
+        'source_image': row['source_image'],
+        'event': row['event'] or config.DEFAULT_EVENT,
+        'matches': json.loads(row['matches']) if row['matches'] is not None else None,
+        'error': row['error'],
+        'created_at': row['created_at'],
+        'finished_at': row['finished_at'],
+    }
+
+
+@retry_on_busy
+def get_results(job_ids):
+    """Restituisce {job_id: risultato} per i job_id presenti nell'archivio."""
+    job_ids = list(dict.fromkeys(job_ids))
+    conn = get_connection()
+    results = {}
+    for start in range(0, len(job_ids), MAX_QUERY_PARAMS):
+        chunk = job_ids[start:start + MAX_QUERY_PARAMS]
+        placeholders = ','.join('?' for _ in chunk)
+        query = f"SELECT * FROM job_results WHERE job_id IN ({placeholders})"
+        for row in conn.execute(query, chunk):
+            results[row['job_id']] = _row_to_dict(row)
+    return results
+
+
+def get_result(job_id):
+    return get_results([job_id]).get(job_id)
+
+
+def wait_for_results(job_ids, timeout):
+    """
+    Long-polling: attende fino a `timeout` secondi che nessuno dei lavori sia
+    ancora in coda, rileggendo l'archivio con un intervallo crescente (da 50 ms a 500 ms).
+    """
+    deadline = time.monotonic() + timeout
+    interval = 0.05
+    while True:
+        results = get_results(job_ids)
+        pending = [job_id for job_id in job_ids
+                   if job_id in results and results[job_id]['status'] == STATUS_QUEUED]
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            return results
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 0.5)
+
+
+@retry_on_busy
+def purge_expired_results(max_age=None):
+    """Elimina i risultati (e gli hash dei contenuti) più vecchi di max_age secondi; restituisce quanti risultati."""
+    max_age = max_age or config.RESULTS_RETENTION_SECONDS
+    cutoff = time.time() - max_age
+    conn = get_connection()
+    with _write_transaction(conn):
+        conn.execute("DELETE FROM content_hashes WHERE created_at < ?", (cutoff,))
+        cursor = conn.execute("DELETE FROM job_results WHERE created_at < ?", (cutoff,))
+    return cursor.rowcount
+
+
+# --- Eventi ---
+
+def _event_to_dict(row):
+    return {
+        'event': row['event'],
+        'status': row['status'],
+        'created_at': row['created_at'],
+        'archived_at': row['archived_at'],
+    }
+
+
+@retry_on_busy
+def create_event(event):
+    """Registra un nuovo evento attivo. Restituisce False se esiste già."""
+    conn = get_connection()
+    with _write_transaction(conn):
+        cursor = conn.execute("INSERT OR IGNORE INTO events (event, status, created_at) VALUES (?, ?, ?)",
+                              (event, EVENT_ACTIVE, time.time()))
+    return cursor.rowcount == 1
+
+
+@retry_on_busy
+def get_event(event):
+    """L'evento come dizionario (event, status, created_at, archived_at), oppure None."""
+    row = get_connection().execute("SELECT * FROM events WHERE event = ?", (event,)).fetchone()
+    return _event_to_dict(row) if row is not None else None
+
+
+@retry_on_busy
+def get_event_statuses(events):
+    """Restituisce {evento: stato} per gli eventi registrati tra quelli indicati."""
+    events = list(dict.fromkeys(events))
+    placeholders = ','.join('?' for _ in events)
+    rows = get_connection().execute(f"SELECT event, status FROM events WHERE event IN ({placeholders})", events)
+    return {row['event']: row['status'] for row in rows}
+
+
+@retry_on_busy
+def list_events():
+    """Tutti gli eventi, dal più recente."""
+    rows = get_connection().execute("SELECT * FROM events ORDER BY created_at DESC, event")
+    return [_event_to_dict(row) for row in rows]
+
+
+@retry_on_busy
+def archive_event(event):
+    """Segna l'evento come archiviato. Restituisce False se non esiste."""
+    conn = get_connection()
+    with _write_transaction(conn):
+        cursor = conn.execute(
+            "UPDATE events SET status = ?, archived_at = COALESCE(archived_at, ?) WHERE event = ?",
+            (EVENT_ARCHIVED, time.time(), event)
+        )
+    return cursor.rowcount == 1
@@ -0,0 +1,69 @@
+import io
+import uuid
+
+import config
+import uploader
+import worker
+from job_queue import decode_job
+
+
+def new_event(client):
+    event = f"gita-{uuid.uuid4().hex[:8]}"
+    response = client.post('/events', json={'event': event})
+    assert response.status_code == 201
+    return event
+
+
+def upload(client, content, event=None):
+    query = f"?event={event}" if event else ''
+    return client.post(f"/upload{query}", data={'file': (io.BytesIO(content), 'foto.jpg')})
+
+
+def test_duplicates_are_scoped_to_the_event(uploader_client):
+    event = new_event(uploader_client)
+    content = uuid.uuid4().bytes
+
+    first = upload(uploader_client, content)
+    other_event = upload(uploader_client, content, event)
+    same_event = upload(uploader_client, content, event)
+
+    assert first.status_code == 202
+    assert other_event.status_code == 202
+    assert same_event.json['duplicate'] is True
+    assert same_event.json['job_id'] == other_event.json['job_id']
+
+
+def test_jobs_carry_their_event(uploader_client):
+    event = new_event(uploader_client)
+
+    response = upload(uploader_client, uuid.uuid4().bytes, event)
+
+    [job] = uploader.job_queue.fetch(10, 0, 0.1)
+    job_id, _, job_event = decode_job(job.payload)
+    assert (job_id, job_event) == (response.json['job_id'], event)
+
+
+def test_uploads_to_unknown_or_archived_events_are_refused(uploader_client):
+    event = new_event(uploader_client)
+    assert uploader_client.post(f"/events/{event}/archive").status_code == 200
+
+    assert upload(uploader_client, uuid.uuid4().bytes, 'sconosciuto').status_code == 404
+    assert upload(uploader_client, uuid.uuid4().bytes, event).status_code == 410
+
+
+def test_default_event_cannot_be_archived(uploader_client):
+    assert uploader_client.post(f"/events/{config.DEFAULT_EVENT}/archive").status_code == 400
+
+
+def test_worker_skips_jobs_of_archived_events(uploader_client, monkeypatch):
+    event = new_event(uploader_client)
+    uploader_client.post(f"/events/{event}/archive")
+    searched = []
+    monkeypatch.setattr(worker, 'find_faces_in_images', lambda paths, index: searched.extend(paths) or [[] for _ in paths])
+    monkeypatch.setattr(worker, 'evict_face_index', lambda name: False)
+
+    results = worker.analyze_batch([('j1', '/tmp/a.jpg', event), ('j2', '/tmp/b.jpg', config.DEFAULT_EVENT)],
+                                   face_index=object())
+
+    assert results == [False, []]
+    assert searched == ['/tmp/b.jpg']
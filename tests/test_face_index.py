@@ -0,0 +1,84 @@
+import threading
+
+import numpy as np
+
+from face_index import FaceIndex
+
+
+def new_index(index_path, db_path=None, embed_fn=None, persist=True, model_name='test'):
+    return FaceIndex(db_path=db_path, index_path=str(index_path), embed_fn=embed_fn, threshold=0.3,
+                     model_name=model_name, persist=persist)
+
+
+def vectors(count, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, 16)).astype(np.float32)
+
+
+def test_saved_index_is_reloaded(tmp_path):
+    path = tmp_path / 'index.npz'
+    index = new_index(path)
+    gallery = vectors(5)
+    index.add_embeddings([f"g/{n}.jpg" for n in range(5)], gallery)
+    index.save()
+
+    reloaded = new_index(path)
+
+    assert reloaded.load()
+    assert len(reloaded) == 5
+    assert reloaded.search(gallery[3:4])[0][0] == 'g/3.jpg'
+
+
+def test_index_of_another_model_is_not_loaded(tmp_path):
+    path = tmp_path / 'index.npz'
+    index = new_index(path)
+    index.add_embeddings(['g/0.jpg'], vectors(1))
+    index.save()
+
+    assert not new_index(path, model_name='altro').load()
+
+
+def test_index_without_persistence_writes_nothing(tmp_path):
+    index = new_index(tmp_path / 'index.npz', persist=False)
+    index.add_embeddings(['g/0.jpg'], vectors(1))
+
+    index.save()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_concurrent_saves_leave_one_valid_file(tmp_path):
+    path = tmp_path / 'index.npz'
+    # Indici distinti sullo stesso file, come i processi di più worker
+    indexes = []
+    for n in range(4):
+        index = new_index(path)
+        index.add_embeddings([f"g/{n}.jpg"], vectors(1, seed=n))
+        indexes.append(index)
+
+    threads = [threading.Thread(target=lambda index=index: [index.save() for _ in range(20)]) for index in indexes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [entry.name for entry in tmp_path.iterdir()] == ['index.npz']
+    reloaded = new_index(path)
+    assert reloaded.load()
+    assert len(reloaded) == 1
+
+
+def test_sync_follows_the_gallery(tmp_path):
+    gallery = tmp_path / 'gallery'
+    gallery.mkdir()
+    for name in ('a.jpg', 'b.jpg'):
+        (gallery / name).write_bytes(name.encode())
+    embed = lambda path: vectors(2, seed=len(path))
+    index = new_index(tmp_path / 'index.npz', db_path=str(gallery), embed_fn=embed)
+
+    assert index.sync() == (2, 0)
+    (gallery / 'a.jpg').unlink()
+    assert index.sync() == (0, 1)
+
+    reloaded = new_index(tmp_path / 'index.npz')
+    assert reloaded.load()
+    assert len(reloaded) == 2
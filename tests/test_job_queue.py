@@ -0,0 +1,114 @@
+import pytest
+
+import config
+from job_queue import StreamQueue, create_queue, encode_job
+
+
+def payloads(count, prefix):
+    return [encode_job(f"{prefix}{n}", f"/tmp/{prefix}{n}.jpg") for n in range(count)]
+
+
+def test_lanes_share_a_batch_by_weight(fake_redis, monkeypatch):
+    monkeypatch.setattr(config, 'QUEUE_LANES', {'interactive': 4, 'bulk': 1})
+    queue = create_queue(fake_redis)
+    queue.push_many(payloads(10, 'i'), 'interactive')
+    queue.push_many(payloads(10, 'b'), 'bulk')
+
+    lanes = [job.lane for job in queue.fetch(5, 0, 0.1)]
+
+    assert lanes.count('interactive') == 4
+    assert lanes.count('bulk') == 1
+
+
+def test_empty_lane_leaves_its_slots_to_the_others(fake_redis, monkeypatch):
+    monkeypatch.setattr(config, 'QUEUE_LANES', {'interactive': 4, 'bulk': 1})
+    queue = create_queue(fake_redis)
+    queue.push_many(payloads(10, 'b'), 'bulk')
+
+    assert [job.lane for job in queue.fetch(5, 0, 0.1)] == ['bulk'] * 5
+
+
+def test_admission_rejects_past_max_depth(fake_redis):
+    queue = create_queue(fake_redis)
+    queue.push_many(payloads(3, 'b'), 'bulk')
+
+    admitted, retry_after, depth, _ = queue.admission('bulk', 2, 4, default_retry=7, max_retry=60)
+    assert (admitted, retry_after, depth) == (False, 7, 3)
+
+    admitted, retry_after, _, _ = queue.admission('bulk', 1, 4, default_retry=7, max_retry=60)
+    assert (admitted, retry_after) == (True, 0)
+
+
+def test_admission_retry_after_follows_the_drain_rate(fake_redis):
+    queue = create_queue(fake_redis)
+    queue.push_many(payloads(3, 'b'), 'bulk')
+    # Abbastanza lavori completati da stimare un ritmo più alto di 1 lavoro al secondo
+    queue.drain_rate.record(10000)
+
+    admitted, retry_after, _, estimated_wait = queue.admission('bulk', 10, 4, default_retry=7, max_retry=60)
+
+    assert not admitted
+    assert 1 <= retry_after < 7
+    assert estimated_wait is not None
+
+
+@pytest.fixture
+def stream_client():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeRedis()
+
+
+def stream_queue(client, consumer, max_deliveries=3):
+    # Visibility timeout nullo: un lavoro non confermato è subito riprendibile
+    return StreamQueue(client, 'test_stream', 'workers', consumer=consumer, dead_letter_stream='test_stream:dead',
+                       visibility_timeout=0, max_deliveries=max_deliveries)
+
+
+def test_stream_acked_jobs_leave_the_queue(stream_client):
+    queue = stream_queue(stream_client, 'a')
+    queue.push_many(payloads(2, 's'))
+
+    jobs = queue.poll(10)
+    queue.ack(jobs)
+
+    assert len(jobs) == 2
+    assert queue.depth() == 0
+    assert queue.poll(10) == []
+
+
+def test_stream_abandoned_job_is_reclaimed_by_another_consumer(stream_client):
+    crashed = stream_queue(stream_client, 'a')
+    crashed.push(payloads(1, 's')[0])
+    [abandoned] = crashed.poll(1)
+
+    [reclaimed] = stream_queue(stream_client, 'b').poll(1)
+
+    assert reclaimed.id == abandoned.id
+    assert reclaimed.payload == abandoned.payload
+    assert reclaimed.deliveries == 2
+
+
+def test_stream_job_goes_to_dead_letter_after_max_deliveries(stream_client):
+    queue = stream_queue(stream_client, 'a', max_deliveries=2)
+    queue.push(payloads(1, 's')[0])
+    [job] = queue.poll(1)
+    assert not queue.fail(job, "analisi fallita")
+
+    [job] = stream_queue(stream_client, 'b', max_deliveries=2).poll(1)
+    assert queue.fail(job, "analisi fallita")
+
+    assert queue.depth() == 0
+    [(_, fields)] = stream_client.xrange('test_stream:dead')
+    assert fields[b'original_id'].decode() == job.id
+    assert fields[b'error'] == b'analisi fallita'
+
+
+def test_stream_job_over_max_deliveries_is_dead_lettered_on_reclaim(stream_client):
+    queue = stream_queue(stream_client, 'a', max_deliveries=1)
+    queue.push(payloads(1, 's')[0])
+    queue.poll(1)
+
+    # Il worker è morto senza chiamare fail(): chi lo riprende lo trova oltre il limite
+    assert stream_queue(stream_client, 'b', max_deliveries=1).poll(1) == []
+    assert stream_client.xlen('test_stream:dead') == 1
+    assert queue.depth() == 0
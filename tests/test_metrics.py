@@ -0,0 +1,52 @@
+import multiprocessing
+
+import metrics
+import worker
+from job_queue import create_queue, encode_job, export_queue_metrics
+
+
+def sample(text, line_start):
+    return [line for line in text.splitlines() if line.startswith(line_start)]
+
+
+def child_snapshot(results):
+    worker.reset_child_metrics()
+    worker.JOBS.labels(lane='bulk', status='done').inc(2)
+    results.put(metrics.REGISTRY.snapshot())
+
+
+def test_counters_are_summed_across_snapshots():
+    first = {'jobs': {'kind': 'counter', 'help': '', 'labelnames': ('lane',), 'buckets': None,
+                      'samples': {('bulk',): 2.0}}}
+    second = {'jobs': {**first['jobs'], 'samples': {('bulk',): 3.0, ('interactive',): 1.0}}}
+
+    merged = metrics.merge_snapshots([first, second])
+
+    assert merged['jobs']['samples'] == {('bulk',): 5.0, ('interactive',): 1.0}
+
+
+def test_child_forked_after_export_does_not_double_count_queue_gauges(fake_redis, monkeypatch):
+    queue = create_queue(fake_redis)
+    queue.push_many([encode_job(f"job{n}", f"/tmp/{n}.jpg") for n in range(3)], 'bulk')
+    monkeypatch.setattr(worker, 'job_queue', queue)
+    export_queue_metrics(queue)
+    try:
+        # Come un figlio riavviato dal supervisore dopo l'avvio del server delle metriche
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=child_snapshot, args=(results,))
+        process.start()
+        snapshot = results.get(timeout=30)
+        process.join()
+
+        child_metrics = worker.ChildMetrics()
+        child_metrics.update(0, snapshot)
+        text = child_metrics.render()
+    finally:
+        worker.QUEUE_DEPTH.set_function(None)
+        worker.DRAIN_RATE.set_function(None)
+
+    assert snapshot['queue_depth']['samples'] == {}
+    assert sample(text, 'queue_depth{lane="bulk"}') == ['queue_depth{lane="bulk"} 3']
+    assert len(sample(text, 'queue_drain_rate_jobs_per_second ')) == 1
+    assert 'worker_jobs_total{lane="bulk",status="done"} 2' in text
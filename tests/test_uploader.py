@@ -0,0 +1,162 @@
+import io
+import sqlite3
+import tarfile
+import uuid
+import zipfile
+
+import config
+import result_store
+import uploader
+
+
+def batch_files(count):
+    return {'files': [(io.BytesIO(f"foto {n} {uuid.uuid4()}".encode()), f"foto_{n}.jpg") for n in range(count)]}
+
+
+def test_batch_over_lane_depth_is_rejected_after_extraction(uploader_client, tmp_path, monkeypatch):
+    monkeypatch.setitem(config.QUEUE_MAX_DEPTH, config.BATCH_UPLOAD_LANE, 2)
+
+    response = uploader_client.post('/upload/batch', data=batch_files(3))
+
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert list(tmp_path.iterdir()) == []
+    assert uploader.job_queue.depths()[config.BATCH_UPLOAD_LANE] == 0
+
+
+def test_batch_within_lane_depth_is_queued(uploader_client, monkeypatch):
+    monkeypatch.setitem(config.QUEUE_MAX_DEPTH, config.BATCH_UPLOAD_LANE, 2)
+
+    response = uploader_client.post('/upload/batch', data=batch_files(2))
+
+    assert response.status_code == 202
+    assert response.json['queued'] == 2
+    assert uploader.job_queue.depths()[config.BATCH_UPLOAD_LANE] == 2
+
+
+def tar_archive(names, compression=''):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=f"w:{compression}") as archive:
+        for name in names:
+            data = f"{name} {uuid.uuid4()}".encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def zip_archive(names):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name in names:
+            archive.writestr(name, f"{name} {uuid.uuid4()}")
+    return buffer.getvalue()
+
+
+def encrypted_zip(names):
+    """ZIP con il flag di cifratura sull'ultimo file (zipfile non sa scriverne di veri)."""
+    data = bytearray(zip_archive(names))
+    local = data.rfind(b'PK\x03\x04')
+    central = data.rfind(b'PK\x01\x02')
+    data[local + 6] |= 1
+    data[central + 8] |= 1
+    return bytes(data)
+
+
+def test_multipart_files_and_archives_are_extracted(uploader_client, tmp_path):
+    data = {
+        'note': 'campo di testo ignorato',
+        'files': [(io.BytesIO(uuid.uuid4().bytes), 'singola.jpg')],
+        'archive': [(io.BytesIO(tar_archive(['a.jpg', 'b.png', 'leggimi.txt'], 'gz')), 'gita.tar.gz'),
+                    (io.BytesIO(zip_archive(['c.jpg', '__MACOSX/._c.jpg'])), 'gita.zip')],
+    }
+
+    response = uploader_client.post('/upload/batch', data=data)
+
+    assert response.status_code == 202
+    assert [job['filename'] for job in response.json['jobs']] == ['singola.jpg', 'a.jpg', 'b.png', 'c.jpg']
+    assert len(list(tmp_path.iterdir())) == 4
+
+
+def test_raw_tar_body_is_extracted(uploader_client):
+    response = uploader_client.post('/upload/batch', data=tar_archive(['a.jpg', 'b.jpg']),
+                                    content_type='application/x-tar')
+
+    assert response.status_code == 202
+    assert response.json['queued'] == 2
+
+
+def test_encrypted_zip_is_rejected_without_leftovers(uploader_client, tmp_path):
+    response = uploader_client.post('/upload/batch?format=zip', data=encrypted_zip(['a.jpg', 'b.jpg']),
+                                    content_type='application/zip')
+
+    assert response.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_truncated_multipart_is_rejected_without_leftovers(uploader_client, tmp_path):
+    body = (b'--limite\r\nContent-Disposition: form-data; name="files"; filename="a.jpg"\r\n\r\n'
+            b'foto senza fine')
+
+    response = uploader_client.post('/upload/batch', data=body,
+                                    content_type='multipart/form-data; boundary=limite')
+
+    assert response.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_multipart_archive_is_extracted_while_the_body_arrives(uploader_client, monkeypatch):
+    archive = tar_archive([f"foto_{n}.jpg" for n in range(3)] + ['fine.txt'])
+    padding = io.BytesIO(b'\0' * (4 * config.UPLOAD_CHUNK_SIZE))
+    boundary = 'limite'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="archive"; filename="gita.tar"\r\n'
+            f'Content-Type: application/x-tar\r\n\r\n').encode() + archive + padding.getvalue() + \
+        f'\r\n--{boundary}--\r\n'.encode()
+    stream = io.BytesIO(body)
+    consumed_at_first_save = []
+    save_upload = uploader.save_upload
+
+    def recording_save_upload(part, filename):
+        consumed_at_first_save.append(stream.tell())
+        return save_upload(part, filename)
+    monkeypatch.setattr(uploader, 'save_upload', recording_save_upload)
+
+    response = uploader_client.post('/upload/batch', input_stream=stream, content_length=len(body),
+                                    content_type=f'multipart/form-data; boundary={boundary}')
+
+    assert response.status_code == 202
+    assert response.json['queued'] == 3
+    assert consumed_at_first_save[0] < len(body)
+
+
+def test_failed_job_registration_removes_saved_files(uploader_client, tmp_path, monkeypatch):
+    def locked(uploads, event=None):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(uploader, 'claim_content_hashes', locked)
+
+    response = uploader_client.post('/upload/batch', data=batch_files(2))
+
+    assert response.status_code == 500
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_push_marks_jobs_failed_and_removes_files(uploader_client, tmp_path, monkeypatch):
+    def unreachable(payloads, lane):
+        raise ConnectionError("Redis non raggiungibile")
+    push_many = uploader.job_queue.push_many
+    monkeypatch.setattr(uploader.job_queue, 'push_many', unreachable)
+    content = uuid.uuid4().bytes
+
+    response = uploader_client.post('/upload', data={'file': (io.BytesIO(content), 'a.jpg')})
+
+    assert response.status_code == 503
+    assert list(tmp_path.iterdir()) == []
+    failed = result_store.get_connection().execute(
+        "SELECT COUNT(*) FROM job_results WHERE status = 'failed' AND error = 'accodamento fallito' "
+        "AND source_image LIKE ?", (f"{tmp_path}%",)).fetchone()[0]
+    assert failed == 1
+
+    # Il contenuto non resta associato al lavoro mai accodato: un nuovo caricamento viene accodato
+    monkeypatch.setattr(uploader.job_queue, 'push_many', push_many)
+    response = uploader_client.post('/upload', data={'file': (io.BytesIO(content), 'a.jpg')})
+    assert response.status_code == 202
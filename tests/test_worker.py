@@ -0,0 +1,64 @@
+import queue
+import uuid
+
+import image_processor
+import worker
+from job_queue import create_queue, encode_job
+from result_store import get_results
+
+
+class FakeIndex:
+    persist = True
+
+    def __len__(self):
+        return 0
+
+
+def run_child(slot, monkeypatch, fake_redis):
+    """child_main nel processo del test, senza fork: registra cosa il figlio carica."""
+    calls = []
+    index = FakeIndex()
+    # child_main sostituisce connessione e coda del modulo: vengono ripristinate a fine test
+    monkeypatch.setattr(worker, 'r', worker.r)
+    monkeypatch.setattr(worker, 'job_queue', worker.job_queue)
+    monkeypatch.setattr(worker.redis, 'Redis', lambda **kwargs: fake_redis)
+    monkeypatch.setattr(worker.signal, 'signal', lambda signum, handler: None)
+    monkeypatch.setattr(worker, 'warm_up', lambda: calls.append('warm_up'))
+    monkeypatch.setattr(image_processor, '_face_index', index)
+    monkeypatch.setattr(image_processor, '_persist_indexes', True)
+    monkeypatch.setattr(worker, 'run_worker', lambda face_index, on_batch: calls.append(('run', face_index)))
+    worker.child_main(slot, queue.Queue())
+    return calls, index
+
+
+def test_child_reuses_the_supervisor_model_and_index(monkeypatch, fake_redis):
+    calls, index = run_child(1, monkeypatch, fake_redis)
+
+    assert calls == [('run', index)]
+
+
+def test_only_the_first_child_persists_the_index(monkeypatch, fake_redis):
+    _, first = run_child(0, monkeypatch, fake_redis)
+    assert first.persist is True
+
+    _, other = run_child(1, monkeypatch, fake_redis)
+    assert other.persist is False
+
+
+def test_batch_error_records_every_job_as_failed(monkeypatch, fake_redis):
+    job_queue = create_queue(fake_redis)
+    job_ids = [uuid.uuid4().hex for _ in range(3)]
+    job_queue.push_many([encode_job(job_id, f"/tmp/{job_id}.jpg") for job_id in job_ids], 'bulk')
+    monkeypatch.setattr(worker, 'job_queue', job_queue)
+    monkeypatch.setattr(worker.time, 'sleep', lambda seconds: None)
+
+    def crash(decoded, face_index):
+        monkeypatch.setattr(worker, '_stopping', True)
+        raise RuntimeError("detector non disponibile")
+    monkeypatch.setattr(worker, 'analyze_batch', crash)
+
+    worker.run_worker(face_index=None)
+
+    results = get_results(job_ids)
+    assert [results[job_id]['status'] for job_id in job_ids] == ['failed'] * 3
+    assert 'detector non disponibile' in results[job_ids[0]]['error']
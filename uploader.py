@@ -1,18 +1,343 @@
 # uploader.py
 
+import hashlib
+import lzma
 import os
+import re
+import shutil
+import tarfile
+import tempfile
+import uuid
+import zipfile
+import zlib
 import redis
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, url_for
 import config
+import metrics
+from werkzeug.sansio.multipart import NEED_DATA, Data, Epilogue, File, MultipartDecoder
 from werkzeug.utils import secure_filename
+from job_queue import create_queue, encode_job, export_queue_metrics
+from result_store import (EVENT_ACTIVE, init_results_db, record_queued_many, claim_content_hashes, fail_unqueued_jobs,
+                          get_result, get_results, wait_for_results, create_event, get_event, list_events,
+                          archive_event)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
 
 r = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+job_queue = create_queue(r)
+init_results_db()
+
+metrics.instrument_flask(app)
+export_queue_metrics(job_queue)
+UPLOADS = metrics.Counter('uploads_total', "File ricevuti per corsia ed esito (queued, duplicate)", ['lane', 'outcome'])
+UPLOAD_BYTES = metrics.Counter('upload_bytes_total', "Byte dei file ricevuti")
+REJECTED = metrics.Counter('admission_rejections_total', "Richieste rifiutate con 429 per coda piena", ['lane'])
+
+# Chiavi degli eventi: diventano nomi di cartella (EVENTS_DIR/<evento>)
+EVENT_KEY_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+
+def requested_wait():
+    """Secondi di long-polling chiesti con ?wait=N (0 = risposta immediata)."""
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = 0
+    return max(0, min(wait, config.RESULT_MAX_WAIT_SECONDS))
+
+def requested_lane(default):
+    """Corsia di priorità chiesta con ?lane=... (None se sconosciuta)."""
+    lane = request.args.get('lane', default)
+    return lane if lane in config.QUEUE_LANES else None
+
+def requested_event():
+    """
+    Evento chiesto con ?event=... (quello predefinito se assente):
+    restituisce (evento, risposta di errore o None).
+    """
+    event = request.args.get('event') or config.DEFAULT_EVENT
+    found = get_event(event)
+    if found is None:
+        return event, (jsonify({"error": f"Evento '{event}' sconosciuto"}), 404)
+    if found['status'] != EVENT_ACTIVE:
+        return event, (jsonify({"error": f"Evento '{event}' archiviato"}), 410)
+    return event, None
+
+def check_admission(lane, incoming=1):
+    """
+    Controllo di ammissione, fatto prima di leggere il corpo della richiesta:
+    restituisce (risposta 429 o None, attesa stimata in secondi o None).
+    """
+    admitted, retry_after, depth, estimated_wait = job_queue.admission(
+        lane, incoming, config.QUEUE_MAX_DEPTH[lane],
+        config.RETRY_AFTER_DEFAULT_SECONDS, config.RETRY_AFTER_MAX_SECONDS
+    )
+    if admitted:
+        return None, estimated_wait
+    REJECTED.labels(lane=lane).inc()
+    response = jsonify({
+        "error": f"Coda '{lane}' piena ({depth} lavori in attesa), riprovare più tardi.",
+        "lane": lane,
+        "queue_depth": depth,
+        "retry_after": retry_after
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response, estimated_wait
+
+def wait_estimate(seconds):
+    return round(seconds, 1) if seconds is not None else None
+
+def save_and_hash(stream, filepath):
+    """
+    Salva il contenuto di `stream` calcolandone lo SHA-256 durante la copia (una sola
+    lettura dei dati). Il file viene scritto con un nome temporaneo e
+    rinominato solo alla fine, così non resta mai un file a metà.
+    """
+    digest = hashlib.sha256()
+    partial = filepath + '.part'
+    try:
+        with open(partial, 'wb') as out:
+            for chunk in iter(lambda: stream.read(config.UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+                UPLOAD_BYTES.inc(len(chunk))
+        os.replace(partial, filepath)
+    except Exception:
+        # Anche un errore nella lettura (es. membro di un archivio corrotto) non deve lasciare file parziali
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return digest.hexdigest()
+
+class BatchError(Exception):
+    pass
+
+class QueueUnavailable(Exception):
+    """I lavori non sono stati accodati: vanno rifiutati con 503."""
+
+def save_upload(stream, filename):
+    """Salva un file caricato con un nuovo job_id nel nome: (job_id, nome, percorso, hash)."""
+    # Il job_id nel nome del file evita che due caricamenti con lo stesso nome si sovrascrivano
+    job_id = uuid.uuid4().hex
+    filename = secure_filename(os.path.basename(filename)) or 'image'
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{job_id}_{filename}")
+    return job_id, filename, filepath, save_and_hash(stream, filepath)
+
+def enqueue_uploads(saved, lane, event=None):
+    """
+    Registra e accoda nella corsia `lane` i file salvati per l'evento con una transazione SQLite e un solo
+    round trip verso Redis. Restituisce {job_id: job_id esistente} per i
+    duplicati (nello stesso evento), che non vengono accodati e il cui file viene eliminato.
+    Se la registrazione fallisce i file vengono eliminati e l'errore sollevato; se
+    fallisce l'accodamento i lavori vengono segnati come falliti, i loro file
+    eliminati e viene sollevata QueueUnavailable.
+    """
+    try:
+        if config.DEDUP_UPLOADS:
+            duplicates = claim_content_hashes(
+                ((content_hash, job_id, filepath) for job_id, _, filepath, content_hash in saved), event
+            )
+        else:
+            duplicates = {}
+            record_queued_many(((job_id, filepath) for job_id, _, filepath, _ in saved), event)
+    except Exception:
+        # Nessun lavoro registrato: i file salvati non verrebbero mai analizzati
+        remove_saved(saved)
+        raise
+    for job_id, _, filepath, _ in saved:
+        if job_id in duplicates:
+            os.remove(filepath)
+    queued = [(job_id, filepath) for job_id, _, filepath, _ in saved if job_id not in duplicates]
+    try:
+        job_queue.push_many([encode_job(job_id, filepath, event) for job_id, filepath in queued], lane)
+    except Exception as e:
+        metrics.count_error('uploader', 'enqueue', e)
+        app.logger.error(f"Accodamento di {len(queued)} lavori fallito: {e}")
+        fail_unqueued_jobs([job_id for job_id, _ in queued], "accodamento fallito")
+        for _, filepath in queued:
+            os.remove(filepath)
+        raise QueueUnavailable(str(e)) from e
+    UPLOADS.labels(lane=lane, outcome='queued').inc(len(saved) - len(duplicates))
+    UPLOADS.labels(lane=lane, outcome='duplicate').inc(len(duplicates))
+    return duplicates
+
+def is_archive_image(name):
+    basename = os.path.basename(name)
+    # Esclude i metadati aggiunti dai sistemi operativi (__MACOSX/, ._foto.jpg, ...)
+    if basename.startswith('.') or '__MACOSX' in name.split('/'):
+        return False
+    return basename.lower().endswith(config.ARCHIVE_IMAGE_EXTENSIONS)
+
+def archive_format(filename, content_type):
+    """'zip', 'tar' (anche compresso) o None, dal nome del file o dal Content-Type."""
+    name = (filename or '').lower()
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if name.endswith('.zip') or content_type in ('application/zip', 'application/x-zip-compressed'):
+        return 'zip'
+    if (name.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz'))
+            or content_type in ('application/x-tar', 'application/gzip', 'application/x-gzip',
+                                'application/x-gtar', 'application/x-bzip2', 'application/x-xz')):
+        return 'tar'
+    return None
+
+def check_batch_size(saved):
+    if len(saved) >= config.BATCH_MAX_FILES:
+        raise BatchError(f"Al massimo {config.BATCH_MAX_FILES} file per richiesta")
+
+def save_tar_members(stream, saved):
+    """
+    Estrae le immagini di un TAR mentre arriva: la modalità 'r|*' legge
+    l'archivio in sequenza (anche gzip/bz2/xz) senza mai tenerlo tutto in
+    memoria né su disco.
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile() or not is_archive_image(member.name):
+                continue
+            check_batch_size(saved)
+            saved.append(save_upload(archive.extractfile(member), member.name))
+
+def save_zip_members(stream, saved):
+    """
+    Lo ZIP ha l'indice in fondo all'archivio, quindi non si può estrarre in
+    sequenza: se lo stream non è posizionabile viene prima copiato in un file
+    temporaneo (in memoria solo se piccolo), poi le immagini vengono estratte una alla volta.
+    """
+    spool = None
+    if not (hasattr(stream, 'seekable') and stream.seekable()):
+        spool = tempfile.SpooledTemporaryFile(max_size=config.ARCHIVE_SPOOL_MAX_MEMORY,
+                                              dir=app.config['UPLOAD_FOLDER'])
+        shutil.copyfileobj(stream, spool, config.UPLOAD_CHUNK_SIZE)
+        spool.seek(0)
+        stream = spool
+    try:
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_archive_image(info.filename):
+                    continue
+                check_batch_size(saved)
+                with archive.open(info) as member:
+                    saved.append(save_upload(member, info.filename))
+    finally:
+        if spool is not None:
+            spool.close()
+
+class MultipartPart:
+    """
+    Contenuto di un file di un corpo multipart, letto man mano che arriva
+    (vedi multipart_files): si comporta come un file non posizionabile.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = b''
+        self._offset = 0
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._chunk[self._offset:] + b''.join(self._chunks)
+            self._chunk, self._offset = b'', 0
+            return data
+        # Può restituire meno di `size` byte (come un socket): b'' solo alla fine della parte
+        while self._offset >= len(self._chunk):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b''
+            self._chunk, self._offset = chunk, 0
+        data = self._chunk[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def drain(self):
+        for _ in self._chunks:
+            pass
+        self._chunk, self._offset = b'', 0
+
+def multipart_files(stream, boundary):
+    """
+    Legge un corpo multipart/form-data mentre arriva, senza passare da
+    request.files (che riceve tutto il corpo prima di restituire il primo file):
+    genera (campo, nome del file, Content-Type, MultipartPart) per ogni file.
+    Ogni parte va letta prima di passare alla successiva; quello che resta viene scartato.
+    Un corpo malformato o incompleto solleva BatchError.
+    """
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+
+    def events():
+        finished = False
+        while True:
+            try:
+                event = decoder.next_event()
+            except ValueError as e:
+                raise BatchError(f"Corpo multipart non valido: {e}")
+            if event is NEED_DATA:
+                if finished:
+                    raise BatchError("Corpo multipart incompleto")
+                chunk = stream.read(config.UPLOAD_CHUNK_SIZE)
+                finished = not chunk
+                decoder.receive_data(chunk or None)
+            elif isinstance(event, Epilogue):
+                return
+            else:
+                yield event
+
+    def data(pending):
+        for event in pending:
+            if isinstance(event, Data):
+                if event.data:
+                    yield event.data
+                if not event.more_data:
+                    return
+
+    pending = events()
+    for event in pending:
+        # I campi di testo (e i loro eventi Data) vengono scartati
+        if isinstance(event, File):
+            part = MultipartPart(data(pending))
+            yield event.name, event.filename, event.headers.get('Content-Type'), part
+            part.drain()
+
+def save_archive(stream, fmt, saved):
+    """
+    Estrae le immagini dell'archivio in `saved`. Archivi corrotti, cifrati
+    (RuntimeError) o con una compressione non supportata (NotImplementedError)
+    diventano BatchError.
+    """
+    try:
+        if fmt == 'zip':
+            save_zip_members(stream, saved)
+        else:
+            save_tar_members(stream, saved)
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error, lzma.LZMAError) as e:
+        raise BatchError(f"Archivio non valido: {e}")
+    except NotImplementedError as e:
+        # Sottoclasse di RuntimeError: va gestita prima
+        raise BatchError(f"Compressione dell'archivio non supportata: {e}")
+    except RuntimeError as e:
+        raise BatchError(f"Archivio cifrato o non leggibile: {e}")
+
+def remove_saved(saved):
+    for _, _, filepath, _ in saved:
+        if os.path.exists(filepath):
+            os.remove(filepath)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    lane = requested_lane(config.UPLOAD_LANE)
+    if lane is None:
+        return jsonify({"error": "Corsia sconosciuta"}), 400
+    event, invalid = requested_event()
+    if invalid is not None:
+        return invalid
+    # Con la coda satura si rifiuta subito, senza ricevere il file
+    rejected, estimated_wait = check_admission(lane)
+    if rejected is not None:
+        return rejected
+
     if 'file' not in request.files:
         return jsonify({"error": "Nessun file"}), 400
     
@@ -20,13 +345,181 @@ def upload_file():
     if not file or file.filename == '':
         return jsonify({"error": "File non valido"}), 400
 
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
-    
-    r.rpush(config.REDIS_QUEUE_NAME, filepath)
-    return jsonify({"message": f"File '{filename}' accodato per l'analisi."}), 202
+    saved = save_upload(file.stream, file.filename)
+    job_id, filename = saved[0], saved[1]
+    try:
+        existing_job_id = enqueue_uploads([saved], lane, event).get(job_id)
+    except QueueUnavailable:
+        return jsonify({"error": "Coda non disponibile, riprovare più tardi."}), 503
+    if existing_job_id is not None:
+        # Stessa foto già caricata: niente nuova analisi, si rimanda al lavoro esistente
+        return jsonify({
+            "message": f"File '{filename}' già caricato.",
+            "job_id": existing_job_id,
+            "duplicate": True,
+            "result_url": url_for('get_job_result', job_id=existing_job_id)
+        }), 200
+    return jsonify({
+        "message": f"File '{filename}' accodato per l'analisi.",
+        "job_id": job_id,
+        "lane": lane,
+        "event": event,
+        "estimated_wait_seconds": wait_estimate(estimated_wait),
+        "result_url": url_for('get_job_result', job_id=job_id)
+    }), 202
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Caricamento di molte immagini in una richiesta, in tre forme:
+    - multipart con più campi 'files' (anche insieme a campi 'archive');
+    - multipart con un campo 'archive' contenente uno ZIP o un TAR;
+    - l'archivio come corpo grezzo della richiesta (Content-Type application/zip,
+      application/x-tar, application/gzip, ... oppure ?format=zip|tar).
+    Anche il multipart viene letto mentre arriva (multipart_files): i TAR vengono
+    estratti in sequenza, gli ZIP (indice in fondo) prima appoggiati su un file temporaneo.
+    I lavori vengono accodati tutti insieme e la risposta è il manifest dei job_id
+    nell'ordine dei file; i duplicati rimandano al lavoro esistente.
+    Per default i lavori vanno nella corsia BATCH_UPLOAD_LANE (?lane=... per cambiarla)
+    e nell'evento predefinito (?event=... per cambiarlo).
+    """
+    lane = requested_lane(config.BATCH_UPLOAD_LANE)
+    if lane is None:
+        return jsonify({"error": "Corsia sconosciuta"}), 400
+    event, invalid = requested_event()
+    if invalid is not None:
+        return invalid
+    # Il numero di file non è noto prima di leggere il corpo: si controlla subito che la corsia
+    # non sia già satura, poi di nuovo con il numero di file estratti
+    rejected, _ = check_admission(lane)
+    if rejected is not None:
+        return rejected
+
+    saved = []
+    try:
+        if request.mimetype == 'multipart/form-data':
+            boundary = request.mimetype_params.get('boundary')
+            if not boundary:
+                raise BatchError("Corpo multipart senza boundary")
+            for field, filename, content_type, part in multipart_files(request.stream, boundary):
+                if field == 'files' and filename:
+                    check_batch_size(saved)
+                    saved.append(save_upload(part, filename))
+                elif field == 'archive':
+                    fmt = archive_format(filename, content_type)
+                    if fmt is None:
+                        raise BatchError(f"Formato di archivio non riconosciuto: {filename}")
+                    save_archive(part, fmt, saved)
+        else:
+            fmt = request.args.get('format') or archive_format(None, request.mimetype)
+            if fmt not in ('zip', 'tar'):
+                raise BatchError("Formato di archivio non riconosciuto: usare ZIP o TAR")
+            save_archive(request.stream, fmt, saved)
+        if not saved:
+            raise BatchError("Nessuna immagine nella richiesta")
+    except BatchError as e:
+        # La richiesta è tutta o niente: si eliminano i file già estratti
+        remove_saved(saved)
+        return jsonify({"error": str(e)}), 400
+    except Exception:
+        # Anche un errore imprevisto (es. disco pieno) non deve lasciare file mai accodati
+        remove_saved(saved)
+        raise
+
+    # Ora il numero di file è noto: il gruppo intero non deve portare la corsia oltre QUEUE_MAX_DEPTH
+    rejected, _ = check_admission(lane, incoming=len(saved))
+    if rejected is not None:
+        remove_saved(saved)
+        return rejected
+
+    try:
+        duplicates = enqueue_uploads(saved, lane, event)
+    except QueueUnavailable:
+        return jsonify({"error": "Coda non disponibile, riprovare più tardi."}), 503
+    manifest = []
+    for job_id, filename, _, content_hash in saved:
+        entry = {"filename": filename, "job_id": duplicates.get(job_id, job_id), "sha256": content_hash}
+        if job_id in duplicates:
+            entry["duplicate"] = True
+        entry["result_url"] = url_for('get_job_result', job_id=entry["job_id"])
+        manifest.append(entry)
+    return jsonify({
+        "message": f"{len(saved) - len(duplicates)} file accodati per l'analisi, {len(duplicates)} già caricati.",
+        "queued": len(saved) - len(duplicates),
+        "duplicates": len(duplicates),
+        "lane": lane,
+        "event": event,
+        "jobs": manifest,
+        "results_url": url_for('get_job_results')
+    }), 202
+
+@app.route('/result/<job_id>')
+def get_job_result(job_id):
+    """Stato e corrispondenze di un lavoro. Con ?wait=N attende fino a N secondi che sia completato."""
+    wait = requested_wait()
+    result = wait_for_results([job_id], wait).get(job_id) if wait else get_result(job_id)
+    if result is None:
+        return jsonify({"error": "Lavoro non trovato"}), 404
+    return jsonify(result)
+
+@app.route('/results', methods=['GET', 'POST'])
+def get_job_results():
+    """
+    Risultati di più lavori in una richiesta: GET /results?ids=a,b,c oppure
+    POST con {"job_ids": [...]}. Con ?wait=N attende fino a N secondi che
+    nessuno dei lavori sia ancora in coda. I job_id sconosciuti sono in 'missing'.
+    """
+    if request.method == 'POST':
+        job_ids = (request.get_json(silent=True) or {}).get('job_ids') or []
+    else:
+        job_ids = [job_id for job_id in request.args.get('ids', '').split(',') if job_id]
+    if not isinstance(job_ids, list) or not job_ids:
+        return jsonify({"error": "Nessun job_id"}), 400
+    if len(job_ids) > config.RESULTS_MAX_BATCH:
+        return jsonify({"error": f"Al massimo {config.RESULTS_MAX_BATCH} job_id per richiesta"}), 400
+    job_ids = [str(job_id) for job_id in job_ids]
+
+    wait = requested_wait()
+    results = wait_for_results(job_ids, wait) if wait else get_results(job_ids)
+    return jsonify({
+        "results": [results[job_id] for job_id in job_ids if job_id in results],
+        "missing": [job_id for job_id in job_ids if job_id not in results]
+    })
+
+@app.route('/events', methods=['GET', 'POST'])
+def events():
+    """
+    GET: elenco degli eventi. POST con {"event": "<chiave>"}: crea un evento,
+    con la propria galleria (EVENTS_DIR/<evento>/gallery) e il proprio indice.
+    """
+    if request.method == 'GET':
+        return jsonify({"events": list_events()})
+    event = str((request.get_json(silent=True) or {}).get('event') or request.args.get('event') or '')
+    if not EVENT_KEY_PATTERN.match(event):
+        return jsonify({"error": "Chiave dell'evento non valida: 1-63 caratteri tra a-z, 0-9, '-' e '_'"}), 400
+    if not create_event(event):
+        return jsonify({"error": f"Evento '{event}' già esistente"}), 409
+    return jsonify(get_event(event)), 201
+
+@app.route('/events/<event>/archive', methods=['POST'])
+def archive(event):
+    """
+    Archivia un evento: non accetta più caricamenti e i worker ne scaricano
+    l'indice dalla memoria. Galleria e indice restano su disco.
+    """
+    if event == config.DEFAULT_EVENT:
+        return jsonify({"error": "L'evento predefinito non può essere archiviato"}), 400
+    if not archive_event(event):
+        return jsonify({"error": f"Evento '{event}' sconosciuto"}), 404
+    return jsonify(get_event(event))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metriche in formato Prometheus (con METRICS_TOKEN impostato serve Authorization: Bearer)."""
+    if config.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {config.METRICS_TOKEN}":
+        return jsonify({"error": "Non autorizzato"}), 401
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000)
@@ -5,41 +5,389 @@ import config
 import logging
 import time
 import os
-import json
-from image_processor import find_faces_in_image
+import argparse
+import gc
+import queue
+import signal
+import multiprocessing
+import threading
+from collections import deque
+import metrics
+from image_processor import (evict_face_index, find_faces_in_images, get_face_index,
+                             set_index_persistence, warm_up)
+from job_queue import DRAIN_RATE, QUEUE_DEPTH, create_queue, decode_job, export_queue_metrics
+from result_store import EVENT_ACTIVE, get_event_statuses, init_results_db, purge_expired_results, save_results
 
 r = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+job_queue = create_queue(r)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - WORKER - %(message)s')
 
-def save_result(image_path, matches):
-    """Salva i risultati in un file JSON."""
-    result_filename = os.path.basename(image_path) + ".json"
-    result_path = os.path.join(config.RESULTS_FOLDER, result_filename)
-    
-    with open(result_path, 'w') as f:
-        json.dump({'source_image': image_path, 'matches': matches}, f, indent=4)
-    logging.info(f"Risultato salvato in: {result_path}")
+JOBS = metrics.Counter('worker_jobs_total', "Lavori elaborati per corsia ed esito (done, failed, retry)",
+                       ['lane', 'status'])
+BATCH_SECONDS = metrics.Histogram('worker_batch_duration_seconds', "Durata dell'elaborazione di un gruppo di lavori")
+BATCH_SIZE = metrics.Histogram('worker_batch_size', "Lavori per gruppo", buckets=(1, 2, 4, 8, 16, 32, 64))
 
-def main():
-    logging.info("Worker avviato. In attesa di lavori...")
-    while True:
+_last_purge = 0.0
+
+def purge_results_if_due():
+    """Elimina i risultati scaduti, al massimo una volta ogni RESULTS_PURGE_INTERVAL."""
+    global _last_purge
+    if time.monotonic() - _last_purge < config.RESULTS_PURGE_INTERVAL:
+        return
+    _last_purge = time.monotonic()
+    deleted = purge_expired_results()
+    if deleted:
+        logging.info(f"Eliminati {deleted} risultati scaduti")
+
+def next_batch():
+    """
+    Attende un lavoro, poi raccoglie quelli già in coda fino a WORKER_BATCH_SIZE,
+    aspettando al massimo WORKER_BATCH_WAIT_MS per riempire il gruppo. Le corsie
+    di priorità (QUEUE_LANES) si dividono i posti del gruppo secondo i loro pesi.
+    Il timeout WORKER_POLL_SECONDS permette di controllare periodicamente se è stato chiesto l'arresto.
+    """
+    return job_queue.fetch(config.WORKER_BATCH_SIZE, config.WORKER_BATCH_WAIT_MS / 1000, config.WORKER_POLL_SECONDS)
+
+_stopping = False
+
+def request_stop(signum, frame):
+    """SIGTERM/SIGINT: termina il gruppo di lavori in corso, poi esce."""
+    global _stopping
+    _stopping = True
+
+def analyze_batch(decoded, face_index):
+    """
+    Corrispondenze di ogni lavoro (job_id, percorso, evento) del gruppo, nello stesso ordine:
+    le immagini di ogni evento vengono confrontate con la galleria di quell'evento
+    (`face_index` per quello predefinito). None = analisi fallita, False = evento
+    sconosciuto o archiviato (il lavoro non va ritentato).
+    """
+    results = [None] * len(decoded)
+    by_event = {}
+    for position, (_, _, event) in enumerate(decoded):
+        by_event.setdefault(event, []).append(position)
+    statuses = get_event_statuses(by_event)
+
+    for event, positions in by_event.items():
+        if statuses.get(event) != EVENT_ACTIVE:
+            # Un evento archiviato esce dall'indice caldo: il suo indice non resta in memoria
+            if evict_face_index(event):
+                logging.info(f"Evento {event} archiviato: indice scaricato dalla memoria")
+            for position in positions:
+                results[position] = False
+            continue
+        index = face_index if event == config.DEFAULT_EVENT else get_face_index(event)
+        paths = [decoded[position][1] for position in positions]
+        for position, matches in zip(positions, find_faces_in_images(paths, index)):
+            results[position] = matches
+    return results
+
+def fail_batch(jobs, error, outcomes):
+    """
+    Dopo un errore imprevisto nell'elaborazione di un gruppo, ogni lavoro non ancora
+    confermato viene dato per fallito: chi ha ancora tentativi verrà ripreso, gli altri
+    vengono registrati come falliti così i client ricevono comunque uno stato finale.
+    `outcomes` contiene l'esito (definitivo o no) dei lavori già passati a job_queue.fail.
+    """
+    results = []
+    for job in jobs:
+        try:
+            job_id, image_path, _ = decode_job(job.payload)
+        except (KeyError, TypeError):
+            job_id = image_path = None
+        if job_id in outcomes:
+            final = outcomes[job_id]
+        else:
+            final = job_queue.fail(job, f"errore del worker: {error}")
+            JOBS.labels(lane=job.lane, status='failed' if final else 'retry').inc()
+        if final and job_id is not None:
+            results.append((job_id, image_path, None, f"errore del worker: {error}"))
+    try:
+        save_results(results)
+    except Exception as e:
+        metrics.count_error('worker', 'save_failed', e)
+        logging.error(f"Impossibile registrare i {len(results)} lavori falliti: {e}")
+
+def run_worker(face_index, on_batch=None):
+    """
+    Preleva ed elabora gruppi di lavori finché non viene chiesto l'arresto.
+    `face_index` è l'indice dell'evento predefinito, quelli degli altri eventi vengono caricati al primo uso.
+    """
+    while not _stopping:
+        jobs = []
+        # Esito di job_queue.fail per job_id, per non ripeterlo se il gruppo fallisce
+        outcomes = {}
+        acked = False
         try:
-            # blpop attende in modo efficiente un messaggio dalla coda
-            _, job_data = r.blpop(config.REDIS_QUEUE_NAME)
-            image_path = job_data.decode('utf-8')
-            logging.info(f"Lavoro ricevuto: {image_path}")
-            
-            matches = find_faces_in_image(image_path)
-            
-            if matches is not None:
-                save_result(image_path, matches)
-            else:
-                logging.warning(f"Analisi fallita per {image_path}.")
+            # Attende in modo efficiente il primo lavoro, gli altri vengono presi se già in coda
+            purge_results_if_due()
+            jobs = next_batch()
+            if not jobs:
+                continue
+            decoded = [decode_job(job.payload) for job in jobs]
+            image_paths = [path for _, path, _ in decoded]
+            logging.info(f"Lavori ricevuti ({len(image_paths)}): {image_paths}")
+            started = time.perf_counter()
+
+            # Rilevazione ed embedding di tutto il gruppo in un solo passaggio, poi un risultato per lavoro
+            results = []
+            completed = []
+            failed = 0
+            for job, (job_id, image_path, event), matches in zip(jobs, decoded, analyze_batch(decoded, face_index)):
+                if matches is False:
+                    failed += 1
+                    logging.warning(f"Evento {event} sconosciuto o archiviato: {image_path} non analizzata.")
+                    results.append((job_id, image_path, None, "evento sconosciuto o archiviato"))
+                    completed.append(job)
+                    JOBS.labels(lane=job.lane, status='failed').inc()
+                elif matches is not None:
+                    results.append((job_id, image_path, matches, None))
+                    completed.append(job)
+                    JOBS.labels(lane=job.lane, status='done').inc()
+                else:
+                    failed += 1
+                    logging.warning(f"Analisi fallita per {image_path}.")
+                    # Con nuovi tentativi previsti il lavoro resta 'queued'
+                    outcomes[job_id] = job_queue.fail(job, "analisi fallita")
+                    if outcomes[job_id]:
+                        results.append((job_id, image_path, None, "analisi fallita"))
+                        JOBS.labels(lane=job.lane, status='failed').inc()
+                    else:
+                        JOBS.labels(lane=job.lane, status='retry').inc()
+            # Tutti i risultati del gruppo in una transazione; solo dopo i lavori vengono confermati
+            save_results(results)
+            logging.info(f"Risultati salvati per {len(results)} lavori")
+            job_queue.ack(completed)
+            acked = True
+            elapsed = time.perf_counter() - started
+            BATCH_SECONDS.observe(elapsed)
+            BATCH_SIZE.observe(len(jobs))
+            if on_batch:
+                on_batch(len(completed), failed, elapsed)
         except Exception as e:
+            metrics.count_error('worker', 'batch', e)
             logging.error(f"Errore nel worker: {e}")
+            if not acked:
+                fail_batch(jobs, e, outcomes)
             time.sleep(1)
 
+def main():
+    if config.WORKER_METRICS_PORT:
+        export_queue_metrics(job_queue)
+        metrics.start_http_server(config.WORKER_METRICS_PORT)
+        logging.info(f"Metriche su http://0.0.0.0:{config.WORKER_METRICS_PORT}/metrics")
+    # Modello e detector vengono caricati subito, non al primo lavoro
+    warm_up()
+    # L'indice della galleria resta in memoria per tutta la vita del worker
+    face_index = get_face_index()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    logging.info(f"Worker avviato ({len(face_index)} volti in indice). In attesa di lavori...")
+    run_worker(face_index)
+    logging.info("Worker arrestato.")
+
+# --- Modalità prefork: un supervisore e N processi figli ---
+
+def reset_child_metrics():
+    """
+    Le misure ereditate dal supervisore (caricamento dell'indice) restano sue: non
+    vanno contate due volte. Anche i gauge della coda sono suoi: un figlio avviato
+    dopo export_queue_metrics non li calcola (con un DrainRate copiato al fork).
+    """
+    metrics.REGISTRY.reset()
+    QUEUE_DEPTH.set_function(None)
+    DRAIN_RATE.set_function(None)
+
+def child_main(slot, stats_queue):
+    """
+    Processo figlio: modello, detector e indice sono già in memoria, ereditati dal supervisore.
+    Le metriche del figlio arrivano al supervisore insieme alle statistiche dei gruppi,
+    al massimo una volta ogni WORKER_METRICS_PUSH_SECONDS.
+    """
+    global r, job_queue
+    # Ogni processo usa una propria connessione a Redis ed è un consumer distinto
+    r = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+    job_queue = create_queue(r)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    reset_child_metrics()
+
+    # Tutti i figli allineano l'indice alla galleria, ma solo il primo lo salva su disco
+    set_index_persistence(slot == 0)
+    # Modello, detector e indice sono quelli del supervisore: nessun nuovo caricamento
+    face_index = get_face_index()
+    logging.info(f"Figlio {slot} (pid {os.getpid()}) pronto.")
+
+    last_push = 0.0
+
+    def on_batch(done, failed, seconds):
+        nonlocal last_push
+        snapshot = None
+        if time.monotonic() - last_push >= config.WORKER_METRICS_PUSH_SECONDS:
+            snapshot = metrics.REGISTRY.snapshot()
+            last_push = time.monotonic()
+        stats_queue.put((slot, done, failed, seconds, snapshot))
+
+    run_worker(face_index, on_batch)
+    # Ultime metriche prima dell'uscita
+    stats_queue.put((slot, 0, 0, None, metrics.REGISTRY.snapshot()))
+
+class ChildMetrics:
+    """
+    Metriche dei figli raccolte dal supervisore: l'ultimo snapshot di ogni
+    figlio vivo più la somma di quelli dei figli già terminati, così i
+    contatori non ripartono da zero quando un figlio viene riavviato.
+    """
+
+    def __init__(self):
+        self._latest = {}
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def update(self, slot, snapshot):
+        with self._lock:
+            self._latest[slot] = snapshot
+
+    def retire(self, slot):
+        with self._lock:
+            if slot in self._latest:
+                self._retired = metrics.merge_snapshots([self._retired, self._latest.pop(slot)])
+
+    def render(self):
+        with self._lock:
+            snapshots = [self._retired, *self._latest.values()]
+        return metrics.render(metrics.merge_snapshots(snapshots + [metrics.REGISTRY.snapshot()]))
+
+class ChildStats:
+    """Lavori, latenze (per gruppo) e riavvii di un posto nel pool dei figli."""
+
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.restarts = 0
+        self.latencies = deque(maxlen=1000)
+
+    def record(self, done, failed, seconds):
+        self.done += done
+        self.failed += failed
+        if seconds is not None:
+            self.latencies.append(seconds)
+
+    def summary(self):
+        text = f"{self.done} lavori, {self.failed} falliti, {self.restarts} riavvii"
+        if self.latencies:
+            ordered = sorted(self.latencies)
+            p50 = ordered[len(ordered) // 2]
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            text += f", latenza per gruppo p50 {p50:.2f}s p95 {p95:.2f}s"
+        return text
+
+def supervise(concurrency):
+    """
+    Carica modello, detector e indice una volta sola, poi avvia `concurrency` processi
+    figli con fork (le pagine restano condivise copy-on-write). I figli che terminano
+    in modo anomalo vengono riavviati; con SIGTERM i figli finiscono il gruppo in
+    corso e il supervisore attende la loro uscita.
+    """
+    warm_up()
+    face_index = get_face_index()
+    logging.info(f"Supervisore: modello, detector e indice caricati ({len(face_index)} volti), avvio {concurrency} figli")
+
+    # Gli oggetti già caricati non vengono più toccati dal GC: le loro pagine restano condivise
+    gc.freeze()
+
+    context = multiprocessing.get_context('fork')
+    stats_queue = context.Queue()
+    children = {}
+    started_at = {}
+    stats = {slot: ChildStats() for slot in range(concurrency)}
+    child_metrics = ChildMetrics()
+
+    def receive(message):
+        slot, done, failed, seconds, snapshot = message
+        stats[slot].record(done, failed, seconds)
+        if snapshot is not None:
+            child_metrics.update(slot, snapshot)
+
+    def start_child(slot):
+        process = context.Process(target=child_main, args=(slot, stats_queue), name=f"worker-{slot}")
+        process.start()
+        children[slot] = process
+        started_at[slot] = time.monotonic()
+
+    def report():
+        try:
+            logging.info(f"Coda: {job_queue.stats()}")
+        except Exception as e:
+            logging.error(f"Impossibile leggere lo stato della coda: {e}")
+        for slot in sorted(stats):
+            pid = children[slot].pid if slot in children else '-'
+            logging.info(f"Figlio {slot} (pid {pid}): {stats[slot].summary()}")
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    for slot in range(concurrency):
+        start_child(slot)
+
+    # Il server delle metriche parte dopo i primi fork; per quelli dei riavvii i lock
+    # delle metriche vengono ricreati nel figlio (vedi metrics._reset_locks_after_fork)
+    if config.WORKER_METRICS_PORT:
+        export_queue_metrics(job_queue)
+        metrics.start_http_server(config.WORKER_METRICS_PORT, child_metrics.render)
+        logging.info(f"Metriche di tutti i figli su http://0.0.0.0:{config.WORKER_METRICS_PORT}/metrics")
+
+    last_report = time.monotonic()
+    while not _stopping:
+        try:
+            receive(stats_queue.get(timeout=1))
+        except queue.Empty:
+            pass
+
+        for slot, process in list(children.items()):
+            if process.is_alive() or _stopping:
+                continue
+            logging.error(f"Figlio {slot} (pid {process.pid}) terminato con codice {process.exitcode}: riavvio")
+            # Un figlio che muore subito dopo l'avvio non viene riavviato in un ciclo stretto
+            if time.monotonic() - started_at[slot] < config.WORKER_RESTART_BACKOFF_SECONDS:
+                time.sleep(config.WORKER_RESTART_BACKOFF_SECONDS)
+            stats[slot].restarts += 1
+            child_metrics.retire(slot)
+            start_child(slot)
+
+        if time.monotonic() - last_report >= config.WORKER_REPORT_SECONDS:
+            report()
+            last_report = time.monotonic()
+
+    logging.info("Arresto: attendo che i figli completino i lavori in corso...")
+    for process in children.values():
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+    deadline = time.monotonic() + config.WORKER_SHUTDOWN_TIMEOUT
+    for slot, process in children.items():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            logging.warning(f"Figlio {slot} (pid {process.pid}) non si è fermato in tempo: kill")
+            process.kill()
+            process.join()
+
+    # Statistiche degli ultimi gruppi completati durante l'arresto
+    while True:
+        try:
+            receive(stats_queue.get_nowait())
+        except queue.Empty:
+            break
+    report()
+    logging.info("Supervisore arrestato.")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker di riconoscimento facciale")
+    parser.add_argument('--concurrency', type=int, default=config.WORKER_CONCURRENCY,
+                        help="numero di processi worker (1 = un solo processo, senza supervisore)")
+    args = parser.parse_args()
+
     os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
-    os.makedirs(config.RESULTS_FOLDER, exist_ok=True)
-    main()
\ No newline at end of file
+    init_results_db()
+    if args.concurrency > 1:
+        supervise(args.concurrency)
+    else:
+        main()
\ No newline at end of file